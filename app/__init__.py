@@ -1,4 +1,5 @@
 import os
+import zlib
 import datetime
 from uuid import UUID
 
@@ -9,6 +10,7 @@ from flask import (
 from flask_migrate import Migrate
 from flask_cors import CORS
 from werkzeug.utils import import_string
+from sqlalchemy.exc import OperationalError
 
 from app.resources import api
 from app.models import (
@@ -18,11 +20,16 @@ from app.models import (
 from app.services import ExperimentResultCalculator
 from app.exceptions import (
     ApiException, handle_api_exception, handle_uncaught_exception,
-    handle_route_not_found_exception
+    handle_route_not_found_exception, handle_operational_error
 )
-from app.commands import seed, rollup, worker
+from app.commands import seed, rollup, worker, partitions, profile
 from app.encoders import CustomJSONEncoder
-from app.proxies import get_worker, get_mailer, get_redis
+from app.proxies import get_worker, get_mailer, get_redis, init_redis
+from app.workloads import resolve_workload
+from app.instrumentation import init_instrumentation
+from app.metrics import init_metrics
+from app.profiling import init_profiling
+from app.capture import init_capture
 
 
 def load_session():
@@ -55,7 +62,7 @@ def load_token():
         UUID(token_value)
     except ValueError:
         raise ApiException(403, "Invalid token: not uuid")
-    token = Token.query.filter(Token.value==token_value).first()
+    token = Token.find_by_value(token_value)
     if not token:
         raise ApiException(403, "Invalid token")
     else:
@@ -63,8 +70,22 @@ def load_token():
         g.user = token.user
 
 
+def view_option(name):
+    """
+    Flags resources set to skip work every other request needs: `anonymous`
+    resources don't load a user, and `raw_body` ones read their body
+    themselves.
+    """
+
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(getattr(view, 'view_class', None), name, False)
+
+
 def load_user():
-    if 'session' in request.cookies:
+    if view_option('anonymous'):
+        g.user = None
+        g.token = None
+    elif 'session' in request.cookies:
         load_session()
     elif 'Authorization' in request.headers:
         load_token()
@@ -73,7 +94,29 @@ def load_user():
         g.token = None
 
 
+def decompress_body():
+    """
+    Clients may gzip request bodies, see `Content-Encoding` in cli/client.py.
+    The decompressed body replaces the raw one, so everything downstream
+    reads it as usual.
+    """
+
+    if request.headers.get('Content-Encoding') != 'gzip' or view_option('raw_body'):
+        return
+    limit = current_app.config['MAX_DECOMPRESSED_BYTES']
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        body = decompressor.decompress(request.get_data(cache=True), limit)
+    except zlib.error:
+        raise ApiException(400, "Invalid gzip body")
+    if decompressor.unconsumed_tail:
+        raise ApiException(413, f"Decompressed body is larger than {limit} bytes")
+    request._cached_data = body
+
+
 def parse_json():
+    if view_option('raw_body'):
+        return
     request.get_json(force=True, silent=True, cache=True)
 
 
@@ -108,6 +151,7 @@ def create_app():
     CORS(app, resources={
         '/conversions': {'origins': '*'},
         '/exposures': {'origins': '*'},
+        '/beacon': {'origins': '*'},
         # TODO: once the new www is deployed, only allow origin 'www.quicksplit.io',
         '*': {'origins': '*', 'supports_credentials': True}
     })
@@ -118,17 +162,27 @@ def create_app():
     db.init_app(app)
     migrate.init_app(app, db)
     api.init_app(app)
+    init_redis(app)
 
     app.shell_context_processor(shell_context)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_capture(app)
+    app.before_request(resolve_workload)
+    app.before_request(decompress_body)
     app.before_request(parse_json)
     app.before_request(load_user)
+    init_profiling(app)
 
     app.register_error_handler(Exception, handle_uncaught_exception)
     app.register_error_handler(ApiException, handle_api_exception)
+    app.register_error_handler(OperationalError, handle_operational_error)
     app.register_error_handler(404, handle_route_not_found_exception)
 
     app.cli.add_command(seed)
     app.cli.add_command(rollup)
     app.cli.add_command(worker)
+    app.cli.add_command(partitions)
+    app.cli.add_command(profile)
 
     return app
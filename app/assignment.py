@@ -0,0 +1,32 @@
+"""
+Deterministic cohort assignment.
+
+A subject's cohort is picked by hashing it with the id of its experiment
+and weighing the result against the experiment's cohorts, so the same
+subject always gets the same cohort for as long as the cohorts and their
+weights don't change, without storing anything. POST /assign uses this, and
+so does the cli's sdk (cli/cli/sdk.py) with the cohorts served by
+GET /experiments/config. The two must stay in step, or the same subject
+could land in different cohorts depending on who assigned it.
+"""
+
+import hashlib
+
+
+def bucket(salt, subject):
+    "Where `subject` falls in [0, 1), uniformly and stable for a given `salt`."
+
+    digest = hashlib.blake2b(f"{salt}:{subject}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def pick(salt, subject, cohorts):
+    "The cohort of `subject` among `cohorts`, a list of (name, weight) ordered by name."
+
+    point = bucket(salt, subject) * sum(weight for _, weight in cohorts)
+    for name, weight in cohorts:
+        point -= weight
+        if point < 0:
+            return name
+    # Rounding can leave the point at the very end
+    return cohorts[-1][0] if cohorts else None
@@ -0,0 +1,96 @@
+"""
+Traffic capture, for replaying production load shapes locally with
+`python -m benchmarks.replay`.
+
+When CAPTURE_DIR is set, a share (CAPTURE_SAMPLE_RATE) of ingestion and
+dashboard requests is appended to `CAPTURE_DIR/capture-<pid>.ndjson`, one
+json object per line: when the request arrived, its method, route and path,
+its json body, an alias of the token it was made with, its status and how
+long it took.
+
+Captures are sanitized, since they are copied off the server:
+
+- Tokens are replaced by an alias, an HMAC of the token keyed with
+  CAPTURE_SECRET, that can't be used to authenticate but still tells apart
+  the traffic of different tokens. Without the secret, aliases can't be
+  reversed by hashing likely values. It's required with CAPTURE_DIR, and
+  shared by every worker so replays can match tokens across their files.
+- Subject names are aliased the same way, so their cardinality is kept.
+- Only json bodies of known fields are kept, and routes that handle
+  passwords or payments are never captured.
+"""
+
+import hashlib
+import hmac
+import os
+import random
+import threading
+import time
+
+from flask import g, request, current_app, json
+
+
+CAPTURED_WORKLOADS = ['ingestion', 'dashboard']
+EXCLUDED_ROUTES = ['/login', '/sessions', '/user', '/account/payment-setup', '/account/plan', '/webhooks/stripe',
+                   '/metrics']
+BODY_FIELDS = ['experiment', 'subject', 'cohort', 'value', 'name', 'environment']
+HASHED_FIELDS = ['subject']
+
+_lock = threading.Lock()
+
+
+def alias(value):
+    secret = current_app.config['CAPTURE_SECRET'].encode()
+    return hmac.new(secret, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def sanitize(body):
+    if not isinstance(body, dict):
+        return None
+    return {
+        key: alias(value) if key in HASHED_FIELDS else value
+        for key, value in body.items() if key in BODY_FIELDS
+    }
+
+
+def should_capture():
+    if not current_app.config['CAPTURE_DIR'] or request.url_rule is None:
+        return False
+    if request.url_rule.rule in EXCLUDED_ROUTES:
+        return False
+    if g.get('workload') not in CAPTURED_WORKLOADS:
+        return False
+    return random.random() < current_app.config['CAPTURE_SAMPLE_RATE']
+
+
+def capture_request(response):
+    if not should_capture():
+        return response
+    token = g.get('token')
+    stats = g.get('request_stats')
+    elapsed = time.perf_counter() - stats.started if stats else 0.0
+    record = {
+        # When the request arrived
+        'ts': time.time() - elapsed,
+        'method': request.method,
+        'route': request.url_rule.rule,
+        'path': request.path,
+        'query': request.query_string.decode() or None,
+        'body': sanitize(request.get_json(force=True, silent=True)),
+        'token': alias(token.value) if token is not None else None,
+        'status': response.status_code,
+        'duration_ms': round(elapsed * 1000, 2) if stats else None,
+    }
+    line = json.dumps(record) + "\n"
+    os.makedirs(current_app.config['CAPTURE_DIR'], exist_ok=True)
+    path = os.path.join(current_app.config['CAPTURE_DIR'], f"capture-{os.getpid()}.ndjson")
+    with _lock:
+        with open(path, 'a') as f:
+            f.write(line)
+    return response
+
+
+def init_capture(app):
+    if app.config['CAPTURE_DIR'] and not app.config['CAPTURE_SECRET']:
+        raise ValueError("CAPTURE_SECRET must be set to capture traffic")
+    app.after_request(capture_request)
@@ -1,29 +1,35 @@
 from pprint import pprint
+import datetime as dt
+import cProfile
+import json
+import pstats
+import time
 
 from flask import current_app
-from flask.cli import AppGroup
-from click import argument, option
+from flask.cli import AppGroup, pass_script_info
+from click import argument, option, command
 from rq import Worker, Connection
-import redis
 
-from app.models import db, ExposureRollup
+from app.models import db, ExposureRollup, User
 from app.seeds import plans, roles, scopes, plan_schedules
 from app.sql import exposures_summary
+from app import partitions as partition_helpers
+from app import synthetic as synthetic_data
+from app.proxies import get_redis, JsonSerializableJobClass
+from app.profiling import top_functions
 from migrations import data_migrations
 
 
 seed = AppGroup(name="seed", help="Commands to seed the database")
 rollup = AppGroup(name="rollup", help="Commands to run daily rollups")
 worker = AppGroup(name="worker", help="Commands to manage the redis-queue worker")
-
+partitions = AppGroup(name="partitions", help="Commands to manage partitions of the event tables")
 
 
 @worker.command("run")
 def run_worker():
-    redis_url = current_app.config["REDIS_URL"]
-    redis_connection = redis.from_url(redis_url)
-    with Connection(redis_connection):
-        worker = Worker(current_app.config["WORKER_QUEUES"])
+    with Connection(get_redis()):
+        worker = Worker(current_app.config["WORKER_QUEUES"], job_class=JsonSerializableJobClass)
         worker.work()
 
 
@@ -36,6 +42,37 @@ def all():
     db.session.commit()
 
 
+@seed.command()
+@option("--accounts", default=10, help="Number of accounts, each with one user")
+@option("--experiments", default=100, help="Experiments per account")
+@option("--subjects", default=100000, help="Subjects per account")
+@option("--exposures", default=1000000, help="Exposures in total, spread over the accounts")
+@option("--conversion-rate", default=0.1, help="Share of the control cohort that converts")
+@option("--lift", default=0.1, help="Relative increase of the conversion rate in the experimental cohort")
+@option("--days", default=90, help="Exposures are spread over this many days, up to now")
+@option("--zipf", default=1.1, help="Exponent of the Zipf distribution of traffic over accounts and experiments")
+@option("--scope", default="production")
+@option("--seed", "random_seed", default=None, type=int, help="Seed for reproducible volumes and timings")
+def synthetic(accounts, experiments, subjects, exposures, conversion_rate, lift, days, zipf, scope, random_seed):
+    """
+    Generate accounts, experiments and events at scale for load testing
+    """
+
+    if current_app.env == "production":
+        raise ValueError("Refusing to load synthetic data into production")
+    started = time.perf_counter()
+    counts = synthetic_data.generate(
+        accounts=accounts, experiments=experiments, subjects=subjects, exposures=exposures,
+        conversion_rate=conversion_rate, lift=lift, days=days, exponent=zipf, scope=scope, seed=random_seed
+    )
+    if current_app.testing:
+        db.session.flush()
+        print("Not commiting during tests")
+    else:
+        db.session.commit()
+    print(f"Loaded {counts} in {time.perf_counter() - started:.0f}s")
+
+
 @seed.command()
 @argument("_revision")
 @option("--up", default=False, is_flag=True)
@@ -68,8 +105,7 @@ def exposures(date):
     Aggregate exposures for each experiment and environment, per day
     """
 
-    query = exposures_summary.format(date=date)
-    results = db.session.execute(query).fetchall()
+    results = exposures_summary.execute(date=date).fetchall()
     results_dict = list(dict(r) for r in results)
     db.session.bulk_insert_mappings(ExposureRollup, results_dict)
     if current_app.testing:
@@ -81,3 +117,79 @@ def exposures(date):
     affected_users = set(d['user_id'] for d in results_dict)
     num_affected_users = len(affected_users)
     print(f"Ran rollup for {date}: {num_affected_users} affected users: {affected_users}")
+
+
+@partitions.command("create")
+@option("--months", default=3, help="Number of months to create, starting with the current month")
+@option("--start", default=None, help="First month to create (YYYY-MM-DD), defaults to today")
+def create_partitions(months, start):
+    """
+    Create monthly partitions ahead of time for the exposure and conversion tables
+    """
+
+    start = dt.datetime.strptime(start, '%Y-%m-%d').date() if start else dt.date.today()
+    for table in partition_helpers.PARTITIONED_TABLES:
+        created = partition_helpers.create_partitions(table, start, months)
+        print(f"Created {len(created)} partitions for {table}: {created}")
+        default_rows = partition_helpers.default_partition_rows(table)
+        if default_rows:
+            print(f"Warning: {table}_default contains {default_rows} rows")
+    if current_app.testing:
+        db.session.flush()
+        print("Not commiting during tests")
+    else:
+        db.session.commit()
+
+
+@partitions.command("detach")
+@argument("before")
+@option("--drop", default=False, is_flag=True, help="Drop the partitions instead of keeping them as archive tables")
+def detach_partitions(before, drop):
+    """
+    Detach monthly partitions holding data older than BEFORE (YYYY-MM-DD)
+    """
+
+    before = dt.datetime.strptime(before, '%Y-%m-%d').date()
+    for table in partition_helpers.PARTITIONED_TABLES:
+        detached = partition_helpers.detach_partitions(table, before, drop=drop)
+        action = "Dropped" if drop else "Detached"
+        print(f"{action} {len(detached)} partitions from {table}: {detached}")
+    if current_app.testing:
+        db.session.flush()
+        print("Not commiting during tests")
+    else:
+        db.session.commit()
+
+
+@command("profile")
+@argument("route")
+@option("--method", default="GET")
+@option("--data", default=None, help="JSON body to send")
+@option("--token", default=None, help="Token to authenticate with, defaults to the first user's admin token")
+@option("-n", "--requests", default=20, help="Number of times to send the request")
+@option("--limit", default=30, help="Number of functions to print")
+@option("--sort", default="cumulative", help="pstats sort key, eg cumulative or tottime")
+@pass_script_info
+def profile(script_info, route, method, data, token, requests, limit, sort):
+    """
+    Send a request to ROUTE repeatedly against a local app, and print the
+    functions it spent the most time in. Requests are committed as usual.
+    """
+
+    app = script_info.load_app()
+    if token is None:
+        with app.app_context():
+            token = str(User.query.order_by(User.created_at.asc()).first().admin_token.value)
+    client = app.test_client()
+    send = lambda: client.open(route, method=method, headers={'Authorization': token},
+                               json=json.loads(data) if data else None)
+
+    # The first request pays for imports and caches, leave it out
+    status = send().status_code
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for _ in range(requests):
+        send()
+    profiler.disable()
+    print(f"{method} {route}: {status}, {requests} requests")
+    print(top_functions(pstats.Stats(profiler), limit=limit, sort=sort))
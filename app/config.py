@@ -1,13 +1,94 @@
 import os
 
 
+# Must match the gunicorn flags in bin/web, the pools below are sized from them.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+
+
 class ProductionConfig(object):
     SECRET_KEY = os.environ['SECRET_KEY']
     DATABASE_URL = os.environ['DATABASE_URL']
     REDIS_URL = os.environ['REDIS_URL']
+    # One pool per process, shared by the request threads and the queue.
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', WEB_THREADS * 2))
+    REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
     SQLALCHEMY_DATABASE_URI = DATABASE_URL
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
+    # One connection per request thread, plus a little overflow for the
+    # occasional extra connection. Each process can open at most
+    # pool_size + max_overflow, so postgres needs at least
+    # WEB_CONCURRENCY * (WEB_THREADS + DATABASE_MAX_OVERFLOW) for the web dyno.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': WEB_THREADS,
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 2)),
+        'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 5)),
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+    # Milliseconds, applied with `SET statement_timeout` when a connection is
+    # checked out. See app/workloads.py.
+    STATEMENT_TIMEOUTS = {
+        'ingestion': int(os.environ.get('INGESTION_STATEMENT_TIMEOUT', 2000)),
+        'dashboard': int(os.environ.get('DASHBOARD_STATEMENT_TIMEOUT', 10000)),
+        'analytics': int(os.environ.get('ANALYTICS_STATEMENT_TIMEOUT', 60000)),
+        'background': int(os.environ.get('BACKGROUND_STATEMENT_TIMEOUT', 0)),
+    }
+    DEFAULT_WORKLOAD = 'dashboard'
+    # Prepare the queries in app/sql once per connection. Turn off behind
+    # poolers that don't keep server sessions, see app/sql/__init__.py.
+    SQL_PREPARED_STATEMENTS = os.environ.get('SQL_PREPARED_STATEMENTS', 'true') == 'true'
+    # Statements per request, by route. See app/instrumentation.py.
+    DEFAULT_QUERY_BUDGET = 25
+    QUERY_BUDGETS = {
+        '/exposures': 20,
+        '/conversions': 20,
+        '/assign': 10,
+        '/experiments': 12,
+        '/experiments/config': 5,
+        '/recent': 5,
+        '/tokens': 5,
+        '/user': 30,
+    }
+    QUERY_BUDGET_STRICT = False
+    # See app/metrics.py. /metrics refuses every scrape until a token is set.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true') == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # See app/profiling.py
+    PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', 'false') == 'true'
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/quicksplit-profiles')
+    PROFILE_SAMPLER = os.environ.get('PROFILE_SAMPLER', 'false') == 'true'
+    PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.01))
+    # Most events accepted by one POST /events
+    MAX_EVENTS_BATCH = int(os.environ.get('MAX_EVENTS_BATCH', 1000))
+    # Most exposures or conversions accepted by one batch request
+    MAX_INGESTION_BATCH = int(os.environ.get('MAX_INGESTION_BATCH', 1000))
+    # navigator.sendBeacon refuses payloads over 64kb
+    MAX_BEACON_BYTES = int(os.environ.get('MAX_BEACON_BYTES', 64 * 1024))
+    # How long beacons remember whether a token is public, see Token.is_public
+    TOKEN_CACHE_SECONDS = int(os.environ.get('TOKEN_CACHE_SECONDS', 5 * 60))
+    # How long POST /assign remembers a subject's cohort, see Exposure.assign
+    ASSIGNMENT_CACHE_SECONDS = int(os.environ.get('ASSIGNMENT_CACHE_SECONDS', 24 * 60 * 60))
+    # Largest page of a paged list route, see `paginate` in app/resources.py
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+    # Rows read from the cursor at a time by exports, see app/exports.py
+    EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 5000))
+    # Limit on gzipped request bodies once decompressed
+    MAX_DECOMPRESSED_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BYTES', 16 * 1024 * 1024))
+    # See app/capture.py
+    CAPTURE_DIR = os.environ.get('CAPTURE_DIR')
+    CAPTURE_SAMPLE_RATE = float(os.environ.get('CAPTURE_SAMPLE_RATE', 1.0))
+    # Keys the aliases of captured tokens and subjects, required with
+    # CAPTURE_DIR. Every worker must share it for aliases to match across
+    # their capture files.
+    CAPTURE_SECRET = os.environ.get('CAPTURE_SECRET')
+    # Optional. See app/replicas.py for which queries are sent to the replica.
+    REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+    SQLALCHEMY_BINDS = {'replica': REPLICA_DATABASE_URL} if REPLICA_DATABASE_URL else {}
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 10))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
     PROPAGATE_EXCEPTIONS = True
     STRIPE_TEST_PUBLISHABLE_KEY = os.environ['STRIPE_TEST_PUBLISHABLE_KEY']
     STRIPE_TEST_SECRET_KEY = os.environ['STRIPE_TEST_SECRET_KEY']
@@ -24,6 +105,11 @@ class TestingConfig(ProductionConfig):
     SQLALCHEMY_DATABASE_URI = DATABASE_URL
     SQLALCHEMY_TRACK_MODIFICATIONS = True
     SQLALCHEMY_ECHO = False
+    # Test fixtures are never committed, so a second connection couldn't
+    # see them. Tests that need a replica add the bind themselves.
+    SQLALCHEMY_BINDS = {}
+    QUERY_BUDGET_STRICT = True
+    CAPTURE_SECRET = 'testing'
 
 
 class DevelopmentConfig(ProductionConfig):
@@ -1,10 +1,14 @@
 import traceback
-from flask import current_app, make_response, json
+from flask import current_app, make_response, json, g, request
 from app.models import db
 
 from dataclasses import dataclass
 
 
+# https://www.postgresql.org/docs/current/errcodes-appendix.html
+QUERY_CANCELED = '57014'
+
+
 @dataclass
 class ApiException(Exception):
     message: str
@@ -46,3 +50,17 @@ def handle_uncaught_exception(exc):
         'status_code': 500
     }
     return make_response(json.dumps(resp), 500)
+
+
+def handle_operational_error(exc):
+    if getattr(exc.orig, 'pgcode', None) != QUERY_CANCELED:
+        return handle_uncaught_exception(exc)
+    if not current_app.testing:
+        db.session.rollback()
+    current_app.logger.warning(f"Statement timeout for {g.get('workload')} workload: {request.method} {request.path}")
+    resp = {
+        'data': None,
+        'message': "This request took too long. Please try again later.",
+        'status_code': 503
+    }
+    return make_response(json.dumps(resp), 503)
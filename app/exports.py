@@ -0,0 +1,69 @@
+"""
+Raw data exports, streamed as they're read from the database.
+
+`GET /experiments/<name>/export` sends one row per exposure of the
+experiment, with its conversion if there is one. Rows are read with a
+server side cursor, `EXPORT_FETCH_SIZE` at a time, and each batch is written
+to the response as soon as it's read, with chunked transfer encoding, so
+memory stays flat however large the experiment is. Clients that accept
+gzip get the stream compressed on the fly.
+"""
+
+import csv
+import io
+import zlib
+
+from flask import Response, json, request, stream_with_context
+
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def ndjson_chunks(batches):
+    for rows in batches:
+        yield "".join(json.dumps(dict(row)) + "\n" for row in rows)
+
+
+def csv_chunks(batches):
+    header = True
+    for rows in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(rows[0].keys())
+            header = False
+        for row in rows:
+            writer.writerow(value.isoformat() if hasattr(value, 'isoformat') else value for value in row)
+        yield buffer.getvalue()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def export_response(batches, fmt, filename):
+    """
+    A streamed response of the rows in `batches`, an iterator of lists of
+    rows like `Query.stream` returns.
+    """
+
+    chunks = ndjson_chunks(batches) if fmt == 'ndjson' else csv_chunks(batches)
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'}
+    if accepts_gzip():
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    # The request context, and with it the transaction the cursor lives in,
+    # stays open until the last chunk is sent
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt], headers=headers)
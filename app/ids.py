@@ -0,0 +1,35 @@
+"""
+Primary key generators.
+
+The high volume event tables use time-ordered uuids, so that new rows land
+on the right-most pages of their b-tree indexes instead of random ones.
+They're still ordinary uuids, so they share columns with existing uuid4 ids.
+"""
+
+import os
+import time
+import uuid
+
+
+def uuid7(unix_ms=None):
+    """
+    Version 7 uuid: a 48 bit unix timestamp in milliseconds followed by 74
+    random bits. Must stay compatible with the `uuid_generate_v7()` database
+    function (migration 4b8e0c7d2f61), which fills in ids for rows inserted
+    outside of the ORM. Pass `unix_ms` for rows created in the past.
+    """
+
+    if unix_ms is None:
+        unix_ms = time.time_ns() // 1000000
+    rand = int.from_bytes(os.urandom(10), 'big')
+    value = (unix_ms & 0xFFFFFFFFFFFF) << 80
+    value |= 0x7 << 76
+    value |= ((rand >> 68) & 0xFFF) << 64
+    value |= 0b10 << 62
+    value |= rand & ((1 << 62) - 1)
+    return uuid.UUID(int=value)
+
+
+def uuid7_timestamp(value):
+    "Return the creation time encoded in a version 7 uuid, in unix seconds."
+    return (value.int >> 80) / 1000
@@ -0,0 +1,137 @@
+"""
+Per-request accounting of database and redis work.
+
+Every request records how many statements it ran, the time spent in them,
+the rows they returned and the number of redis round trips. The totals are
+returned in a `Server-Timing` header, logged as one json line per request,
+and checked against a statement budget per route (`QUERY_BUDGETS`, falling
+back to `DEFAULT_QUERY_BUDGET`). Going over budget logs a warning, or raises
+`QueryBudgetExceeded` when `QUERY_BUDGET_STRICT` is set, as it is in tests.
+"""
+
+import time
+from dataclasses import dataclass, field
+
+from flask import g, request, current_app, json, has_request_context
+from redis import Redis
+from redis.client import Pipeline
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@dataclass
+class RequestStats:
+    statements: int = 0
+    db_seconds: float = 0.0
+    rows: int = 0
+    redis_calls: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+# Transaction bookkeeping, which the session emits lazily and isn't a query
+SAVEPOINTS = ('savepoint', 'release savepoint', 'rollback to savepoint')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    stats = current_stats()
+    if stats is not None and not statement.lstrip().lower().startswith(SAVEPOINTS):
+        stats.statements += 1
+        stats.db_seconds += elapsed
+        stats.rows += max(cursor.rowcount, 0)
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+class InstrumentedPipeline(Pipeline):
+
+    def execute(self, *args, **kwargs):
+        stats = current_stats()
+        if stats is not None:
+            stats.redis_calls += 1
+        return super().execute(*args, **kwargs)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Counts round trips to redis. A pipeline counts once, when it's executed.
+    """
+
+    def execute_command(self, *args, **options):
+        stats = current_stats()
+        if stats is not None:
+            stats.redis_calls += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def start_request_stats():
+    g.request_stats = RequestStats()
+
+
+def query_budget(rule):
+    return current_app.config['QUERY_BUDGETS'].get(rule, current_app.config['DEFAULT_QUERY_BUDGET'])
+
+
+def finish_request_stats(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    duration = time.perf_counter() - stats.started
+    rule = request.url_rule.rule if request.url_rule else None
+
+    response.headers['Server-Timing'] = ", ".join([
+        f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.statements} queries, {stats.rows} rows"',
+        f'redis;desc="{stats.redis_calls} calls"',
+        f'total;dur={duration * 1000:.2f}',
+    ])
+    current_app.logger.info(json.dumps({
+        'method': request.method,
+        'route': rule,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'statements': stats.statements,
+        'db_ms': round(stats.db_seconds * 1000, 2),
+        'rows': stats.rows,
+        'redis_calls': stats.redis_calls,
+    }))
+
+    budget = query_budget(rule)
+    if stats.statements > budget:
+        message = f"{request.method} {rule} ran {stats.statements} statements, over its budget of {budget}"
+        if current_app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+def init_instrumentation(app):
+    """
+    Call before registering any other `before_request` hook, so that the
+    work they do is counted.
+    """
+
+    app.before_request(start_request_stats)
+    app.after_request(finish_request_stats)
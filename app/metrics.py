@@ -0,0 +1,143 @@
+"""
+Prometheus metrics, served by `MetricsResource` at /metrics.
+
+Gunicorn runs several worker processes, so when `prometheus_multiproc_dir`
+is set (see bin/web) every process writes its samples to files in that
+directory and a scrape of any worker aggregates all of them. Without it, as
+in development and tests, metrics are kept in process.
+
+Recording a sample is a dictionary lookup and a write to memory, so it's
+cheap enough for every request; `python -m benchmarks.metrics` measures it.
+"""
+
+import os
+import time
+
+from flask import g, request, current_app
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+)
+from prometheus_client.core import GaugeMetricFamily
+from rq import Queue
+
+
+REQUEST_LATENCY = Histogram(
+    'quicksplit_request_duration_seconds', 'Request latency by route',
+    ['method', 'route', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+POOL_WAIT = Histogram(
+    'quicksplit_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+    ['pool'],
+    buckets=(.0001, .001, .005, .01, .05, .1, .5, 1, 5),
+)
+POOL_TIMEOUTS = Counter('quicksplit_pool_timeouts_total', 'Checkouts that timed out', ['pool'])
+POOL_CONNECTIONS = Gauge(
+    'quicksplit_pool_connections', 'Connections held by the pools, summed over live processes',
+    ['pool', 'state'], multiprocess_mode='livesum',
+)
+JOB_DURATION = Histogram(
+    'quicksplit_job_duration_seconds', 'Background job duration',
+    ['function', 'status'],
+    buckets=(.05, .1, .5, 1, 5, 10, 30, 60, 300),
+)
+REPORT_DURATION = Histogram(
+    'quicksplit_report_duration_seconds', 'Time to compute an experiment result, by number of subjects',
+    ['subjects'],
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+CACHE_REQUESTS = Counter('quicksplit_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+
+
+# Each process refreshes its pool gauges at most this often, in seconds
+POOL_GAUGE_INTERVAL = 5
+_pools_updated_at = [0.0]
+
+SIZE_BUCKETS = [(1000, '<1k'), (10000, '<10k'), (100000, '<100k')]
+
+
+def size_bucket(subjects):
+    for limit, label in SIZE_BUCKETS:
+        if subjects < limit:
+            return label
+    return '>=100k'
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def record_pool_wait(pool, waited, timed_out):
+    POOL_WAIT.labels(pool).observe(waited)
+    if timed_out:
+        POOL_TIMEOUTS.labels(pool).inc()
+
+
+def record_request(response):
+    stats = g.get('request_stats')
+    if stats is not None and request.url_rule is not None:
+        REQUEST_LATENCY.labels(request.method, request.url_rule.rule, response.status_code)\
+                       .observe(time.perf_counter() - stats.started)
+    now = time.monotonic()
+    if now - _pools_updated_at[0] >= POOL_GAUGE_INTERVAL:
+        _pools_updated_at[0] = now
+        # The response is ready, and often its writes are committed, so a
+        # gauge that can't be read mustn't turn it into an error
+        try:
+            update_pool_gauges(current_app.extensions['sqlalchemy'].db.engine.pool,
+                               current_app.extensions['redis'].connection_pool)
+        except Exception as exc:
+            current_app.logger.warning(f"Could not update the pool gauges: {exc}")
+    return response
+
+
+class QueueCollector(object):
+    """
+    Reads queue depths from redis when scraped, rather than tracking them in
+    every process.
+    """
+
+    def __init__(self, connection, queue_names):
+        self.connection = connection
+        self.queue_names = queue_names
+
+    def collect(self):
+        depth = GaugeMetricFamily('quicksplit_queue_jobs', 'Jobs waiting in each rq queue', labels=['queue'])
+        failed = GaugeMetricFamily('quicksplit_queue_failed_jobs', 'Failed jobs in each rq queue', labels=['queue'])
+        for name in self.queue_names:
+            queue = Queue(name, connection=self.connection)
+            depth.add_metric([name], queue.count)
+            failed.add_metric([name], queue.failed_job_registry.count)
+        yield depth
+        yield failed
+
+
+def update_pool_gauges(engine_pool, redis_pool):
+    POOL_CONNECTIONS.labels('database', 'checked_out').set(engine_pool.checkedout())
+    POOL_CONNECTIONS.labels('database', 'idle').set(engine_pool.checkedin())
+    redis = redis_pool.describe()
+    POOL_CONNECTIONS.labels('redis', 'checked_out').set(redis['connections'] - redis['idle'])
+    POOL_CONNECTIONS.labels('redis', 'idle').set(redis['idle'])
+
+
+def render(engine_pool, redis):
+    """
+    The metrics of every worker process in the prometheus text format.
+    """
+
+    update_pool_gauges(engine_pool, redis.connection_pool)
+    _pools_updated_at[0] = time.monotonic()
+    if 'prometheus_multiproc_dir' in os.environ:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    queues = CollectorRegistry()
+    queues.register(QueueCollector(redis, current_app.config['WORKER_QUEUES']))
+    return generate_latest(registry) + generate_latest(queues), CONTENT_TYPE_LATEST
+
+
+def init_metrics(app):
+    if app.config['METRICS_ENABLED']:
+        app.after_request(record_request)
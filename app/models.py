@@ -1,24 +1,42 @@
 from typing import Dict, List
 from dataclasses import dataclass, asdict
 import uuid
+import time
+import json
 import datetime as dt
 
 from flask import g, request, current_app
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL, bindparam, text, tuple_
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.ext import baked
 from sqlalchemy.dialects.postgresql import UUID, insert, JSONB, INTERVAL
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 import stripe
 
 from app.encoders import CustomJSONEncoder
-
-db = SQLAlchemy(engine_options={'json_serializer': CustomJSONEncoder().encode})
+from app.ids import uuid7
+from app.assignment import pick
+from app.pools import InstrumentedQueuePool
+from app.replicas import RoutingSQLAlchemy
+from app.metrics import REPORT_DURATION, size_bucket
+
+# Pool sizing lives in SQLALCHEMY_ENGINE_OPTIONS, these options take precedence
+db = RoutingSQLAlchemy(engine_options={
+    'json_serializer': CustomJSONEncoder().encode,
+    'poolclass': InstrumentedQueuePool
+})
+
+# Caches the compiled sql of the lookups on the ingestion and auth paths, so
+# they're only built once per process. Steps are cached by their code, so
+# values must be passed with `bindparam` and `.params()`, never captured.
+bakery = baked.bakery()
 
 from app.exceptions import ApiException
 from app.services import ExperimentResultCalculator
-from app.proxies import worker, mailer
+from app.proxies import worker, mailer, redis
 
 
 class AsyncWriterMixin(object):
@@ -42,6 +60,114 @@ class AsyncWriterMixin(object):
         return obj
 
 
+def use_token(token_value, roles=('admin', 'public')):
+    """
+    Act as the token with `token_value` in a worker, like requests do once
+    they've loaded theirs. Tokens can be deleted, or change hands, between
+    the request and the job, so they're checked again.
+    """
+
+    g.token = Token.find_by_value(token_value)
+    if not g.token:
+        raise ApiException(403, "Invalid token")
+    if g.token.role.name not in roles:
+        raise ApiException(403, "Permission denied. Token does not have access to this resource.")
+    g.user = g.token.user
+
+
+def create_events_async(token_value, exposures, conversions):
+    """
+    Write a beacon's exposures and then its conversions in one job and one
+    transaction, so its conversions find the exposures it just sent.
+    """
+
+    return worker.enqueue(_create_events_async, args=(token_value, exposures, conversions))
+
+
+def _create_events_async(token_value, exposures, conversions):
+    use_token(token_value, roles=['public'])
+    # Nobody is waiting on a beacon to correct it, so invalid records are
+    # dropped rather than taking the valid ones down with them
+    result = {}
+    if exposures:
+        result['exposures'] = Exposure.create_batch(exposures, skip_invalid=True)
+    if conversions:
+        result['conversions'] = Conversion.create_batch(conversions, skip_invalid=True)
+    db.session.commit()
+    return result
+
+
+# Seconds a write-behind drain job may run before another can be queued
+DRAIN_TIMEOUT = 10 * 60
+
+
+class AsyncBatchWriterMixin(object):
+    """
+    Writes batches of events in async workers with `create_batch`, which
+    reads the user and token from `g`. The worker looks the token up again
+    by its value, so requests that haven't looked it up, like beacons, can
+    write events too.
+
+    Events that arrive one at a time, like those of POST /assign, are
+    written behind with `write_behind` instead: they're pushed to a redis
+    list per token, which a job drains in batches.
+    """
+
+    @classmethod
+    def create_batch_async(cls, records, token_value=None):
+        token_value = token_value or str(g.token.value)
+        return worker.enqueue(cls._create_batch_async, args=(token_value, records))
+
+    @classmethod
+    def _create_batch_async(cls, token_value, records, skip_invalid=False):
+        use_token(token_value)
+        result = cls.create_batch(records, skip_invalid=skip_invalid)
+        db.session.commit()
+        return result
+
+    @classmethod
+    def pending_key(cls, token_value):
+        return f"pending:{cls.__tablename__}:{token_value}"
+
+    @classmethod
+    def write_behind(cls, record, token_value=None):
+        token_value = token_value or str(g.token.value)
+        key = cls.pending_key(token_value)
+        redis.rpush(key, CustomJSONEncoder().encode(record))
+        # One drain job per token at a time, which writes everything pushed
+        # while it runs. The flag expires in case the job is lost.
+        if redis.set(f"{key}:queued", 1, nx=True, ex=DRAIN_TIMEOUT):
+            worker.enqueue(cls._drain, args=(token_value,))
+
+    @classmethod
+    def _drain(cls, token_value):
+        key = cls.pending_key(token_value)
+        size = current_app.config['MAX_INGESTION_BATCH']
+        while True:
+            records = redis.lrange(key, 0, size - 1)
+            if not records:
+                redis.delete(f"{key}:queued")
+                # Records pushed just before the flag was cleared didn't queue
+                # a job, so this one carries on with them
+                if redis.llen(key) and redis.set(f"{key}:queued", 1, nx=True, ex=DRAIN_TIMEOUT):
+                    continue
+                return
+            batch = [json.loads(record) for record in records]
+            for record in batch:
+                record['created_at'] = dt.datetime.fromisoformat(record['created_at'])
+            try:
+                # One record the batch can't take, say of an experiment
+                # deactivated since, mustn't lose the others
+                cls._create_batch_async(token_value, batch, skip_invalid=True)
+            except Exception:
+                # The records stay pending, for the job the next push queues
+                redis.delete(f"{key}:queued")
+                raise
+            # Only once they're committed, so a failed job loses nothing
+            redis.ltrim(key, len(records), -1)
+            redis.expire(f"{key}:queued", DRAIN_TIMEOUT)
+
+
 class TimestampMixin(object):
 
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
@@ -54,37 +180,59 @@ class EventTrackerMixin(object):
     last_exposure_at: str
     last_conversion_at: str
 
+    # The exposure and conversion tables are partitioned, and postgres can't
+    # reference a partitioned table unless the foreign key includes the
+    # partition key. So these pointers are plain uuids, joined explicitly.
+    #
+    # The pointers are loaded lazily. They used to be joined, and as each
+    # exposure joins its own subject, cohort and experiment, loading any one
+    # of these models joined dozens of tables. Ingestion sets the pointers to
+    # exposures already in the session, so reading them costs no queries.
+    # Listings should use `last_event_options`.
+
     @declared_attr
     def last_exposure_id_staging(cls):
-        return db.Column(UUID(as_uuid=True), db.ForeignKey('exposure.id', name='experiment_last_exposure_id_staging_fkey'), index=True)
+        return db.Column(UUID(as_uuid=True), index=True)
 
     @declared_attr
     def last_exposure_id_production(cls):
-        return db.Column(UUID(as_uuid=True), db.ForeignKey('exposure.id', name='experiment_last_exposure_id_production_fkey'), index=True)
+        return db.Column(UUID(as_uuid=True), index=True)
 
     @declared_attr
     def last_conversion_id_staging(cls):
-        return db.Column(UUID(as_uuid=True), db.ForeignKey('conversion.id', name='experiment_last_conversion_id_staging_fkey'), index=True)
+        return db.Column(UUID(as_uuid=True), index=True)
 
     @declared_attr
     def last_conversion_id_production(cls):
-        return db.Column(UUID(as_uuid=True), db.ForeignKey('conversion.id', name='experiment_last_conversion_id_production_fkey'), index=True)
+        return db.Column(UUID(as_uuid=True), index=True)
 
     @declared_attr
     def last_exposure_staging(cls):
-        return db.relationship("Exposure", foreign_keys=[cls.last_exposure_id_staging], lazy="joined")
+        return db.relationship("Exposure", primaryjoin=f"Exposure.id==foreign({cls.__name__}.last_exposure_id_staging)")
 
     @declared_attr
     def last_exposure_production(cls):
-        return db.relationship("Exposure", foreign_keys=[cls.last_exposure_id_production], lazy="joined")
+        return db.relationship("Exposure", primaryjoin=f"Exposure.id==foreign({cls.__name__}.last_exposure_id_production)")
 
     @declared_attr
     def last_conversion_staging(cls):
-        return db.relationship("Conversion", foreign_keys=[cls.last_conversion_id_staging], lazy="joined")
+        return db.relationship("Conversion", primaryjoin=f"Conversion.id==foreign({cls.__name__}.last_conversion_id_staging)")
 
     @declared_attr
     def last_conversion_production(cls):
-        return db.relationship("Conversion", foreign_keys=[cls.last_conversion_id_production], lazy="joined")
+        return db.relationship("Conversion", primaryjoin=f"Conversion.id==foreign({cls.__name__}.last_conversion_id_production)")
+
+    @classmethod
+    def last_event_options(cls, scope_name):
+        """
+        Loader options for reading `last_exposure_at` and `last_conversion_at`
+        of many rows at once, as seen by a token for `scope_name`.
+        """
+
+        return [
+            selectinload(getattr(cls, f'last_exposure_{scope_name}')).load_only('last_seen_at'),
+            selectinload(getattr(cls, f'last_conversion_{scope_name}')).load_only('last_seen_at'),
+        ]
 
     @property
     def last_exposure(self):
@@ -149,7 +297,7 @@ class Contact(AsyncWriterMixin, TimestampMixin, db.Model):
     subject = db.Column(db.String(), nullable=False)
     message = db.Column(db.String(), nullable=False)
 
-    user = db.relationship("User", lazy="joined", uselist=False)
+    user = db.relationship("User", lazy="raise", uselist=False)
 
     @classmethod
     def create(cls, email, subject, message):
@@ -178,6 +326,23 @@ class Event(TimestampMixin, db.Model):
 
     user = db.relationship("User", backref=db.backref("events", lazy="dynamic"))
 
+    @classmethod
+    def create_batch(cls, events):
+        """
+        Insert many events in a single statement. Each event is a dict of
+        `name`, `user_id`, `data` and `created_at`, when the event happened,
+        for clients that send events late.
+        """
+
+        rows = [{
+            'name': event['name'],
+            'user_id': event.get('user_id'),
+            'data': event.get('data'),
+            'created_at': event.get('created_at') or func.now(),
+        } for event in events]
+        db.session.execute(insert(cls.__table__).values(rows))
+        return len(rows)
+
 
 @dataclass
 class PlanSchedule(TimestampMixin, db.Model):
@@ -336,7 +501,7 @@ class PaymentMethod(TimestampMixin, db.Model):
     stripe_payment_method_id = db.Column(db.String(), nullable=False)
     stripe_data = db.Column(JSONB())
 
-    account = db.relationship("Account", backref=db.backref("payment_methods", lazy="joined"), lazy="joined")
+    account = db.relationship("Account", backref=db.backref("payment_methods", lazy="select"), lazy="joined")
 
     @classmethod
     def create(cls, account, stripe_payment_method_id, stripe_data=None):
@@ -368,7 +533,7 @@ class Account(TimestampMixin, db.Model):
     stripe_livemode = db.Column(db.Boolean(), default=False)
 
     plan = db.relationship('Plan', backref='accounts', lazy="joined", foreign_keys=[plan_id])
-    downgrade_plan = db.relationship('Plan', lazy="joined", foreign_keys=[downgrade_plan_id])
+    downgrade_plan = db.relationship('Plan', lazy="select", foreign_keys=[downgrade_plan_id])
 
     def __repr__(self):
         return f"<Account {self.id}>"
@@ -506,10 +671,35 @@ class Token(TimestampMixin, db.Model):
     scope_id = db.Column(UUID(as_uuid=True), db.ForeignKey('scope.id'), nullable=False, index=True)
     value = db.Column(UUID(as_uuid=True), unique=True, index=True, default=uuid.uuid4)
 
-    account = db.relationship('Account', lazy='joined')
+    # Authentication reads the role and scope of every token, which are both
+    # tiny tables. The account is the user's, and is loaded with them.
+    account = db.relationship('Account', lazy='select')
     role = db.relationship('Role', lazy='joined')
     scope = db.relationship('Scope', lazy="joined")
 
+    @classmethod
+    def find_by_value(cls, value):
+        query = bakery(lambda session: session.query(Token))
+        query += lambda q: q.filter(Token.value==bindparam('value'))
+        return query(db.session()).params(value=value).first()
+
+    @classmethod
+    def is_public(cls, value):
+        """
+        Whether `value` is the value of a public token. The answer, yes or no,
+        is cached in redis for TOKEN_CACHE_SECONDS, so beacons only look
+        tokens up in the database now and then.
+        """
+
+        key = f"token:public:{value}"
+        cached = redis.get(key)
+        if cached is not None:
+            return cached == b'1'
+        token = cls.find_by_value(value)
+        public = token is not None and not token.private
+        redis.set(key, int(public), ex=current_app.config['TOKEN_CACHE_SECONDS'])
+        return public
+
     @property
     def private(self):
         return self.role.name in ['admin']
@@ -533,7 +723,7 @@ class User(TimestampMixin, db.Model):
     email = db.Column(db.String(length=128), nullable=False, unique=True)
     password_hash = db.Column(db.String(length=128), nullable=False)
 
-    tokens = db.relationship('Token', lazy='joined', backref='user', cascade='delete')
+    tokens = db.relationship('Token', lazy='selectin', backref='user', cascade='delete')
     account = db.relationship('Account', lazy='joined', backref=db.backref('users', lazy='dynamic'))
     experiments = db.relationship('Experiment', lazy='dynamic', backref="user", cascade='all')
 
@@ -618,16 +808,59 @@ class Experiment(EventTrackerMixin, TimestampMixin, db.Model):
     __table_args__ = (db.UniqueConstraint('user_id', 'name'), )
 
     @classmethod
-    def create(cls, name, user):
+    def create(cls, name, user, cohorts=None):
+        """
+        `cohorts` optionally sets up the cohorts of the experiment, as a dict
+        of their names and weights, before any subjects are exposed. Cohorts
+        first seen in an exposure get a weight of 1.
+        """
+
+        cohorts = cohorts or {}
+        if not isinstance(cohorts, dict) or not all(
+                isinstance(weight, (int, float)) and not isinstance(weight, bool) and weight > 0
+                for weight in cohorts.values()):
+            raise ApiException(422, "Cohorts must map each cohort's name to a positive weight")
         experiment = cls(user=user, name=name)
+        # Not assigned as a list to experiment.cohorts, which would hash the
+        # cohorts, and dataclasses aren't hashable
+        rows = [Cohort(experiment=experiment, name=cohort, weight=weight) for cohort, weight in cohorts.items()]
         try:
             db.session.add(experiment)
+            db.session.add_all(rows)
             db.session.flush()
         except IntegrityError:
             raise ApiException(403, "Experiment with that name already exists")
         experiment.activate()
         return experiment
 
+    @classmethod
+    def assignment_config(cls, user):
+        """
+        What's needed to assign subjects to the cohorts of the active
+        experiments of `user` without asking the api, served by
+        GET /experiments/config. Each experiment's id salts the hash of its
+        subjects, and its cohorts are listed in a fixed order with their
+        weights, see cli/cli/sdk.py.
+        """
+
+        rows = db.session.query(cls.name, cls.id, Cohort.name, Cohort.weight)\
+                         .outerjoin(Cohort, Cohort.experiment_id==cls.id)\
+                         .filter(cls.user_id==user.id, cls.active==True)\
+                         .order_by(cls.name, Cohort.name)
+        experiments = {}
+        for name, id, cohort, weight in rows:
+            experiment = experiments.setdefault(name, {'id': str(id), 'cohorts': []})
+            if cohort is not None:
+                experiment['cohorts'].append([cohort, weight])
+        return {'experiments': experiments}
+
+    @classmethod
+    def find_by_name(cls, user, name):
+        query = bakery(lambda session: session.query(Experiment))
+        query += lambda q: q.filter(Experiment.user_id==bindparam('user_id'))\
+                            .filter(Experiment.name==bindparam('name'))
+        return query(db.session()).params(user_id=user.id, name=name).first()
+
     @property
     def subjects_counter(self):
         if not request or g.token.scope.name == 'production':
@@ -639,6 +872,14 @@ class Experiment(EventTrackerMixin, TimestampMixin, db.Model):
     def full(self):
         return self.subjects_counter >= self.user.account.plan.max_subjects_per_experiment
 
+    def weighted_cohorts(self):
+        "The cohorts subjects are assigned to, as (name, weight) ordered by name."
+
+        return db.session.query(Cohort.name, Cohort.weight)\
+                         .filter(Cohort.experiment_id==self.id)\
+                         .order_by(Cohort.name)\
+                         .all()
+
     def activate(self):
         if self.active:
             return
@@ -656,6 +897,12 @@ class Experiment(EventTrackerMixin, TimestampMixin, db.Model):
         self.active = False
         db.session.add(self)
         db.session.flush()
+        # Stops POST /assign from answering from its cache, see Exposure.assign
+        redis.delete(self.assignable_key(self.user_id, self.name))
+
+    @staticmethod
+    def assignable_key(user_id, name):
+        return f"assign:active:{user_id}:{name}"
 
 
 @dataclass(init=False)
@@ -677,8 +924,8 @@ class ExperimentResult(TimestampMixin, db.Model):
     ran_at = db.Column(db.DateTime(timezone=True), index=True)
 
     experiment = db.relationship('Experiment', lazy='joined', backref=db.backref('results', lazy='dynamic'))
-    user = db.relationship('User', lazy="joined", backref=db.backref('experiment_results', lazy="dynamic"))
-    scope = db.relationship('Scope', lazy='joined')
+    user = db.relationship('User', lazy="select", backref=db.backref('experiment_results', lazy="dynamic"))
+    scope = db.relationship('Scope', lazy='select')
 
     @classmethod
     def create(cls, experiment, scope):
@@ -698,8 +945,10 @@ class ExperimentResult(TimestampMixin, db.Model):
         return self.ran_at is not None
 
     def run(self):
+        started = time.perf_counter()
         erc = ExperimentResultCalculator(experiment=self.experiment, scope=self.scope)
         erc.run()
+        REPORT_DURATION.labels(size_bucket(len(erc.data))).observe(time.perf_counter() - started)
         self.fields = asdict(erc)
         self.version = erc.version
         self.ran_at = dt.datetime.now()
@@ -712,7 +961,7 @@ class ExperimentResult(TimestampMixin, db.Model):
 class Subject(EventTrackerMixin, TimestampMixin, db.Model):
     subject_id: str
 
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     account_id = db.Column(UUID(as_uuid=True), db.ForeignKey('account.id'), nullable=False, index=True)
     scope_id = db.Column(UUID(as_uuid=True), db.ForeignKey('scope.id'), nullable=False, index=True)
     name = db.Column(db.String(length=64), nullable=False, index=True)
@@ -720,7 +969,14 @@ class Subject(EventTrackerMixin, TimestampMixin, db.Model):
     __table_args__ = (db.UniqueConstraint('account_id', 'name', 'scope_id'), )
 
     account = db.relationship('Account', backref=db.backref('subjects', lazy='dynamic'))
-    scope = db.relationship('Scope', lazy='joined')
+    scope = db.relationship('Scope', lazy='select')
+
+    @classmethod
+    def find_by_name(cls, account_id, name):
+        query = bakery(lambda session: session.query(Subject))
+        query += lambda q: q.filter(Subject.name==bindparam('name'))\
+                            .filter(Subject.account_id==bindparam('account_id'))
+        return query(db.session()).params(account_id=account_id, name=name).first()
 
     @property
     def subject_id(self):
@@ -730,18 +986,88 @@ class Subject(EventTrackerMixin, TimestampMixin, db.Model):
 @dataclass
 class Cohort(EventTrackerMixin, TimestampMixin, db.Model):
     name: str
+    weight: float
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     experiment_id = db.Column(UUID(as_uuid=True), db.ForeignKey('experiment.id'), nullable=False, index=True)
     name = db.Column(db.String(length=64), nullable=False, index=True)
+    # Share of the subjects assigned to the cohort, relative to the others
+    weight = db.Column(db.Float(), nullable=False, default=1.0, server_default='1')
 
     experiment = db.relationship('Experiment', backref='cohorts')
 
     __table_args__ = (db.UniqueConstraint('experiment_id', 'name'), )
 
 
+# Points rows of a table at their latest event, unless they already point at
+# a later one, which happens when older events are imported.
+LATEST_EVENT_UPDATE = """
+    update {table} set {column} = latest.event_id
+    from unnest(cast(:ids as uuid[]), cast(:event_ids as uuid[]), cast(:seen_ats as timestamptz[]))
+        as latest(id, event_id, last_seen_at)
+    where {table}.id = latest.id and not exists (
+        select 1 from {events}
+        where {events}.id = {table}.{column} and {events}.last_seen_at > latest.last_seen_at
+    )
+"""
+
+
+def point_to_latest(table, column, events, rows, index):
+    """
+    Update `column` of `table` with one statement, from `rows` of
+    (event id, ..., last_seen_at) where the id of the row to update is at
+    `index`.
+    """
+
+    latest = {}
+    for row in rows:
+        if row[index] not in latest or row[-1] > latest[row[index]][1]:
+            latest[row[index]] = (row[0], row[-1])
+    db.session.execute(text(LATEST_EVENT_UPDATE.format(table=table, column=column, events=events)), {
+        'ids': [str(id) for id in latest],
+        'event_ids': [str(event_id) for event_id, _ in latest.values()],
+        'seen_ats': [seen_at for _, seen_at in latest.values()],
+    })
+
+
+def load_experiments(records, rejected=None):
+    """
+    The experiments named by batch `records`, by name, which must all be
+    active. When `rejected` is given, records of missing or inactive
+    experiments are added to it by their index instead of failing the
+    batch, and only the active experiments are returned.
+    """
+
+    names = {record['experiment'] for record in records}
+    experiments = dict((experiment.name, experiment) for experiment in
+                       Experiment.query.filter(Experiment.user_id==g.user.id)
+                                       .filter(Experiment.name.in_(names)))
+    if rejected is not None:
+        for index, record in enumerate(records):
+            experiment = experiments.get(record['experiment'])
+            if experiment is None:
+                rejected[index] = "Experiment does not exist"
+            elif not experiment.active:
+                rejected[index] = "Experiment is not active"
+        return dict((name, experiment) for name, experiment in experiments.items() if experiment.active)
+    missing = sorted(names - experiments.keys())
+    if missing:
+        raise ApiException(404, f"Experiments do not exist: {missing}")
+    inactive = sorted(name for name, experiment in experiments.items() if not experiment.active)
+    if inactive:
+        raise ApiException(422, f"Experiments are not active: {inactive}")
+    return experiments
+
+
+def batch_result(created, updated, rejected=None):
+    result = {'created': created, 'updated': updated}
+    if rejected is not None:
+        result['rejected'] = [{'index': index, 'message': message} for index, message in sorted(rejected.items())]
+    return result
+
+
 @dataclass
-class Exposure(TimestampMixin, db.Model):
+class Exposure(AsyncBatchWriterMixin, TimestampMixin, db.Model):
     id: str
     cohort: Cohort
     subject: Subject
@@ -749,30 +1075,72 @@ class Exposure(TimestampMixin, db.Model):
     scope: Scope
     last_seen_at: str
 
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, primary_key=True, index=True)
     cohort_id = db.Column(UUID(as_uuid=True), db.ForeignKey('cohort.id'), nullable=False, index=True)
     subject_id = db.Column(UUID(as_uuid=True), db.ForeignKey('subject.id'), nullable=False, index=True)
     experiment_id = db.Column(UUID(as_uuid=True), db.ForeignKey('experiment.id'), nullable=False, index=True)
     scope_id = db.Column(UUID(as_uuid=True), db.ForeignKey('scope.id'), nullable=False, index=True)
     last_seen_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
 
-    __table_args__ = (db.UniqueConstraint('subject_id', 'experiment_id', 'scope_id'), )
-
-    cohort = db.relationship('Cohort', backref=db.backref('exposures', lazy='dynamic'), foreign_keys=[cohort_id], lazy="joined")
-    subject = db.relationship('Subject', backref=db.backref('exposures', lazy='dynamic'), foreign_keys=[subject_id], lazy="joined")
-    experiment = db.relationship('Experiment', backref=db.backref('exposures', lazy='dynamic'), lazy="joined", foreign_keys=[experiment_id])
-    scope = db.relationship('Scope', lazy='joined')
-    conversion = db.relationship('Conversion', backref=db.backref('exposure', uselist=False, lazy="joined"), uselist=False, lazy="joined")
+    # Partitioned by month on `created_at`. Postgres requires the partition
+    # key in every unique constraint, so the table's primary key is
+    # (id, created_at) while the ORM keeps identifying exposures by `id`.
+    __table_args__ = (
+        db.UniqueConstraint('subject_id', 'experiment_id', 'scope_id', 'created_at', name='exposure_subject_id_experiment_id_scope_id_key'),
+        {'postgresql_partition_by': 'RANGE (created_at)'}
+    )
+    __mapper_args__ = {'primary_key': [id]}
+
+    # Exposure.create has already loaded everything an exposure points to by
+    # the time it reads the exposure back, so these are identity map hits.
+    cohort = db.relationship('Cohort', backref=db.backref('exposures', lazy='dynamic'), foreign_keys=[cohort_id], lazy="select")
+    subject = db.relationship('Subject', backref=db.backref('exposures', lazy='dynamic'), foreign_keys=[subject_id], lazy="select")
+    experiment = db.relationship('Experiment', backref=db.backref('exposures', lazy='dynamic'), lazy="select", foreign_keys=[experiment_id])
+    scope = db.relationship('Scope', lazy='select')
+    conversion = db.relationship('Conversion', primaryjoin='Exposure.id==foreign(Conversion.exposure_id)', backref=db.backref('exposure', uselist=False, lazy="select"), uselist=False, lazy="select")
 
     def __hash__(self):
         return hash(str(self.id))
 
+    @classmethod
+    def find_created_at(cls, subject_id, experiment_id, scope_id):
+        query = bakery(lambda session: session.query(Exposure.created_at))
+        query += lambda q: q.filter(Exposure.subject_id==bindparam('subject_id'))\
+                            .filter(Exposure.experiment_id==bindparam('experiment_id'))\
+                            .filter(Exposure.scope_id==bindparam('scope_id'))
+        return query(db.session()).params(
+            subject_id=subject_id, experiment_id=experiment_id, scope_id=scope_id
+        ).scalar()
+
+    @classmethod
+    def find_cohort_name(cls, subject_name, experiment_id, account_id, scope_id):
+        query = bakery(lambda session: session.query(Cohort.name))
+        query += lambda q: q.join(Exposure, Exposure.cohort_id==Cohort.id)\
+                            .join(Subject, Subject.id==Exposure.subject_id)\
+                            .filter(Subject.account_id==bindparam('account_id'))\
+                            .filter(Subject.name==bindparam('subject_name'))\
+                            .filter(Subject.scope_id==bindparam('scope_id'))\
+                            .filter(Exposure.experiment_id==bindparam('experiment_id'))\
+                            .filter(Exposure.scope_id==bindparam('scope_id'))
+        return query(db.session()).params(
+            subject_name=subject_name, experiment_id=experiment_id, account_id=account_id, scope_id=scope_id
+        ).scalar()
+
+    @classmethod
+    def lock_id(cls, subject_id, experiment_id):
+        query = bakery(lambda session: session.query(Exposure.id))
+        query += lambda q: q.filter(Exposure.subject_id==bindparam('subject_id'))\
+                            .filter(Exposure.experiment_id==bindparam('experiment_id'))\
+                            .with_for_update()
+        return query(db.session()).params(subject_id=subject_id, experiment_id=experiment_id).scalar()
+
     @classmethod
     def create(cls, subject_name, cohort_name, experiment_name):
         # Note that using this method requires a request context since we depend on
         # the user being pulled from `g`. If we move this to a worker node
         # we'll have to pass in a user_id to refetch the user.
-        experiment = g.user.experiments.filter(Experiment.name==experiment_name).first()
+        experiment = Experiment.find_by_name(g.user, experiment_name)
         if not experiment:
             raise ApiException(404, "Experiment does not exist")
 
@@ -790,6 +1158,9 @@ class Exposure(TimestampMixin, db.Model):
             constraint='subject_account_id_name_scope_id_key',
             set_={'updated_at': func.now()}
         ).returning(Subject.id)
+        # The upsert holds a lock on the subject's row until the transaction
+        # ends, so concurrent requests for the same subject are serialized
+        # and the exposure lookup below can't race with another insert.
         subject_id = db.session.execute(subject_insert).fetchone()[0]
 
         cohort_insert = insert(Cohort.__table__).values(
@@ -801,11 +1172,17 @@ class Exposure(TimestampMixin, db.Model):
         ).returning(Cohort.id)
         cohort_id = db.session.execute(cohort_insert).fetchone()[0]
 
+        # The unique constraint includes the partition key, so an existing
+        # exposure only conflicts if we insert it with its original
+        # `created_at`.
+        created_at = Exposure.find_created_at(subject_id, experiment.id, g.token.scope.id)
+
         exposure_insert = insert(Exposure.__table__).values(
             experiment_id=experiment.id,
             subject_id=subject_id,
             cohort_id=cohort_id,
-            scope_id=g.token.scope.id
+            scope_id=g.token.scope.id,
+            created_at=created_at or func.now()
         ).on_conflict_do_update(
             constraint="exposure_subject_id_experiment_id_scope_id_key",
             set_={'last_seen_at': func.now()}
@@ -839,48 +1216,219 @@ class Exposure(TimestampMixin, db.Model):
         db.session.flush()
         return exposure
 
+    @classmethod
+    def assign(cls, subject_name, experiment_name):
+        """
+        The cohort of a subject, picked from the experiment's weighted
+        cohorts, see app/assignment.py. Subjects already exposed keep their
+        cohort. The exposure is written behind by the worker, and the cohort
+        is cached in redis, so assigning the same subject again doesn't touch
+        the database. Until the cache expires, those repeats don't update the
+        exposure's `last_seen_at` either. The cache is only used while the
+        experiment is known to be active, which deactivating it forgets.
+        """
+
+        key = f"assign:{g.user.id}:{g.token.scope_id}:{experiment_name}:{subject_name}"
+        assignable_key = Experiment.assignable_key(g.user.id, experiment_name)
+        assignable, cohort = redis.mget(assignable_key, key)
+        if assignable is not None and cohort is not None:
+            return cohort.decode()
+
+        experiment = Experiment.find_by_name(g.user, experiment_name)
+        if not experiment:
+            raise ApiException(404, "Experiment does not exist")
+        if not experiment.active:
+            raise ApiException(422, "Experiment is not active")
+        cohort = Exposure.find_cohort_name(subject_name, experiment.id, g.user.account_id, g.token.scope_id)
+        if cohort is None:
+            if experiment.full:
+                raise ApiException(422, "Experiment has reached max exposures limit")
+            cohorts = experiment.weighted_cohorts()
+            if not cohorts:
+                raise ApiException(422, "Experiment has no cohorts to assign subjects to")
+            cohort = pick(experiment.id, subject_name, cohorts)
+
+        expires = current_app.config['ASSIGNMENT_CACHE_SECONDS']
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(assignable_key, 1, ex=expires)
+        pipe.set(key, cohort, ex=expires)
+        pipe.execute()
+        cls.write_behind({
+            'experiment': experiment_name,
+            'subject': subject_name,
+            'cohort': cohort,
+            'created_at': dt.datetime.now(dt.timezone.utc),
+        })
+        return cohort
+
+    @classmethod
+    def create_batch(cls, records, skip_invalid=False):
+        """
+        Log many exposures with a fixed number of statements, for imports.
+        Each record is a dict of `experiment`, `subject`, `cohort` and
+        `created_at`, when the exposure happened. Records of the same subject
+        and experiment are merged; like repeated exposures, they keep the
+        first cohort. Returns how many exposures were created and updated.
+
+        With `skip_invalid`, records of missing or inactive experiments, and
+        new subjects over an experiment's exposures limit, are left out
+        instead of failing the batch, and returned as `rejected`.
+        """
+
+        scope = g.token.scope
+        rejected = {} if skip_invalid else None
+        experiments = load_experiments(records, rejected)
+        indexed = [(index, record) for index, record in enumerate(records) if not rejected or index not in rejected]
+        if not indexed:
+            return batch_result(0, 0, rejected)
+        merged = {}
+        indexes = {}
+        for index, record in indexed:
+            key = (record['subject'], experiments[record['experiment']].id)
+            indexes.setdefault(key, []).append(index)
+            if key in merged:
+                merged[key]['first_at'] = min(merged[key]['first_at'], record['created_at'])
+                merged[key]['last_at'] = max(merged[key]['last_at'], record['created_at'])
+            else:
+                merged[key] = {'cohort': record['cohort'], 'first_at': record['created_at'],
+                               'last_at': record['created_at']}
+
+        # Sorted, so that concurrent batches lock subjects in the same order
+        # and can't deadlock. The locks serialize batches the way they
+        # serialize single exposures, see Exposure.create.
+        subject_insert = insert(Subject.__table__).values([
+            {'account_id': g.user.account_id, 'name': name, 'scope_id': scope.id}
+            for name in sorted({subject_name for subject_name, _ in merged})
+        ]).on_conflict_do_update(
+            constraint='subject_account_id_name_scope_id_key',
+            set_={'updated_at': func.now()}
+        ).returning(Subject.id, Subject.name)
+        subject_ids = dict((name, id) for id, name in db.session.execute(subject_insert))
+
+        cohort_insert = insert(Cohort.__table__).values([
+            {'name': name, 'experiment_id': experiment_id}
+            for experiment_id, name in sorted({(key[1], row['cohort']) for key, row in merged.items()})
+        ]).on_conflict_do_update(
+            constraint='cohort_experiment_id_name_key',
+            set_={'updated_at': func.now()}
+        ).returning(Cohort.id, Cohort.experiment_id, Cohort.name)
+        cohort_ids = dict(((experiment_id, name), id) for id, experiment_id, name in db.session.execute(cohort_insert))
+
+        keys = [(subject_ids[subject_name], experiment_id) for subject_name, experiment_id in merged]
+        existing = dict(((subject_id, experiment_id), created_at) for subject_id, experiment_id, created_at in
+                        db.session.query(Exposure.subject_id, Exposure.experiment_id, Exposure.created_at)
+                                  .filter(Exposure.scope_id==scope.id)
+                                  .filter(tuple_(Exposure.subject_id, Exposure.experiment_id).in_(keys)))
+
+        limit = g.user.account.plan.max_subjects_per_experiment
+        room = dict((experiment.id, limit - getattr(experiment, f'subjects_counter_{scope.name}'))
+                    for experiment in experiments.values())
+        created = {}
+        for merged_key, key in zip(list(merged), keys):
+            if key in existing:
+                continue
+            experiment_id = key[1]
+            if created.get(experiment_id, 0) >= room[experiment_id]:
+                if rejected is None:
+                    name = next(e.name for e in experiments.values() if e.id == experiment_id)
+                    raise ApiException(422, f"Experiment {name} would exceed the max exposures limit")
+                for index in indexes[merged_key]:
+                    rejected[index] = "Experiment has reached max exposures limit"
+                del merged[merged_key]
+                continue
+            created[experiment_id] = created.get(experiment_id, 0) + 1
+        if not merged:
+            return batch_result(0, 0, rejected)
+
+        rows = []
+        for (subject_name, experiment_id), row in merged.items():
+            subject_id = subject_ids[subject_name]
+            created_at = existing.get((subject_id, experiment_id)) or row['first_at']
+            rows.append({
+                'id': uuid7(int(created_at.timestamp() * 1000)),
+                'experiment_id': experiment_id,
+                'subject_id': subject_id,
+                'cohort_id': cohort_ids[(experiment_id, row['cohort'])],
+                'scope_id': scope.id,
+                'created_at': created_at,
+                'last_seen_at': row['last_at'],
+            })
+        exposure_insert = insert(Exposure.__table__).values(rows)
+        exposure_insert = exposure_insert.on_conflict_do_update(
+            constraint="exposure_subject_id_experiment_id_scope_id_key",
+            set_={'last_seen_at': func.greatest(Exposure.last_seen_at, exposure_insert.excluded.last_seen_at)}
+        ).returning(Exposure.id, Exposure.experiment_id, Exposure.cohort_id, Exposure.subject_id, Exposure.last_seen_at)
+        exposures = db.session.execute(exposure_insert).fetchall()
+
+        for table, index in (('experiment', 1), ('cohort', 2), ('subject', 3)):
+            point_to_latest(table, f'last_exposure_id_{scope.name}', 'exposure', exposures, index)
+        if created:
+            db.session.execute(text(f"""
+                update experiment set subjects_counter_{scope.name} = subjects_counter_{scope.name} + created.count
+                from unnest(cast(:ids as uuid[]), cast(:counts as integer[])) as created(id, count)
+                where experiment.id = created.id
+            """), {'ids': [str(id) for id in created], 'counts': list(created.values())})
+        for experiment in experiments.values():
+            db.session.expire(experiment)
+        return batch_result(sum(created.values()), len(rows) - sum(created.values()), rejected)
+
 
 @dataclass
-class Conversion(TimestampMixin, db.Model):
+class Conversion(AsyncBatchWriterMixin, TimestampMixin, db.Model):
     id: str
     last_seen_at: str
     scope: Scope
     value: float
 
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    exposure_id = db.Column(UUID(as_uuid=True), db.ForeignKey('exposure.id'), nullable=False, index=True)
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, primary_key=True, index=True)
+    exposure_id = db.Column(UUID(as_uuid=True), nullable=False, index=True)
     scope_id = db.Column(UUID(as_uuid=True), db.ForeignKey('scope.id'), nullable=False, index=True)
     value = db.Column(db.Float())
     last_seen_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
 
-    __table_args__ = (db.UniqueConstraint('exposure_id', 'scope_id'), )
+    # Partitioned the same way as Exposure.
+    __table_args__ = (
+        db.UniqueConstraint('exposure_id', 'scope_id', 'created_at', name='conversion_exposure_id_scope_id_key'),
+        {'postgresql_partition_by': 'RANGE (created_at)'}
+    )
+    __mapper_args__ = {'primary_key': [id]}
+
+    scope = db.relationship('Scope', lazy='select')
 
-    scope = db.relationship('Scope', lazy='joined')
+    @classmethod
+    def find_created_at(cls, exposure_id, scope_id):
+        query = bakery(lambda session: session.query(Conversion.created_at))
+        query += lambda q: q.filter(Conversion.exposure_id==bindparam('exposure_id'))\
+                            .filter(Conversion.scope_id==bindparam('scope_id'))
+        return query(db.session()).params(exposure_id=exposure_id, scope_id=scope_id).scalar()
 
     @classmethod
     def create(cls, subject_name, experiment_name, value=None):
         # Note that using this function requires a request context since we depend on
         # the user being pulled from `g`. If we move this to a worker node
         # we'll have to pass in a user_id to refetch the user.
-        experiment = g.user.experiments.filter(Experiment.name==experiment_name).first()
+        experiment = Experiment.find_by_name(g.user, experiment_name)
         if not experiment:
             raise ApiException(404, "Experiment does not exist")
 
-        subject = Subject.query.filter(Subject.name==subject_name)\
-                               .filter(Subject.account==experiment.user.account)\
-                               .first()
+        subject = Subject.find_by_name(experiment.user.account_id, subject_name)
         if not subject:
             raise ApiException(404, "Subject does not exist")
-        exposure = Exposure.query.filter(Exposure.subject_id==subject.id)\
-                                 .filter(Exposure.experiment_id==experiment.id)\
-                                 .first()
-        if not exposure:
+        # Locking the exposure serializes concurrent conversions for it, so
+        # the lookup of an existing conversion can't race with an insert.
+        exposure_id = Exposure.lock_id(subject.id, experiment.id)
+        if not exposure_id:
             raise ApiException(404, "Subject does not have an exposure for that experiment yet")
+        exposure = Exposure.query.get(exposure_id)
+
+        created_at = Conversion.find_created_at(exposure.id, g.token.scope.id)
 
         conversion_insert = insert(Conversion.__table__).values(
             exposure_id=exposure.id,
             value=value,
-            scope_id=g.token.scope.id
+            scope_id=g.token.scope.id,
+            created_at=created_at or func.now()
         ).on_conflict_do_update(
             constraint='conversion_exposure_id_scope_id_key',
             set_={'last_seen_at': dt.datetime.now()}
@@ -903,6 +1451,110 @@ class Conversion(TimestampMixin, db.Model):
         db.session.flush()
         return conversion
 
+    @classmethod
+    def create_batch(cls, records, skip_invalid=False):
+        """
+        Log many conversions with a fixed number of statements, for imports.
+        Each record is a dict of `experiment`, `subject`, `value` and
+        `created_at`, when the conversion happened. Records of the same
+        subject and experiment are merged and, like repeated conversions,
+        keep the first value. Returns how many conversions were created and
+        updated.
+
+        With `skip_invalid`, records of missing or inactive experiments and
+        of subjects that weren't exposed are left out instead of failing the
+        batch, and returned as `rejected`.
+        """
+
+        scope = g.token.scope
+        rejected = {} if skip_invalid else None
+        experiments = load_experiments(records, rejected)
+        indexed = [(index, record) for index, record in enumerate(records) if not rejected or index not in rejected]
+        names = {record['subject'] for _, record in indexed}
+        subject_ids = dict(db.session.query(Subject.name, Subject.id)
+                                     .filter(Subject.account_id==g.user.account_id)
+                                     .filter(Subject.scope_id==scope.id)
+                                     .filter(Subject.name.in_(names))) if names else {}
+        missing = sorted(names - subject_ids.keys())
+        if missing and rejected is None:
+            raise ApiException(404, f"Subjects do not exist: {missing}")
+
+        merged = {}
+        keys = {}
+        for index, record in indexed:
+            if record['subject'] not in subject_ids:
+                rejected[index] = "Subject does not exist"
+                continue
+            key = (subject_ids[record['subject']], experiments[record['experiment']].id)
+            keys[index] = key
+            if key in merged:
+                merged[key]['first_at'] = min(merged[key]['first_at'], record['created_at'])
+                merged[key]['last_at'] = max(merged[key]['last_at'], record['created_at'])
+            else:
+                merged[key] = {'value': record.get('value'), 'first_at': record['created_at'],
+                               'last_at': record['created_at']}
+
+        if not merged:
+            return batch_result(0, 0, rejected)
+
+        # Locking the exposures serializes concurrent conversions for them,
+        # see Conversion.create. In order, so batches can't deadlock.
+        exposures = dict(((subject_id, experiment_id), (id, cohort_id)) for id, subject_id, experiment_id, cohort_id in
+                         db.session.query(Exposure.id, Exposure.subject_id, Exposure.experiment_id, Exposure.cohort_id)
+                                   .filter(tuple_(Exposure.subject_id, Exposure.experiment_id).in_(list(merged)))
+                                   .order_by(Exposure.id)
+                                   .with_for_update())
+        if len(exposures) < len(merged):
+            if rejected is None:
+                raise ApiException(404, f"{len(merged) - len(exposures)} subjects do not have an exposure for their experiment yet")
+            for index, key in keys.items():
+                if key not in exposures:
+                    rejected[index] = "Subject does not have an exposure for the experiment yet"
+                    merged.pop(key, None)
+            if not merged:
+                return batch_result(0, 0, rejected)
+
+        exposure_ids = [exposure_id for exposure_id, _ in exposures.values()]
+        existing = dict(db.session.query(Conversion.exposure_id, Conversion.created_at)
+                                  .filter(Conversion.scope_id==scope.id)
+                                  .filter(Conversion.exposure_id.in_(exposure_ids)))
+
+        rows = []
+        for key, row in merged.items():
+            exposure_id = exposures[key][0]
+            created_at = existing.get(exposure_id) or row['first_at']
+            rows.append({
+                'id': uuid7(int(created_at.timestamp() * 1000)),
+                'exposure_id': exposure_id,
+                'value': row['value'],
+                'scope_id': scope.id,
+                'created_at': created_at,
+                'last_seen_at': row['last_at'],
+            })
+        conversion_insert = insert(Conversion.__table__).values(rows)
+        conversion_insert = conversion_insert.on_conflict_do_update(
+            constraint='conversion_exposure_id_scope_id_key',
+            set_={'last_seen_at': func.greatest(Conversion.last_seen_at, conversion_insert.excluded.last_seen_at)}
+        ).returning(Conversion.id, Conversion.exposure_id, Conversion.last_seen_at)
+        conversions = db.session.execute(conversion_insert).fetchall()
+
+        parents = dict((exposure_id, (experiment_id, cohort_id, subject_id))
+                       for (subject_id, experiment_id), (exposure_id, cohort_id) in exposures.items())
+        conversions = [(id, *parents[exposure_id], last_seen_at) for id, exposure_id, last_seen_at in conversions]
+        for table, index in (('experiment', 1), ('cohort', 2), ('subject', 3)):
+            point_to_latest(table, f'last_conversion_id_{scope.name}', 'conversion', conversions, index)
+        for experiment in experiments.values():
+            db.session.expire(experiment)
+        return batch_result(len(rows) - len(existing), len(existing), rejected)
+
+
+# Migrations create the monthly partitions (see `flask partitions create`),
+# but tables built with `db.create_all()` need somewhere to put rows.
+for partitioned_table in (Exposure.__table__, Conversion.__table__):
+    event.listen(partitioned_table, 'after_create', DDL(
+        "create table %(table)s_default partition of %(table)s default"
+    ))
+
 
 @dataclass
 class ExposureRollup(TimestampMixin, db.Model):
@@ -929,4 +1581,4 @@ class ExposureRollup(TimestampMixin, db.Model):
 
     __table_args__ = (db.UniqueConstraint('day', 'experiment_id', 'scope_id'), )
 
-    user = db.relationship("User", primaryjoin="User.id==ExposureRollup.user_id", foreign_keys=[user_id], backref=db.backref('exposures_rollups', lazy="dynamic"))
+    user = db.relationship("User", primaryjoin="User.id==ExposureRollup.user_id", foreign_keys=[user_id], lazy="raise", backref=db.backref('exposures_rollups', lazy="dynamic"))
@@ -0,0 +1,95 @@
+"""
+Helpers for managing the monthly partitions of the event tables.
+
+Each partitioned table has one partition per calendar month, named like
+`exposure_y2020m04`, plus a default partition that catches rows outside of
+every monthly range. The default partition should stay empty; if it isn't,
+postgres will refuse to create a monthly partition overlapping its rows.
+"""
+
+import datetime as dt
+
+from app.models import db
+
+
+PARTITIONED_TABLES = ['exposure', 'conversion']
+
+
+def month_start(date):
+    return dt.date(date.year, date.month, 1)
+
+
+def next_month(date):
+    if date.month == 12:
+        return dt.date(date.year + 1, 1, 1)
+    return dt.date(date.year, date.month + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def list_partitions(table):
+    query = """
+        select child.relname
+        from pg_inherits
+        join pg_class parent on pg_inherits.inhparent = parent.oid
+        join pg_class child on pg_inherits.inhrelid = child.oid
+        where parent.relname = :table
+        order by child.relname
+    """
+    return [r[0] for r in db.session.execute(query, {'table': table})]
+
+
+def create_partition(table, month):
+    """
+    Create the partition holding `month` for `table` if it doesn't exist.
+    Returns the name of the partition, or None if it already existed.
+    """
+
+    month = month_start(month)
+    name = partition_name(table, month)
+    if name in list_partitions(table):
+        return None
+    db.session.execute(
+        f"create table {name} partition of {table} "
+        f"for values from ('{month}') to ('{next_month(month)}')"
+    )
+    return name
+
+
+def create_partitions(table, start, months):
+    month = month_start(start)
+    created = []
+    for _ in range(months):
+        name = create_partition(table, month)
+        if name:
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+def detach_partitions(table, before, drop=False):
+    """
+    Detach every monthly partition of `table` that ends on or before the
+    date `before`. Detached partitions are left in place as ordinary tables
+    so they can be archived, unless `drop` is set.
+    """
+
+    before = month_start(before)
+    detached = []
+    for name in list_partitions(table):
+        if name == f"{table}_default":
+            continue
+        year, month = name.rsplit('_y', 1)[1].split('m')
+        if next_month(dt.date(int(year), int(month), 1)) > before:
+            continue
+        db.session.execute(f"alter table {table} detach partition {name}")
+        if drop:
+            db.session.execute(f"drop table {name}")
+        detached.append(name)
+    return detached
+
+
+def default_partition_rows(table):
+    return db.session.execute(f"select count(*) from {table}_default").scalar()
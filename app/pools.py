@@ -0,0 +1,121 @@
+"""
+Connection pools shared by every request a process handles.
+
+The pools are created once per process and record how often connections are
+checked out and how long callers wait for one, which is what we need to size
+them.
+"""
+
+import os
+import time
+import threading
+from dataclasses import dataclass, field, fields
+
+from redis import BlockingConnectionPool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from app.instrumentation import InstrumentedRedis
+from app.metrics import record_pool_wait
+
+
+@dataclass
+class PoolStats:
+    checkouts: int = 0
+    timeouts: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def as_dict(self):
+        # Not asdict(), which deep-copies the lock and fails
+        with self._lock:
+            return {f.name: getattr(self, f.name) for f in fields(self) if f.name != '_lock'}
+
+
+class InstrumentedRedisPool(BlockingConnectionPool):
+    """
+    Blocks for up to `timeout` seconds when all `max_connections` are in use,
+    rather than opening more connections than redis was sized for.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        except Exception:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.stats.record(waited, timed_out=timed_out)
+            record_pool_wait('redis', waited, timed_out)
+
+    def describe(self):
+        return {
+            **self.stats.as_dict(),
+            'max_connections': self.max_connections,
+            'connections': len(self._connections),
+            'idle': sum(1 for c in list(self.pool.queue) if c is not None),
+        }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    SQLAlchemy's default pool, timing how long request threads wait for a
+    database connection. Set as the engine's `poolclass` in `app.models`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.stats.record(waited, timed_out=timed_out)
+            record_pool_wait('database', waited, timed_out)
+
+    def describe(self):
+        return {
+            **self.stats.as_dict(),
+            'pool_size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'idle': self.checkedin(),
+        }
+
+
+def create_redis_client(config):
+    pool = InstrumentedRedisPool.from_url(
+        config['REDIS_URL'],
+        max_connections=config['REDIS_MAX_CONNECTIONS'],
+        timeout=config['REDIS_POOL_TIMEOUT'],
+        health_check_interval=config['REDIS_HEALTH_CHECK_INTERVAL'],
+    )
+    # redis-py also resets a pool the first time it's used from a new pid,
+    # but resetting eagerly means a child forked by `gunicorn --preload`
+    # never touches sockets inherited from the master.
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=pool.reset)
+    return InstrumentedRedis(connection_pool=pool)
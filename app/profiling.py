@@ -0,0 +1,158 @@
+"""
+Profiling for live workers.
+
+Two tools, both off unless configured:
+
+- When PROFILE_REQUESTS is set, sending `X-Profile: true` with a request
+  authenticated as an admin runs it under cProfile. The stats are written to
+  PROFILE_DIR and the file name is returned in the `X-Profile-File` header.
+  With `X-Profile-Format: text` the response body is replaced by the top
+  functions instead.
+- A stack sampler that snapshots every thread's stack each
+  PROFILE_SAMPLE_INTERVAL seconds and periodically writes the counts as
+  collapsed stacks (`PROFILE_DIR/stacks-<pid>.txt`), the input format of
+  flamegraph.pl and speedscope. It starts with the worker when
+  PROFILE_SAMPLER is set, and `kill -USR2 <worker pid>` toggles it.
+"""
+
+import io
+import os
+import sys
+import time
+import signal
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+from flask import g, request, current_app, make_response
+
+
+def profile_requested():
+    # Runs after load_user, see init_profiling
+    token = g.get('token')
+    return bool(current_app.config['PROFILE_REQUESTS'] and request.headers.get('X-Profile') == 'true'
+                and token is not None and token.role.name == 'admin')
+
+
+def start_request_profile():
+    if profile_requested():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def top_functions(stats, limit=30, sort='cumulative'):
+    output = io.StringIO()
+    stats.stream = output
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    route = request.url_rule.rule if request.url_rule else request.path
+    filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{request.method}{route.replace('/', '_')}.pstats"
+    os.makedirs(current_app.config['PROFILE_DIR'], exist_ok=True)
+    profiler.dump_stats(os.path.join(current_app.config['PROFILE_DIR'], filename))
+    if request.headers.get('X-Profile-Format') == 'text':
+        response = make_response(top_functions(pstats.Stats(profiler)), 200, {'Content-Type': 'text/plain'})
+    response.headers['X-Profile-File'] = filename
+    return response
+
+
+class StackSampler(object):
+
+    def __init__(self, directory, interval=0.01, flush_every=10):
+        self.directory = directory
+        self.interval = interval
+        self.flush_every = flush_every
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"stacks-{os.getpid()}.txt")
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own:
+                self.stacks[self.collapse(frame)] += 1
+
+    def flush(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def run(self):
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_flush >= self.flush_every:
+                self.flush()
+                last_flush = time.monotonic()
+        self.flush()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+
+    def toggle(self, *args):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+
+def install_signal_handler(app):
+    """
+    Toggle the sampler on SIGUSR2. Gunicorn resets signal handlers when a
+    worker starts, after the app is loaded with --preload, so
+    gunicorn.conf.py installs it again from `post_worker_init`.
+    """
+
+    # Signal handlers can only be installed from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, app.extensions['stack_sampler'].toggle)
+
+
+def init_profiling(app):
+    """
+    Call after the hook that loads the user, so that requests are only
+    profiled for admins.
+    """
+
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+
+    sampler = StackSampler(app.config['PROFILE_DIR'], interval=app.config['PROFILE_SAMPLE_INTERVAL'])
+    app.extensions['stack_sampler'] = sampler
+    if app.config['PROFILE_SAMPLER']:
+        sampler.start()
+    install_signal_handler(app)
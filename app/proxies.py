@@ -1,30 +1,49 @@
+import time
 from typing import Dict
 from dataclasses import dataclass
 
 import requests
 from werkzeug.local import LocalProxy
-from flask_redis import FlaskRedis
 from flask import current_app, g, request
 from rq import Queue
 from rq.job import Job
 
+from app.pools import create_redis_client
+from app.metrics import JOB_DURATION
+
 
 @dataclass(init=False)
 class JsonSerializableJobClass(Job):
     id: str
 
+    def perform(self):
+        started = time.perf_counter()
+        status = 'failed'
+        try:
+            result = super().perform()
+            status = 'finished'
+            return result
+        finally:
+            JOB_DURATION.labels(self.func_name, status).observe(time.perf_counter() - started)
+
+
+def init_redis(app):
+    """
+    Create the redis client and queue shared by every request in this
+    process. They're thread safe, and all connections come from one pool.
+    """
+
+    redis = create_redis_client(app.config)
+    app.extensions['redis'] = redis
+    app.extensions['worker'] = Queue(connection=redis, job_class=JsonSerializableJobClass)
+
 
 def get_redis():
-    if 'redis' not in g:
-        g.redis = FlaskRedis(current_app)._redis_client
-    return g.redis
+    return current_app.extensions['redis']
 
 
 def get_worker():
-    redis = get_redis()
-    if 'worker' not in g:
-        g.worker = Queue(connection=redis, job_class=JsonSerializableJobClass)
-    return g.worker
+    return current_app.extensions['worker']
 
 
 worker = LocalProxy(get_worker)
@@ -0,0 +1,107 @@
+"""
+Send heavy reads to a read replica.
+
+When `REPLICA_DATABASE_URL` is set, resource methods decorated with
+`@read_only` run their queries against the replica instead of the primary
+that takes every exposure write. Requests fall back to the primary when
+
+- the replica is more than `REPLICA_MAX_LAG_SECONDS` behind, or
+- the request has already written something, so it can read its own writes.
+
+Report loads, which only read events written by earlier requests, can use
+the replica regardless with `replica_bind(ignore_writes=True)`.
+"""
+
+import time
+import threading
+
+from flask import g, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from funcy import decorator
+from sqlalchemy import event, orm
+
+
+REPLICA_BIND = 'replica'
+
+LAG_QUERY = """
+    select case
+        when not pg_is_in_recovery() then 0
+        when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+    end
+"""
+
+_lag_lock = threading.Lock()
+_lag = {'checked_at': None, 'seconds': None}
+
+
+@decorator
+def read_only(call):
+    g.read_only = True
+    return call._func(*call._args, **call._kwargs)
+
+
+def replica_lag(engine):
+    """
+    Seconds the replica is behind the primary, checked at most once every
+    `REPLICA_LAG_CHECK_INTERVAL` seconds per process. An unreachable replica
+    counts as infinitely far behind.
+    """
+
+    interval = current_app.config['REPLICA_LAG_CHECK_INTERVAL']
+    with _lag_lock:
+        now = time.monotonic()
+        if _lag['checked_at'] is None or now - _lag['checked_at'] >= interval:
+            try:
+                with engine.connect() as conn:
+                    _lag['seconds'] = float(conn.execute(LAG_QUERY).scalar())
+            except Exception as exc:
+                current_app.logger.warning(f"Could not check replica lag: {exc}")
+                _lag['seconds'] = float('inf')
+            _lag['checked_at'] = now
+        return _lag['seconds']
+
+
+def replica_bind(ignore_writes=False):
+    """
+    The replica engine if it's configured and caught up, otherwise None.
+    Passing None as the bind to `db.session.execute` uses the primary.
+    """
+
+    app = current_app._get_current_object()
+    if REPLICA_BIND not in (app.config['SQLALCHEMY_BINDS'] or {}):
+        return None
+    if not ignore_writes and g.get('pinned_to_primary'):
+        return None
+    engine = get_state(app).db.get_engine(app, bind=REPLICA_BIND)
+    if replica_lag(engine) > app.config['REPLICA_MAX_LAG_SECONDS']:
+        return None
+    return engine
+
+
+class RoutingSession(SignallingSession):
+    """
+    Routes reads for `@read_only` requests to the replica. Models with their
+    own `__bind_key__` and everything written by a flush use the usual binds.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('read_only'):
+            engine = replica_bind()
+            if engine is not None:
+                info = getattr(getattr(mapper, 'persist_selectable', None), 'info', {})
+                if info.get('bind_key') is None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def pin_to_primary(session, flush_context, instances):
+    if has_request_context():
+        g.pinned_to_primary = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,5 +1,11 @@
+import base64
+import binascii
 import datetime as dt
+import hashlib
+import hmac
 import os
+import re
+import uuid
 
 from flask import request, g, current_app, make_response, json, session
 from flask_restful import Api, Resource
@@ -8,12 +14,16 @@ from funcy import decorator
 from app.models import (
     db, Account, User, Token, Experiment, Subject, Conversion, Exposure, Role,
     Cohort, Scope, Event, Plan, Contact, PaymentMethod, Session, ExposureRollup,
-    ExperimentResult, PlanSchedule
+    ExperimentResult, PlanSchedule, create_events_async
 )
 from app.services import ExperimentResultCalculator
-from app.sql import recent_events, experiment_results
+from app.sql import recent_events, experiment_results, experiment_export
 from app.exceptions import ApiException
-from app.proxies import worker, redis
+from app.proxies import worker, redis, get_redis
+from app.workloads import workload
+from app.replicas import read_only
+from app.metrics import render as render_metrics
+from app.exports import FORMATS as EXPORT_FORMATS, export_response
 
 
 api = Api()
@@ -54,6 +64,77 @@ def params(call, *required, **optional):
     return call._func(*call._args, **json)
 
 
+def batch_records(records, required, optional, limit):
+    """
+    Validate the records of a batch request, a json array of objects, the
+    way `params` validates a single one. Their `created_at`, when given, is
+    parsed; records without one happened now.
+    """
+
+    if not records or len(records) > limit:
+        raise ApiException(422, f"Send between 1 and {limit} records at once")
+    now = dt.datetime.now(dt.timezone.utc)
+    parsed = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ApiException(422, f"Record {index} is not an object")
+        missing_params = [param for param in required if param not in record]
+        if missing_params:
+            raise ApiException(422, f"Record {index} is missing required parameters: {missing_params}")
+        unexpected_params = [param for param in record if param not in required and param not in optional]
+        if unexpected_params:
+            raise ApiException(422, f"Record {index} has invalid parameters: {unexpected_params}")
+        record = {**record, 'created_at': record.get('created_at') or now}
+        if isinstance(record['created_at'], str):
+            created_at = record['created_at']
+            # fromisoformat doesn't take the Z suffix before python 3.11
+            if created_at.endswith(('Z', 'z')):
+                created_at = created_at[:-1] + '+00:00'
+            try:
+                record['created_at'] = dt.datetime.fromisoformat(created_at)
+            except ValueError:
+                record['created_at'] = None
+        if not isinstance(record['created_at'], dt.datetime):
+            raise ApiException(422, f"Record {index} has an invalid created_at")
+        if record['created_at'].tzinfo is None:
+            record['created_at'] = record['created_at'].replace(tzinfo=dt.timezone.utc)
+        parsed.append(record)
+    return parsed
+
+
+def paginate(query, column):
+    """
+    Keyset pagination of `query` on the unique `column`, for list routes
+    that can grow without bound. Only requests with a `?limit=` are paged,
+    so clients that expect the whole list still get it. The cursor for the
+    next page, when there is one, is sent in the X-Next-Cursor header and
+    passed back as `?after=`.
+    """
+
+    if 'limit' not in request.args:
+        return query.all()
+    max_page_size = current_app.config['MAX_PAGE_SIZE']
+    try:
+        limit = int(request.args['limit'])
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= max_page_size:
+        raise ApiException(422, f"The limit must be between 1 and {max_page_size}")
+    query = query.order_by(column)
+    if request.args.get('after'):
+        try:
+            after = base64.b64decode(request.args['after'], altchars=b'-_', validate=True).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            raise ApiException(422, "Invalid cursor")
+        query = query.filter(column > after)
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows
+    rows = rows[:limit]
+    cursor = base64.urlsafe_b64encode(str(getattr(rows[-1], column.key)).encode()).decode()
+    return rows, 200, {'X-Next-Cursor': cursor}
+
+
 class IndexResource(Resource):
     def get(self):
         return {
@@ -109,52 +190,201 @@ class ExperimentsResource(Resource):
 
     @protected()
     def get(self):
-        return g.user.experiments.all()
+        options = Experiment.last_event_options(g.token.scope.name)
+        return paginate(g.user.experiments.options(*options), Experiment.name)
+
+    @protected()
+    @params('name', cohorts=None)
+    def post(self, name, cohorts):
+        return Experiment.create(name=name, user=g.user, cohorts=cohorts)
+
+
+class ExperimentsConfigResource(Resource):
+
+    @read_only
+    @protected(['admin', 'public'])
+    def get(self):
+        config = Experiment.assignment_config(g.user)
+        etag = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        # Clients poll for changes, which are rare, so most polls are
+        # answered without a body
+        if request.if_none_match.contains(etag):
+            resp = make_response('', 304)
+            resp.set_etag(etag)
+            return resp
+        return config, 200, {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+
 
+class ExperimentExportResource(Resource):
+
+    @workload('analytics')
+    @read_only
     @protected()
-    @params('name')
-    def post(self, name):
-        return Experiment.create(name=name, user=g.user)
+    def get(self, name):
+        experiment = Experiment.find_by_name(g.user, name)
+        if not experiment:
+            raise ApiException(404, "Experiment does not exist")
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            raise ApiException(422, f"Invalid format: {fmt}. Use one of {list(EXPORT_FORMATS)}")
+        batches = experiment_export.stream(
+            fetch_size=current_app.config['EXPORT_FETCH_SIZE'],
+            experiment_id=experiment.id,
+            scope_id=g.token.scope.id
+        )
+        filename = re.sub(r'[^\w.-]+', '-', f"{experiment.name}-{g.token.scope.name}")
+        return export_response(batches, fmt, filename)
 
 
 class ExposuresResource(Resource):
 
-    # We might consider moving this business logic into a Exposure.create method
+    @workload('ingestion')
     @protected(['admin', 'public'])
+    def post(self):
+        if isinstance(request.json, list):
+            return self.post_batch(request.json)
+        return self.post_exposure()
+
+    # We might consider moving this business logic into a Exposure.create method
     @params('experiment', 'subject', 'cohort')
-    def post(self, experiment, subject, cohort):
+    def post_exposure(self, experiment, subject, cohort):
         subject = str(subject)
         cohort = str(cohort)
         experiment = str(experiment)
         return Exposure.create(subject_name=subject, cohort_name=cohort, experiment_name=experiment)
 
+    def post_batch(self, records):
+        return Exposure.create_batch(self.parse_batch(records), skip_invalid=request.args.get('skip_invalid') == 'true')
+
+    @staticmethod
+    def parse_batch(records):
+        records = batch_records(records, ['experiment', 'subject', 'cohort'], ['created_at'],
+                                current_app.config['MAX_INGESTION_BATCH'])
+        for record in records:
+            record.update(experiment=str(record['experiment']), subject=str(record['subject']),
+                          cohort=str(record['cohort']))
+        return records
+
+
+class AssignResource(Resource):
+
+    @workload('ingestion')
+    @protected(['admin', 'public'])
+    @params('experiment', 'subject')
+    def post(self, experiment, subject):
+        return {'cohort': Exposure.assign(subject_name=str(subject), experiment_name=str(experiment))}
+
 
 class ConversionsResource(Resource):
 
+    @workload('ingestion')
     @protected(['admin', 'public'])
+    def post(self):
+        if isinstance(request.json, list):
+            return self.post_batch(request.json)
+        return self.post_conversion()
+
     @params('experiment', 'subject', value=None)
-    def post(self, experiment, subject, value):
+    def post_conversion(self, experiment, subject, value):
         subject = str(subject)
         experiment = str(experiment)
         value = float(value) if value is not None else value
         return Conversion.create(subject_name=subject, experiment_name=experiment, value=value)
 
+    def post_batch(self, records):
+        return Conversion.create_batch(self.parse_batch(records), skip_invalid=request.args.get('skip_invalid') == 'true')
+
+    @staticmethod
+    def parse_batch(records):
+        records = batch_records(records, ['experiment', 'subject'], ['value', 'created_at'],
+                                current_app.config['MAX_INGESTION_BATCH'])
+        for record in records:
+            try:
+                value = float(record['value']) if record.get('value') is not None else None
+            except (TypeError, ValueError):
+                raise ApiException(422, f"Invalid value: {record['value']}")
+            record.update(experiment=str(record['experiment']), subject=str(record['subject']), value=value)
+        return records
+
+
+class BeaconResource(Resource):
+    """
+    Exposures and conversions sent by browsers with `navigator.sendBeacon`,
+    or as an image pixel. Neither can set headers, so the public token is
+    part of the payload:
+
+        {"token": "...", "exposures": [...], "conversions": [...]}
+
+    posted as text/plain, or urlencoded in the `d` parameter of a GET. Both
+    are simple cross-origin requests, so unlike /exposures and /conversions
+    they don't cost the browser a preflight.
+
+    Beacons are usually answered without reading from the database: the
+    token is checked against redis, see Token.is_public, and the payload for
+    shape. A single job writes the events, see create_events_async.
+    """
+
+    anonymous = True
+    # Reads its body itself, whatever the content type
+    raw_body = True
+
+    @workload('ingestion')
+    def get(self):
+        return self.record(request.args.get('d', ''))
+
+    @workload('ingestion')
+    def post(self):
+        # Checked before the body is read, too
+        self.check_size(request.content_length or 0)
+        return self.record(request.get_data(as_text=True))
+
+    def check_size(self, size):
+        limit = current_app.config['MAX_BEACON_BYTES']
+        if size > limit:
+            raise ApiException(413, f"Beacons are limited to {limit} bytes")
+
+    def record(self, payload):
+        self.check_size(len(payload))
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            raise ApiException(400, "Invalid beacon payload")
+        if not isinstance(payload, dict):
+            raise ApiException(400, "Invalid beacon payload")
+        unexpected_params = [param for param in payload if param not in ['token', 'exposures', 'conversions']]
+        if unexpected_params:
+            raise ApiException(422, f"Received invalid parameters: {unexpected_params}")
+        try:
+            token_value = str(uuid.UUID(str(payload.get('token'))))
+        except ValueError:
+            raise ApiException(403, "Invalid token: not uuid")
+        # Beacons come from browsers, where only public tokens belong
+        if not Token.is_public(token_value):
+            raise ApiException(403, "Invalid token")
+
+        exposures = ExposuresResource.parse_batch(payload['exposures']) if payload.get('exposures') else []
+        conversions = ConversionsResource.parse_batch(payload['conversions']) if payload.get('conversions') else []
+        if exposures or conversions:
+            create_events_async(token_value, exposures, conversions)
+        return make_response('', 204)
+
 
 class ResultsResource(Resource):
 
+    @read_only
     @protected()
     def get(self):
         # The query generated by the ORM here has like 100 rows per experiment
         # result, and that ends up being ~15MB for just 6 reports and slow to
         # download. So the custom SQL should save whole seconds when hitting
         # this route.
-        query = experiment_results.format(user_id=g.user.id)
-        return db.session.execute(query).fetchall()
+        return experiment_results.execute(user_id=g.user.id).fetchall()
 
+    @workload('analytics')
     @protected()
     @params('experiment')
     def post(self, experiment):
-        experiment = g.user.experiments.filter(Experiment.name==experiment).first()
+        experiment = Experiment.find_by_name(g.user, experiment)
         if not experiment:
             raise ApiException(404, "Experiment does not exist")
         result = ExperimentResult.create(experiment=experiment, scope=g.token.scope).run()
@@ -173,7 +403,7 @@ class ActivateResource(Resource):
     @protected()
     @params('experiment')
     def post(self, experiment):
-        experiment = g.user.experiments.filter(Experiment.name==experiment).first()
+        experiment = Experiment.find_by_name(g.user, experiment)
         if not experiment:
             raise ApiException(404, "Experiment does not exist")
         experiment.activate()
@@ -185,7 +415,7 @@ class DeactivateResource(Resource):
     @protected()
     @params('experiment')
     def post(self, experiment):
-        experiment = g.user.experiments.filter(Experiment.name==experiment).first()
+        experiment = Experiment.find_by_name(g.user, experiment)
         if not experiment:
             raise ApiException(404, "Experiment does not exist")
         experiment.deactivate()
@@ -202,14 +432,16 @@ class TokensResource(Resource):
 class RecentResource(Resource):
 
     # TODO: we should have a service object for pulling recent events
+    @read_only
     @protected()
     def get(self):
-        re = recent_events.format(user_id=g.user.id, scope_name=g.token.scope.name)
-        return [dict(r) for r in db.session.execute(re).fetchall()]
+        events = recent_events.execute(user_id=g.user.id, scope_name=g.token.scope.name)
+        return [dict(r) for r in events.fetchall()]
 
 
 class SummaryExposuresResource(Resource):
 
+    @read_only
     @protected()
     def get(self):
         end_date = request.args.get('end_date') or str(dt.datetime.now().date())
@@ -232,13 +464,33 @@ class SummaryExposuresResource(Resource):
 
 class EventsResource(Resource):
 
+    @workload('ingestion')
+    def post(self):
+        if isinstance(request.json, list):
+            return self.post_batch(request.json)
+        return self.post_event()
+
     @params("name", user_id=None, data=None)
-    def post(self, name, user_id, data):
+    def post_event(self, name, user_id, data):
         event = Event(name=name, user_id=user_id, data=data)
         db.session.add(event)
         db.session.flush()
         return event
 
+    def post_batch(self, events):
+        events = batch_records(events, ['name'], ['user_id', 'data', 'created_at'],
+                               current_app.config['MAX_EVENTS_BATCH'])
+        # Caught here, or postgres would reject them with a 500
+        for index, event in enumerate(events):
+            if not isinstance(event['name'], str):
+                raise ApiException(422, f"Record {index} has an invalid name")
+            if event.get('user_id') is not None:
+                try:
+                    event['user_id'] = str(uuid.UUID(str(event['user_id'])))
+                except ValueError:
+                    raise ApiException(422, f"Record {index} has an invalid user_id")
+        return {'created': Event.create_batch(events)}
+
 
 class PlansResource(Resource):
 
@@ -313,11 +565,29 @@ class StripeWebhooksResource(Resource):
             current_app.logger.info(f"No handling for stripe webhook type: {request.json['type']} ({request.json['id']})")
 
 
+class MetricsResource(Resource):
+
+    # Scraped by prometheus with METRICS_TOKEN, not a user's token
+    anonymous = True
+
+    def get(self):
+        token = current_app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(authorization, f"Bearer {token}"):
+            raise ApiException(403, "Permission denied.")
+        body, content_type = render_metrics(db.engine.pool, get_redis())
+        return make_response(body, 200, {'Content-Type': content_type})
+
+
 api.add_resource(IndexResource, '/')
 api.add_resource(UserResource, '/user')
 api.add_resource(ExperimentsResource, '/experiments')
+api.add_resource(ExperimentsConfigResource, '/experiments/config')
+api.add_resource(ExperimentExportResource, '/experiments/<name>/export')
 api.add_resource(ExposuresResource, '/exposures')
 api.add_resource(ConversionsResource, '/conversions')
+api.add_resource(AssignResource, '/assign')
+api.add_resource(BeaconResource, '/beacon')
 api.add_resource(ResultsResource, '/results')
 api.add_resource(ResultsDetailsResource, '/results/<result_id>')
 api.add_resource(LoginResource, '/login')
@@ -333,3 +603,4 @@ api.add_resource(AccountPlanResource, '/account/plan')
 api.add_resource(StripeWebhooksResource, '/webhooks/stripe')
 api.add_resource(SessionsResource, '/sessions')
 api.add_resource(SummaryExposuresResource, '/summaries/exposures')
+api.add_resource(MetricsResource, '/metrics')
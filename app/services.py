@@ -7,8 +7,8 @@ from statsmodels.formula.api import ols
 from flask import g
 import numpy as np
 
-from app.models import db
 from app.sql import experiment_loader_query
+from app.replicas import replica_bind
 
 
 @dataclass(init=False)
@@ -36,8 +36,14 @@ class ExperimentResultCalculator(object):
 
     def load_data(self):
         if self.data is None:
-            query = experiment_loader_query.format(experiment_id=self.experiment.id, scope_id=self.scope.id)
-            self.data = pd.DataFrame(db.session.execute(query))
+            # Loads events written by earlier requests, so the replica is fine
+            # even after this request has written the result row.
+            rows = experiment_loader_query.execute(
+                bind=replica_bind(ignore_writes=True),
+                experiment_id=self.experiment.id,
+                scope_id=self.scope.id
+            )
+            self.data = pd.DataFrame(rows)
             self.data.columns = ['name', 'subject', 'cohort', 'converted', 'conversion_value']
         return self.data
 
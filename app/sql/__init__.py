@@ -4,19 +4,173 @@ Custom sql for when the ORM doesn't generate sensible queries.
 The .sql files in this directory are set as attributes on this package.
 
 So if you create a file named 'experiment_results.sql' in this directory
-then you can import the sql directly by using
+then you can run the sql by using
 
     from app.sql import experiment_results
+    experiment_results.execute(user_id=user.id)
+
+Values are passed as bound parameters, never interpolated into the sql. Each
+file declares its parameters and their postgres types in a header
+
+    -- params: user_id uuid, scope_name text
+
+and refers to them as `:user_id` in the body. Use `cast(:value as type)`
+rather than `:value::type`, which SQLAlchemy doesn't parse.
+
+When `SQL_PREPARED_STATEMENTS` is enabled, each query is prepared once per
+database connection and later calls only send `EXECUTE`, so postgres
+doesn't parse and plan the query again on every call. Disable it when
+connecting through a pooler that doesn't keep server sessions, like
+pgbouncer in transaction mode.
 """
 
 import os
+import re
 import sys
+import time
+import threading
+
+from flask import current_app
+from flask_sqlalchemy import get_state
+from sqlalchemy import text, bindparam, types
+from sqlalchemy.dialects.postgresql import UUID
+
+from app.metrics import record_cache
 
 
 sql_directory = os.path.dirname(__file__)
 
-for fn in os.listdir(sql_directory):
+PARAMS_HEADER = re.compile(r'^--\s*params:(.*)$', re.MULTILINE)
+BIND_PARAM = re.compile(r'(?<![:\w\\]):(\w+)(?![:\w])')
+TYPES = {
+    'uuid': UUID(as_uuid=True),
+    'text': types.String(),
+    'date': types.Date(),
+    'timestamptz': types.DateTime(timezone=True),
+    'integer': types.Integer(),
+}
+
+
+class Query(object):
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.params = self.parse_params(sql)
+        names = [name for name, _ in self.params]
+        unknown = set(BIND_PARAM.findall(sql)) - set(names)
+        if unknown:
+            raise ValueError(f"{name}.sql uses undeclared parameters: {sorted(unknown)}")
+
+        binds = [bindparam(name, type_=TYPES[type_]) for name, type_ in self.params]
+        self.statement = text(sql).bindparams(*binds)
+        self.prepared_name = f"sql_{name}"
+        positional = BIND_PARAM.sub(lambda m: f"${names.index(m.group(1)) + 1}", sql)
+        arguments = lambda values: f"({', '.join(values)})" if values else ""
+        self.prepare_statement = text(
+            f"prepare {self.prepared_name}{arguments([type_ for _, type_ in self.params])} as {positional}"
+        )
+        self.execute_statement = text(
+            f"execute {self.prepared_name}{arguments([':' + name for name in names])}"
+        ).bindparams(*binds)
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def parse_params(sql):
+        match = PARAMS_HEADER.search(sql)
+        if not match:
+            return []
+        params = []
+        for param in match.group(1).split(','):
+            name, type_ = param.split()
+            if type_ not in TYPES:
+                raise ValueError(f"Unsupported parameter type: {type_}")
+            params.append((name, type_))
+        return params
+
+    def execute(self, bind=None, **params):
+        """
+        Run the query in the current session. `bind` overrides the session's
+        choice of engine, eg to read from the replica.
+        """
+
+        missing = [name for name, _ in self.params if name not in params]
+        if missing:
+            raise ValueError(f"Missing parameters for {self.name}: {missing}")
+        started = time.perf_counter()
+        try:
+            # app.models imports this package, so look the session up at runtime
+            session = get_state(current_app).db.session
+            conn = session.connection(bind=bind, clause=self.statement)
+            if not current_app.config['SQL_PREPARED_STATEMENTS']:
+                return conn.execute(self.statement, **params)
+            # The pool clears the record's info when a connection is
+            # replaced, and with it the statements prepared on it.
+            prepared = conn.connection.info.setdefault('prepared_statements', set())
+            record_cache('prepared_statements', self.prepared_name in prepared)
+            if self.prepared_name not in prepared:
+                conn.execute(self.prepare_statement)
+                prepared.add(self.prepared_name)
+            return conn.execute(self.execute_statement, **params)
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - started
+
+    def stream(self, fetch_size, bind=None, **params):
+        """
+        Run the query with a server side cursor, and return an iterator of
+        lists of up to `fetch_size` rows, so that results of any size are
+        read with flat memory. Cursors can't be declared for prepared
+        statements, so this always sends the sql. The rows must be read
+        before the session's transaction ends.
+        """
+
+        missing = [name for name, _ in self.params if name not in params]
+        if missing:
+            raise ValueError(f"Missing parameters for {self.name}: {missing}")
+        started = time.perf_counter()
+        try:
+            session = get_state(current_app).db.session
+            conn = session.connection(bind=bind, clause=self.statement)
+            result = conn.execution_options(stream_results=True, max_row_buffer=fetch_size)\
+                         .execute(self.statement, **params)
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - started
+
+        def batches():
+            try:
+                while True:
+                    rows = result.fetchmany(fetch_size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                result.close()
+        return batches()
+
+    def stats(self):
+        return {'calls': self.calls, 'seconds': self.seconds}
+
+    def __repr__(self):
+        return f"<Query {self.name}({', '.join(name for name, _ in self.params)})>"
+
+
+queries = {}
+
+for fn in sorted(os.listdir(sql_directory)):
     if fn.endswith('.sql'):
         sql_file_path = os.path.join(sql_directory, fn)
         with open(sql_file_path, 'r') as f:
-            setattr(sys.modules[__name__], fn.replace('.sql', ''), f.read())
+            name = fn.replace('.sql', '')
+            queries[name] = Query(name, f.read())
+            setattr(sys.modules[__name__], name, queries[name])
+
+
+def stats():
+    return {name: query.stats() for name, query in queries.items()}
@@ -0,0 +1,16 @@
+-- params: experiment_id uuid, scope_id uuid
+select
+    subject.name as subject,
+    cohort.name as cohort,
+    exposure.created_at as exposed_at,
+    exposure.last_seen_at as exposure_last_seen_at,
+    conversion.created_at as converted_at,
+    conversion.last_seen_at as conversion_last_seen_at,
+    conversion.value as conversion_value
+from exposure
+join subject on exposure.subject_id = subject.id
+join cohort on exposure.cohort_id = cohort.id
+left join conversion on conversion.exposure_id = exposure.id
+    and conversion.scope_id = exposure.scope_id
+where exposure.experiment_id = :experiment_id
+    and exposure.scope_id = :scope_id
@@ -1,3 +1,4 @@
+-- params: experiment_id uuid, scope_id uuid
 select
     experiment.name,
     subject.name as subject,
@@ -10,5 +11,5 @@ join subject on exposure.subject_id = subject.id
 join cohort on exposure.cohort_id = cohort.id
 join scope on exposure.scope_id = scope.id
 left join conversion on conversion.exposure_id = exposure.id
-where experiment.id = '{experiment_id}'::uuid
-    and scope.id = '{scope_id}'
+where experiment.id = :experiment_id
+    and scope.id = :scope_id
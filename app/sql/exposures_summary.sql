@@ -1,5 +1,6 @@
+-- params: date date
 select
-    '{date}'::date as day,
+    cast(:date as date) as day,
     "user".id as user_id,
     account.id as account_id,
     experiment.id as experiment_id,
@@ -11,8 +12,12 @@ from experiment
 join "user" on experiment.user_id = "user".id
 join account on "user".account_id = account.id
 join exposure on exposure.experiment_id = experiment.id
-    and exposure.last_seen_at::date = '{date}'::date
+    and exposure.last_seen_at::date = cast(:date as date)
+    -- Rows are created before they're last seen, which lets postgres skip
+    -- the partitions of later months.
+    and exposure.created_at < cast(:date as date) + 1
 left join conversion on conversion.exposure_id = exposure.id
-    and conversion.last_seen_at::date = '{date}'::date
+    and conversion.last_seen_at::date = cast(:date as date)
+    and conversion.created_at < cast(:date as date) + 1
 group by 1,2,3,4,5,6
 order by 1 desc
@@ -1,3 +1,4 @@
+-- params: user_id uuid, scope_name text
 with recent_exposures as (
 select
     exposure.id,
@@ -12,8 +13,8 @@ join experiment on exposure.experiment_id = experiment.id
 join cohort on cohort.id = exposure.cohort_id
 join subject on exposure.subject_id = subject.id
 join scope on scope.id = exposure.scope_id
-where experiment.user_id = '{user_id}'
-    and scope.name = '{scope_name}'
+where experiment.user_id = :user_id
+    and scope.name = :scope_name
 order by exposure.last_seen_at desc
 limit 10),
 
@@ -32,8 +33,8 @@ join cohort on cohort.id = exposure.cohort_id
 join subject on exposure.subject_id = subject.id
 join conversion on conversion.exposure_id = exposure.id
 join scope on scope.id = exposure.scope_id
-    and scope.name = '{scope_name}'
-where experiment.user_id = '{user_id}'
+    and scope.name = :scope_name
+where experiment.user_id = :user_id
 order by conversion.last_seen_at desc
 limit 10),
 
@@ -0,0 +1,259 @@
+"""
+Synthetic data for load testing, created by `flask seed synthetic`.
+
+Creates accounts on the custom plan, each with one user and its tokens, a
+set of experiments, and a pool of subjects exposed to those experiments
+over the last `days` days. Traffic is skewed the way it is in production:
+exposures are spread over the accounts, and over the experiments of each
+account, following a Zipf distribution, so a few experiments get most of
+the traffic and most get very little.
+
+Events are streamed into postgres with COPY, which is the only way to load
+tens of millions of rows in minutes. Everything the app derives from events
+is filled in afterwards, so the data looks as if it came through the api:
+subject counters and the last exposure and conversion pointers of
+experiments, cohorts and subjects, and the daily exposure rollups up to
+yesterday.
+"""
+
+import datetime as dt
+import io
+import random
+import time
+import uuid
+
+from werkzeug.security import generate_password_hash
+
+from app.ids import uuid7
+from app.models import db, Account, Plan, Scope, User
+from app import partitions as partition_helpers
+
+
+COPY_BATCH = 100000
+COHORTS = ['control', 'experimental']
+
+ROLLUP_QUERY = """
+    insert into exposure_rollup
+        (id, day, user_id, account_id, experiment_id, experiment_name, scope_id, exposures, conversions)
+    select
+        md5(random()::text || clock_timestamp()::text)::uuid,
+        exposure.last_seen_at::date,
+        "user".id,
+        account.id,
+        experiment.id,
+        experiment.name,
+        exposure.scope_id,
+        count(exposure.id),
+        count(conversion.id)
+    from experiment
+    join "user" on experiment.user_id = "user".id
+    join account on "user".account_id = account.id
+    join exposure on exposure.experiment_id = experiment.id
+    left join conversion on conversion.exposure_id = exposure.id
+        and conversion.last_seen_at::date = exposure.last_seen_at::date
+    where "user".id = any(cast(:user_ids as uuid[]))
+        and exposure.last_seen_at::date < current_date
+    group by 2, 3, 4, 5, 6, 7
+"""
+
+
+def zipf_split(total, n, exponent):
+    """
+    Split `total` into `n` parts where the k-th part is proportional to
+    1 / k ** exponent.
+    """
+
+    weights = [1 / (k ** exponent) for k in range(1, n + 1)]
+    scale = total / sum(weights)
+    return [round(weight * scale) for weight in weights]
+
+
+def timestamp(seconds):
+    return dt.datetime.fromtimestamp(seconds, dt.timezone.utc).isoformat()
+
+
+class CopyBuffer(object):
+    """
+    Rows for one table, sent with COPY every `COPY_BATCH` rows. Values must
+    not contain tabs or newlines; None is written as null.
+    """
+
+    def __init__(self, cursor, table, columns):
+        self.cursor = cursor
+        self.statement = f"copy {table} ({', '.join(columns)}) from stdin"
+        self.buffer = io.StringIO()
+        self.rows = 0
+        self.total = 0
+
+    def add(self, *values):
+        self.buffer.write("\t".join(r"\N" if value is None else str(value) for value in values))
+        self.buffer.write("\n")
+        self.rows += 1
+        if self.rows >= COPY_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.buffer.seek(0)
+            self.cursor.copy_expert(self.statement, self.buffer)
+            self.total += self.rows
+        self.buffer = io.StringIO()
+        self.rows = 0
+
+
+class Latest(object):
+    "The most recent exposure and conversion of an experiment, cohort or subject."
+
+    __slots__ = ['exposure_at', 'exposure_id', 'conversion_at', 'conversion_id', 'exposures']
+
+    def __init__(self):
+        self.exposure_at = self.conversion_at = 0.0
+        self.exposure_id = self.conversion_id = None
+        self.exposures = 0
+
+    def exposed(self, at, exposure_id):
+        self.exposures += 1
+        if at > self.exposure_at:
+            self.exposure_at, self.exposure_id = at, exposure_id
+
+    def converted(self, at, conversion_id):
+        if at > self.conversion_at:
+            self.conversion_at, self.conversion_id = at, conversion_id
+
+
+def update_latest(cursor, table, scope, latest, counters=False):
+    """
+    Point each row of `table` at its latest events, by loading them into a
+    temporary table and updating from it in one statement.
+    """
+
+    cursor.execute("create temporary table synthetic_latest "
+                   "(id uuid, exposure_id uuid, conversion_id uuid, exposures integer)")
+    rows = CopyBuffer(cursor, "synthetic_latest", ['id', 'exposure_id', 'conversion_id', 'exposures'])
+    for id, events in latest.items():
+        if events.exposures:
+            rows.add(id, events.exposure_id, events.conversion_id, events.exposures)
+    rows.flush()
+    counter = f", subjects_counter_{scope} = synthetic_latest.exposures" if counters else ""
+    cursor.execute(f"""
+        update {table} set
+            last_exposure_id_{scope} = synthetic_latest.exposure_id,
+            last_conversion_id_{scope} = synthetic_latest.conversion_id
+            {counter}
+        from synthetic_latest
+        where {table}.id = synthetic_latest.id
+    """)
+    cursor.execute("drop table synthetic_latest")
+
+
+def create_user(plan, password_hash):
+    account = Account.create(plan=plan, stripe_customer_id=f"cus_synthetic_{uuid.uuid4().hex}")
+    # Like User.create, without hashing a password for every user
+    user = User(email=f"synthetic-{uuid.uuid4()}@quicksplit.io", account=account, password_hash=password_hash)
+    user.set_tokens()
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def generate(accounts=10, experiments=100, subjects=100000, exposures=1000000, conversion_rate=0.1, lift=0.1,
+             days=90, exponent=1.1, scope="production", password="synthetic", seed=None):
+    """
+    Load the synthetic data in the current transaction, and return the
+    number of rows created in each table. Each account's subjects are
+    exposed to at most one experiment in `subjects`, so experiments can't
+    have more exposures than that.
+    """
+
+    rng = random.Random(seed)
+    plan = Plan.query.filter(Plan.name=="custom").first()
+    scope = Scope.query.filter(Scope.name==scope).first()
+    password_hash = generate_password_hash(password)
+    now = time.time()
+    start = now - days * 24 * 3600
+    span = now - start
+
+    first, today = dt.date.fromtimestamp(start), dt.date.today()
+    months = (today.year - first.year) * 12 + today.month - first.month + 1
+    for table in partition_helpers.PARTITIONED_TABLES:
+        # Postgres won't create a partition overlapping rows in the default
+        # one, in which case the events land in the default partition too
+        if not partition_helpers.default_partition_rows(table):
+            partition_helpers.create_partitions(table, first, months)
+
+    cursor = db.session.connection().connection.cursor()
+    experiment_rows = CopyBuffer(cursor, "experiment", [
+        'id', 'user_id', 'name', 'subjects_counter_production', 'subjects_counter_staging', 'active',
+        'last_activated_at', 'created_at', 'updated_at'])
+    cohort_rows = CopyBuffer(cursor, "cohort", ['id', 'experiment_id', 'name', 'created_at', 'updated_at'])
+    subject_rows = CopyBuffer(cursor, "subject", ['id', 'account_id', 'scope_id', 'name', 'created_at', 'updated_at'])
+    exposure_rows = CopyBuffer(cursor, "exposure", [
+        'id', 'created_at', 'updated_at', 'last_seen_at', 'cohort_id', 'subject_id', 'experiment_id', 'scope_id'])
+    conversion_rows = CopyBuffer(cursor, "conversion", [
+        'id', 'created_at', 'updated_at', 'last_seen_at', 'exposure_id', 'scope_id', 'value'])
+
+    user_ids = []
+    created_at = timestamp(start)
+    for account_exposures in zipf_split(exposures, accounts, exponent):
+        user = create_user(plan, password_hash)
+        user_ids.append(str(user.id))
+
+        # Parents go first, since the event tables reference them
+        subject_ids = [uuid7(int(start * 1000)).hex for _ in range(subjects)]
+        for index, subject_id in enumerate(subject_ids):
+            subject_rows.add(subject_id, user.account_id, scope.id, f"subject-{index}", created_at, created_at)
+        subject_rows.flush()
+
+        experiment_latest, cohort_latest = {}, {}
+        experiment_cohorts = []
+        for index in range(experiments):
+            experiment_id = uuid.uuid4().hex
+            experiment_rows.add(experiment_id, user.id, f"synthetic-{index}", 0, 0,
+                                index < plan.max_active_experiments, created_at, created_at, created_at)
+            experiment_latest[experiment_id] = Latest()
+            cohort_ids = [uuid.uuid4().hex for _ in COHORTS]
+            for cohort_id, name in zip(cohort_ids, COHORTS):
+                cohort_rows.add(cohort_id, experiment_id, name, created_at, created_at)
+                cohort_latest[cohort_id] = Latest()
+            experiment_cohorts.append((experiment_id, cohort_ids))
+        experiment_rows.flush()
+        cohort_rows.flush()
+
+        subject_latest = {subject_id: Latest() for subject_id in subject_ids}
+        for (experiment_id, cohort_ids), count in zip(experiment_cohorts, zipf_split(account_exposures, experiments, exponent)):
+            offset = rng.randrange(subjects)
+            for i in range(min(count, subjects)):
+                subject_id = subject_ids[(offset + i) % subjects]
+                treated = rng.random() < 0.5
+                cohort_id = cohort_ids[treated]
+                at = start + rng.random() * span
+                exposure_id = uuid7(int(at * 1000)).hex
+                stamp = timestamp(at)
+                exposure_rows.add(exposure_id, stamp, stamp, stamp, cohort_id, subject_id, experiment_id, scope.id)
+                for latest in (experiment_latest[experiment_id], cohort_latest[cohort_id], subject_latest[subject_id]):
+                    latest.exposed(at, exposure_id)
+
+                if rng.random() < conversion_rate * (1 + lift if treated else 1):
+                    converted_at = min(at + rng.expovariate(1 / 3600), now)
+                    conversion_id = uuid7(int(converted_at * 1000)).hex
+                    stamp = timestamp(converted_at)
+                    conversion_rows.add(conversion_id, stamp, stamp, stamp, exposure_id, scope.id,
+                                        round(rng.expovariate(1 / 20), 2))
+                    for latest in (experiment_latest[experiment_id], cohort_latest[cohort_id], subject_latest[subject_id]):
+                        latest.converted(converted_at, conversion_id)
+        exposure_rows.flush()
+        conversion_rows.flush()
+
+        update_latest(cursor, "experiment", scope.name, experiment_latest, counters=True)
+        update_latest(cursor, "cohort", scope.name, cohort_latest)
+        update_latest(cursor, "subject", scope.name, subject_latest)
+
+    rollups = db.session.execute(ROLLUP_QUERY, {'user_ids': user_ids}).rowcount
+    return {
+        'accounts': accounts,
+        'experiments': experiment_rows.total,
+        'subjects': subject_rows.total,
+        'exposures': exposure_rows.total,
+        'conversions': conversion_rows.total,
+        'rollups': rollups,
+    }
@@ -0,0 +1,68 @@
+"""
+Statement timeouts per workload.
+
+Exposures and conversions have to stay fast while someone runs a large
+report, so each kind of query gets its own `statement_timeout` budget
+(`STATEMENT_TIMEOUTS`). Resource methods declare their workload with
+`@workload(...)`, and the timeout is set on the connection whenever it is
+checked out of the pool. Code running outside of a request, like the worker
+and the cli, uses the 'background' budget.
+"""
+
+from flask import g, request, current_app, has_app_context, has_request_context
+from sqlalchemy import event
+
+from app.pools import InstrumentedQueuePool
+from app.metrics import record_cache
+
+
+WORKLOADS = ['ingestion', 'dashboard', 'analytics', 'background']
+
+
+def workload(name):
+    if name not in WORKLOADS:
+        raise ValueError(f"Unknown workload: {name}")
+
+    def decorate(func):
+        func.workload = name
+        return func
+    return decorate
+
+
+def resolve_workload():
+    """
+    Runs before every request. It must be registered before any hook that
+    queries the database, since the connection is checked out by the first
+    query of the request.
+    """
+
+    view = current_app.view_functions.get(request.endpoint)
+    method = getattr(getattr(view, 'view_class', None), request.method.lower(), None)
+    g.workload = getattr(method, 'workload', current_app.config['DEFAULT_WORKLOAD'])
+
+
+def current_workload():
+    if has_request_context():
+        return g.get('workload', current_app.config['DEFAULT_WORKLOAD'])
+    return 'background'
+
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def apply_statement_timeout(dbapi_connection, connection_record, connection_proxy):
+    if not has_app_context():
+        return
+    timeout = current_app.config['STATEMENT_TIMEOUTS'][current_workload()]
+    # Most checkouts are for the same workload as the connection's last one,
+    # so only pay for the round trip when the budget changes. The record's
+    # info is cleared whenever the connection is invalidated.
+    cached = connection_record.info.get('statement_timeout') == timeout
+    record_cache('statement_timeout', cached)
+    if cached:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("set statement_timeout = %s", (timeout,))
+    cursor.close()
+    # Commit so the setting survives the rollback when the connection is
+    # returned to the pool.
+    dbapi_connection.commit()
+    connection_record.info['statement_timeout'] = timeout
@@ -0,0 +1,12 @@
+"""
+Benchmarks for the api, run against a local postgres and redis.
+
+These are not collected by pytest. Each module is runnable on its own, eg
+
+    python -m benchmarks.partitions --rows 1000000
+
+The ingestion and reporting benchmarks cover the main request paths, and
+write their results to json with --output. Compare two runs with
+
+    python -m benchmarks.results before.json after.json --threshold 0.1
+"""
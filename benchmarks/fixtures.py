@@ -0,0 +1,83 @@
+"""
+Throwaway users and experiments for the benchmarks.
+
+Everything is created in the database configured for FLASK_ENV, under users
+with random emails and accounts that aren't linked to stripe, and is left in
+place afterwards.
+"""
+
+import uuid
+
+from app.models import db, Account, Cohort, Experiment, Plan, User
+
+
+def create_user(plan="free"):
+    plan = Plan.query.filter(Plan.name==plan).first()
+    account = Account.create(plan=plan, stripe_customer_id=f"cus_benchmark_{uuid.uuid4().hex}")
+    user = User.create(email=f"benchmark-{uuid.uuid4()}@quicksplit.io", password="benchmark", account=account)
+    db.session.commit()
+    return user
+
+
+def create_experiment(user, name="benchmark"):
+    experiment = Experiment.create(name=name, user=user)
+    db.session.commit()
+    return experiment
+
+
+def load_events(experiment, scope, subjects, conversion_rate=0.2, days=7):
+    """
+    Expose `subjects` new subjects to the experiment in `scope`, split evenly
+    between a control and an experimental cohort, with exposures spread over
+    the last `days` days. Every 1 / `conversion_rate`th subject converts.
+
+    Rows are inserted with `insert ... select` rather than through the api,
+    which would take hours at the larger sizes.
+    """
+
+    control = Cohort(experiment=experiment, name="control")
+    experimental = Cohort(experiment=experiment, name="experimental")
+    db.session.add_all([control, experimental])
+    db.session.flush()
+    params = {
+        'prefix': f"{experiment.id}-{scope.name}-",
+        'account_id': str(experiment.user.account_id),
+        'experiment_id': str(experiment.id),
+        'scope_id': str(scope.id),
+        'control_id': str(control.id),
+        'experimental_id': str(experimental.id),
+        'subjects': subjects,
+        'every': max(round(1 / conversion_rate), 1) if conversion_rate else subjects + 1,
+        'minutes': days * 24 * 60,
+    }
+    db.session.execute("""
+        insert into subject (id, account_id, scope_id, name)
+        select md5(:prefix || n)::uuid, cast(:account_id as uuid), cast(:scope_id as uuid), :prefix || n
+        from generate_series(1, :subjects) n
+    """, params)
+    db.session.execute("""
+        insert into exposure (id, created_at, last_seen_at, cohort_id, subject_id, experiment_id, scope_id)
+        select
+            md5('exposure' || :prefix || n)::uuid, ts, ts,
+            case when n % 2 = 0 then cast(:control_id as uuid) else cast(:experimental_id as uuid) end,
+            md5(:prefix || n)::uuid,
+            cast(:experiment_id as uuid),
+            cast(:scope_id as uuid)
+        from (
+            select n, now() - interval '1 minute' * (n % :minutes) as ts
+            from generate_series(1, :subjects) n
+        ) series
+    """, params)
+    db.session.execute("""
+        insert into conversion (id, created_at, last_seen_at, exposure_id, scope_id, value)
+        select
+            md5('conversion' || :prefix || n)::uuid, now(), now(),
+            md5('exposure' || :prefix || n)::uuid,
+            cast(:scope_id as uuid),
+            round((random() * 100)::numeric, 2)
+        from generate_series(1, :subjects) n
+        where n % :every = 0
+    """, params)
+    setattr(experiment, f"subjects_counter_{scope.name}", subjects)
+    db.session.commit()
+    return experiment
@@ -0,0 +1,180 @@
+"""
+Throughput and latency of /exposures and /conversions.
+
+Posts exposures for new subjects, then a conversion for each of them, one
+request at a time and then from `--concurrency` threads at once. Each is run
+through the flask test client, which measures the app on its own, and
+through gunicorn started with the worker and thread counts of bin/web,
+which adds http parsing and contention between workers. Pass --no-gunicorn
+to skip the latter.
+
+Creates a throwaway user on the custom plan, so that the subjects fit in one
+experiment, see benchmarks/fixtures.py.
+
+    FLASK_ENV=development python -m benchmarks.ingestion --requests 2000 --concurrency 8
+"""
+
+import argparse
+import itertools
+import os
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import requests as http
+
+from app import create_app
+from app.models import User
+from benchmarks.fixtures import create_user, create_experiment
+from benchmarks.results import add_output_argument, report
+
+
+def summarize(times, seconds):
+    times = sorted(times)
+    return {
+        'requests_per_second': len(times) / seconds,
+        'p50_ms': times[len(times) // 2] * 1000,
+        'p95_ms': times[int(len(times) * 0.95)] * 1000,
+        'p99_ms': times[int(len(times) * 0.99)] * 1000,
+    }
+
+
+def payloads(route, experiment, subjects, offset):
+    for i in itertools.count():
+        subject = f"subject-{offset + i % subjects}"
+        if route == '/exposures':
+            yield {'experiment': experiment, 'subject': subject, 'cohort': ('control', 'experimental')[i % 2]}
+        else:
+            yield {'experiment': experiment, 'subject': subject, 'value': 1.0}
+
+
+def measure(make_post, route, payloads, requests, concurrency):
+    """
+    Send `requests` posts from `concurrency` threads. `make_post` is called
+    once per thread, so that threads don't share a client.
+    """
+
+    lock = threading.Lock()
+    remaining = [requests]
+    times = []
+
+    def work():
+        post = make_post()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+                payload = next(payloads)
+            started = time.perf_counter()
+            status = post(route, payload)
+            elapsed = time.perf_counter() - started
+            assert status == 200, f"{route} returned {status}"
+            with lock:
+                times.append(elapsed)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(times, time.perf_counter() - started)
+
+
+def client_post(app, token):
+    def make_post():
+        client = app.test_client()
+        return lambda route, payload: client.post(route, json=payload, headers={'Authorization': token}).status_code
+    return make_post
+
+
+def http_post(base_url, token):
+    def make_post():
+        session = http.Session()
+        session.headers['Authorization'] = token
+        return lambda route, payload: session.post(f"{base_url}{route}", json=payload).status_code
+    return make_post
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def gunicorn(workers, threads, timeout=30):
+    port = free_port()
+    process = subprocess.Popen([
+        'gunicorn', 'app:create_app()', '--workers', str(workers), '--threads', str(threads),
+        '--bind', f'127.0.0.1:{port}', '--log-level', 'WARNING', '--config', 'gunicorn.conf.py',
+    ])
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                http.get(f"{base_url}/")
+                break
+            except http.ConnectionError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("gunicorn didn't start")
+                time.sleep(0.1)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def measure_server(make_post, requests, concurrency, subjects, offset):
+    results = {}
+    for label, threads in [('single', 1), ('concurrent', concurrency)]:
+        for route in ['/exposures', '/conversions']:
+            # Conversions are sent for the subjects exposed just before
+            results[f"{route} {label}"] = measure(
+                make_post, route, payloads(route, 'benchmark', subjects, offset), requests, threads
+            )
+        offset += subjects
+    return results, offset
+
+
+def run(requests, concurrency, workers, threads, use_gunicorn=True):
+    app = create_app()
+    with app.app_context():
+        user = create_user(plan="custom")
+        create_experiment(user)
+        token = str(user.admin_token.value)
+        user_id = user.id
+
+    results = {'requests': requests, 'concurrency': concurrency, 'workers': workers, 'threads': threads}
+    # Every request exposes a new subject, and the conversions convert them
+    results['test_client'], offset = measure_server(client_post(app, token), requests, concurrency, requests, 0)
+    if use_gunicorn:
+        with gunicorn(workers, threads) as base_url:
+            results['gunicorn'], offset = measure_server(http_post(base_url, token), requests, concurrency, requests, offset)
+
+    with app.app_context():
+        experiment = User.query.get(user_id).experiments.first()
+        assert experiment.subjects_counter_production == offset, "Some exposures weren't recorded"
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per route and concurrency level")
+    # More threads than the database pool holds would mostly measure waiting for it
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('WEB_THREADS', 8)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 2)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 8)))
+    parser.add_argument('--no-gunicorn', dest='gunicorn', action='store_false')
+    add_output_argument(parser)
+    args = parser.parse_args()
+    results = run(args.requests, args.concurrency, args.workers, args.threads, use_gunicorn=args.gunicorn)
+    report('ingestion', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Python CPU time spent per ingestion request.
+
+Posts exposures and conversions through the test client and records the
+process CPU time of each request, which excludes time spent waiting on
+postgres. Also compares each baked lookup with the equivalent ORM query
+built from scratch on every call, which is what the ingestion and auth
+paths did before the lookups were baked. Run it on two commits to compare
+whole requests.
+
+Creates a throwaway user, see benchmarks/fixtures.py.
+
+    FLASK_ENV=development python -m benchmarks.lookups --requests 2000
+"""
+
+import argparse
+import statistics
+import time
+
+from flask import g
+
+from app import create_app
+from app.models import db, User, Experiment, Subject, Exposure, Token
+from benchmarks.fixtures import create_user, create_experiment
+from benchmarks.results import add_output_argument, report
+
+
+def cpu_times(call, n):
+    times = []
+    for i in range(n):
+        started = time.process_time()
+        call(i)
+        times.append(time.process_time() - started)
+    return times
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'mean_ms': statistics.mean(times) * 1000,
+        'p50_ms': times[len(times) // 2] * 1000,
+        'p95_ms': times[int(len(times) * 0.95)] * 1000,
+    }
+
+
+def measure_requests(app, token, requests, subjects):
+    client = app.test_client()
+    headers = {'Authorization': str(token)}
+
+    def post(route, **data):
+        def call(i):
+            resp = client.post(route, json={'experiment': 'benchmark', 'subject': f"subject-{i % subjects}", **data},
+                               headers=headers)
+            assert resp.status_code == 200, resp.data
+        return call
+
+    return {
+        '/exposures': summarize(cpu_times(post('/exposures', cohort='control'), requests)),
+        '/conversions': summarize(cpu_times(post('/conversions', value=1.0), requests)),
+    }
+
+
+def measure_lookups(app, user_id, n):
+    user = User.query.get(user_id)
+    token = user.admin_token
+    experiment = Experiment.find_by_name(user, 'benchmark')
+    subject = Subject.query.filter(Subject.account_id==user.account_id).first()
+    exposure = Exposure.query.filter(Exposure.subject_id==subject.id).first()
+    lookups = {
+        'token': (
+            lambda i: Token.find_by_value(token.value),
+            lambda i: Token.query.filter(Token.value==token.value).first()
+        ),
+        'experiment': (
+            lambda i: Experiment.find_by_name(user, experiment.name),
+            lambda i: user.experiments.filter(Experiment.name==experiment.name).first()
+        ),
+        'subject': (
+            lambda i: Subject.find_by_name(user.account_id, subject.name),
+            lambda i: Subject.query.filter(Subject.name==subject.name)
+                                   .filter(Subject.account==user.account).first()
+        ),
+        'exposure': (
+            lambda i: Exposure.find_created_at(subject.id, experiment.id, exposure.scope_id),
+            lambda i: db.session.query(Exposure.created_at)
+                                .filter(Exposure.subject_id==subject.id)
+                                .filter(Exposure.experiment_id==experiment.id)
+                                .filter(Exposure.scope_id==exposure.scope_id).scalar()
+        ),
+    }
+    results = {}
+    with app.test_request_context():
+        g.user = user
+        g.token = token
+        for name, (baked, built) in lookups.items():
+            results[name] = {
+                'baked': summarize(cpu_times(baked, n)),
+                'built': summarize(cpu_times(built, n)),
+            }
+    return results
+
+
+def run(requests, subjects):
+    app = create_app()
+    with app.app_context():
+        user = create_user()
+        create_experiment(user)
+        user_id, token = user.id, user.admin_token.value
+    results = {'requests': requests, 'subjects': subjects}
+    # Each request pushes its own app context, and so gets its own session
+    results['endpoints'] = measure_requests(app, token, requests, subjects)
+    with app.app_context():
+        results['lookups'] = measure_lookups(app, user_id, requests)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--subjects', type=int, default=50, help="Stay under the free plan's subject limit")
+    add_output_argument(parser)
+    args = parser.parse_args()
+    report('lookups', run(args.requests, args.subjects), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Overhead of recording request metrics.
+
+Times the per-request recording on its own, then the same cheap route
+through the test client with and without the metrics hook. Pass
+--multiprocess to record to files the way gunicorn workers do.
+
+    python -m benchmarks.metrics --requests 5000 --multiprocess
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.results import add_output_argument, report
+
+
+def per_call_seconds(call, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        call()
+    return (time.perf_counter() - started) / n
+
+
+def run(requests):
+    # Imported here, prometheus_client reads prometheus_multiproc_dir on import
+    from app import create_app
+    from app.metrics import REQUEST_LATENCY, record_request
+
+    app = create_app()
+    client = app.test_client()
+    record = lambda: REQUEST_LATENCY.labels('POST', '/exposures', 200).observe(0.01)
+
+    def request_seconds():
+        # Plans is public and only reads a small table
+        return per_call_seconds(lambda: client.get('/plans'), requests)
+
+    with_metrics = request_seconds()
+    app.after_request_funcs[None].remove(record_request)
+    without_metrics = request_seconds()
+    return {
+        'requests': requests,
+        'multiprocess': 'prometheus_multiproc_dir' in os.environ,
+        'record_us': per_call_seconds(record, requests * 10) * 10 ** 6,
+        'request_with_metrics_us': with_metrics * 10 ** 6,
+        'request_without_metrics_us': without_metrics * 10 ** 6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--multiprocess', action='store_true')
+    add_output_argument(parser)
+    args = parser.parse_args()
+    if args.multiprocess:
+        if 'prometheus_client' in sys.modules:
+            raise RuntimeError("prometheus_client was imported before the multiprocess directory was set")
+        os.environ['prometheus_multiproc_dir'] = tempfile.mkdtemp(prefix='quicksplit-metrics-')
+    report('metrics', run(args.requests), args.output)
+
+
+if __name__ == '__main__':
+    main()
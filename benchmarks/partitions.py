@@ -0,0 +1,207 @@
+"""
+Compare a plain exposure table with one partitioned by month.
+
+Loads the same synthetic rows into both layouts, then measures upsert
+throughput (the statement used by `Exposure.create`), with `--repeat-share`
+of the upserts for subjects that already have an exposure so that they take
+the `on conflict` path, and the time to run the
+daily exposures rollup for the most recent day. Tables live in a scratch
+`benchmarks` schema of DATABASE_URL and are dropped afterwards.
+
+    python -m benchmarks.partitions --rows 50000000 --months 12
+"""
+
+import argparse
+import datetime as dt
+import os
+import time
+import uuid
+
+import sqlalchemy
+
+from benchmarks.results import add_output_argument, report
+
+
+SCHEMA = "benchmarks"
+BATCH_SIZE = 1000000
+# Share of the measured upserts that repeat an existing exposure
+REPEAT_SHARE = 0.5
+INDEXED_COLUMNS = ['cohort_id', 'created_at', 'experiment_id', 'last_seen_at', 'scope_id', 'subject_id', 'updated_at']
+
+
+def create_table(conn, name, partitioned, start, months):
+    conn.execute(f"drop table if exists {SCHEMA}.{name}")
+    conn.execute(f"""
+        create table {SCHEMA}.{name} (
+            created_at timestamp with time zone not null default now(),
+            updated_at timestamp with time zone not null default now(),
+            id uuid not null,
+            cohort_id uuid not null,
+            subject_id uuid not null,
+            experiment_id uuid not null,
+            scope_id uuid not null,
+            last_seen_at timestamp with time zone not null default now()
+        ) {'partition by range (created_at)' if partitioned else ''}
+    """)
+    if partitioned:
+        conn.execute(f"create table {SCHEMA}.{name}_default partition of {SCHEMA}.{name} default")
+        month = start
+        for _ in range(months + 1):
+            following = dt.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+            conn.execute(
+                f"create table {SCHEMA}.{name}_y{month.year}m{month.month:02d} partition of {SCHEMA}.{name} "
+                f"for values from ('{month}') to ('{following}')"
+            )
+            month = following
+
+
+def create_indexes(conn, name, partitioned):
+    key = "created_at" if partitioned else ""
+    conn.execute(f"alter table {SCHEMA}.{name} add primary key (id{', ' + key if key else ''})")
+    conn.execute(
+        f"alter table {SCHEMA}.{name} add constraint {name}_unique_key "
+        f"unique (subject_id, experiment_id, scope_id{', ' + key if key else ''})"
+    )
+    for column in INDEXED_COLUMNS:
+        conn.execute(f"create index on {SCHEMA}.{name} ({column})")
+
+
+def load_rows(conn, name, rows, start, months, experiments):
+    """
+    Spread `rows` exposures evenly over the time span, across `experiments`
+    experiments with two cohorts and two scopes each.
+    """
+
+    seconds = (months * 30 * 24 * 3600)
+    loaded = 0
+    while loaded < rows:
+        batch = min(BATCH_SIZE, rows - loaded)
+        conn.execute(f"""
+            insert into {SCHEMA}.{name}
+                (created_at, updated_at, last_seen_at, id, cohort_id, subject_id, experiment_id, scope_id)
+            select
+                ts, ts, ts + interval '1 hour' * (n % 3),
+                md5(random()::text || n)::uuid,
+                md5('cohort' || (n % {experiments * 2}))::uuid,
+                md5(random()::text || 'subject' || n)::uuid,
+                md5('experiment' || (n % {experiments}))::uuid,
+                md5('scope' || (n % 2))::uuid
+            from (
+                select n, '{start}'::timestamptz + interval '1 second' * ((n::bigint * {seconds}) / {rows}) as ts
+                from generate_series({loaded}, {loaded + batch - 1}) n
+            ) series
+        """)
+        loaded += batch
+
+
+def measure_upserts(conn, name, partitioned, count, experiments, repeat_share):
+    conflict = "subject_id, experiment_id, scope_id" + (", created_at" if partitioned else "")
+    statement = sqlalchemy.text(f"""
+        insert into {SCHEMA}.{name} (id, cohort_id, subject_id, experiment_id, scope_id, created_at)
+        values (:id, :cohort_id, :subject_id, :experiment_id, :scope_id, coalesce(:created_at, now()))
+        on conflict ({conflict}) do update set last_seen_at = now()
+    """)
+    experiment_ids = [str(uuid.uuid5(uuid.NAMESPACE_DNS, f'experiment{n}')) for n in range(experiments)]
+    # Existing exposures, sampled from across the table. Repeating one with
+    # its own created_at conflicts in either layout.
+    repeats = int(count * repeat_share)
+    existing = conn.execute(sqlalchemy.text(f"""
+        select cohort_id, subject_id, experiment_id, scope_id, created_at
+        from {SCHEMA}.{name} tablesample system (1)
+        limit :limit
+    """), {'limit': repeats}).fetchall() if repeats else []
+    started = time.perf_counter()
+    for n in range(count):
+        # Spread evenly over the run
+        if existing and int((n + 1) * repeat_share) > int(n * repeat_share):
+            cohort_id, subject_id, experiment_id, scope_id, created_at = existing[n % len(existing)]
+        else:
+            cohort_id, subject_id, experiment_id, scope_id, created_at = (
+                uuid.uuid4(), uuid.uuid4(), experiment_ids[n % experiments], uuid.uuid4(), None)
+        conn.execute(statement, {
+            'id': str(uuid.uuid4()),
+            'cohort_id': str(cohort_id),
+            'subject_id': str(subject_id),
+            'experiment_id': str(experiment_id),
+            'scope_id': str(scope_id),
+            'created_at': created_at,
+        })
+    return count / (time.perf_counter() - started)
+
+
+def measure_rollup(conn, name, day):
+    started = time.perf_counter()
+    conn.execute(f"""
+        select experiment_id, scope_id, count(id)
+        from {SCHEMA}.{name}
+        where last_seen_at::date = '{day}'::date
+            and created_at < '{day}'::date + 1
+        group by 1, 2
+    """).fetchall()
+    return time.perf_counter() - started
+
+
+def total_size(conn, name, partitioned):
+    if not partitioned:
+        return conn.execute(f"select pg_total_relation_size('{SCHEMA}.{name}')").scalar()
+    return conn.execute(f"""
+        select sum(pg_total_relation_size(inhrelid))
+        from pg_inherits where inhparent = '{SCHEMA}.{name}'::regclass
+    """).scalar()
+
+
+def run(database_url, rows, months, upserts, experiments, repeat_share=REPEAT_SHARE, keep=False):
+    engine = sqlalchemy.create_engine(database_url)
+    today = dt.date.today()
+    month_index = today.year * 12 + today.month - 1 - months
+    start = dt.date(month_index // 12, month_index % 12 + 1, 1)
+    last_day = start + dt.timedelta(days=months * 30 - 1)
+    results = {'rows': rows, 'months': months, 'repeat_share': repeat_share, 'layouts': {}}
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(f"create schema if not exists {SCHEMA}")
+        for layout, partitioned in [('heap', False), ('partitioned', True)]:
+            name = f"exposure_{layout}"
+            create_table(conn, name, partitioned, start, months)
+
+            started = time.perf_counter()
+            load_rows(conn, name, rows, start, months, experiments)
+            load_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            create_indexes(conn, name, partitioned)
+            index_seconds = time.perf_counter() - started
+            conn.execute(f"vacuum analyze {SCHEMA}.{name}")
+
+            results['layouts'][layout] = {
+                'load_rows_per_second': rows / load_seconds,
+                'index_build_seconds': index_seconds,
+                'upserts_per_second': measure_upserts(conn, name, partitioned, upserts, experiments, repeat_share),
+                'rollup_seconds': measure_rollup(conn, name, last_day),
+                'total_size_bytes': total_size(conn, name, partitioned),
+            }
+            if not keep:
+                conn.execute(f"drop table {SCHEMA}.{name}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--rows', type=int, default=50000000)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--upserts', type=int, default=10000)
+    parser.add_argument('--experiments', type=int, default=1000)
+    parser.add_argument('--repeat-share', type=float, default=REPEAT_SHARE,
+                        help="Share of the upserts for subjects that were already exposed")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch tables")
+    add_output_argument(parser)
+    args = parser.parse_args()
+    results = run(args.database_url, args.rows, args.months, args.upserts, args.experiments,
+                  repeat_share=args.repeat_share, keep=args.keep)
+    report('partitions', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+Query plan regression harness for the hot queries.
+
+Runs `EXPLAIN (ANALYZE, BUFFERS)` for every statement of the ingestion
+paths, `Exposure.create` and `Conversion.create`, both for a new and a
+returning subject, and for the raw sql in app/sql. The ORM statements are
+recorded while running the real code in a transaction that is rolled back,
+then explained one by one, in order, with the same parameters; the explains
+are rolled back too.
+
+Each plan is reduced to a fingerprint of its shape, the nodes with their
+tables and indexes but without costs or row counts, stored with its timing
+and the number of buffers it touched. Compared to a baseline, a plan has
+degraded when it sequentially scans a table the baseline didn't, or touches
+more than --tolerance times more buffers. Other changes of shape are shown
+but don't fail the run.
+
+Plans depend on data volume, so run it against a large dataset, eg one made
+by `flask seed synthetic --exposures 5000000`, or pass --generate. Queries
+run for the user with the largest experiment.
+
+    FLASK_ENV=development python -m benchmarks.plans --output plans.json
+    FLASK_ENV=development python -m benchmarks.plans --baseline plans.json
+"""
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import re
+import sys
+from contextlib import contextmanager
+
+from flask import g
+from sqlalchemy import event
+
+from app import create_app
+from app.models import db, Conversion, Experiment, Exposure, Subject, User
+from app import sql
+from app.synthetic import generate as generate_synthetic
+from benchmarks.results import add_output_argument, report
+
+
+PARTITION = re.compile(r'_(y\d{4}m\d{2}|default)(?=_|$)')
+EXPLAINED = ('select', 'insert', 'update', 'delete', 'with')
+STATEMENT = re.compile(r'^\s*(\w+)\s+(?:.*?\b(?:from|into)\s+)?"?(\w+)', re.IGNORECASE | re.DOTALL)
+# Growth in buffers smaller than this is noise, whatever the ratio
+MIN_BUFFERS = 100
+
+
+def shape(node):
+    """
+    The plan without costs and estimates, eg
+    `Limit(Index Scan on exposure_partition using ...)`. Partitions are named
+    after their table, and identical children of an Append are collapsed, so
+    adding monthly partitions doesn't change the shape.
+    """
+
+    label = node['Node Type']
+    if 'Relation Name' in node:
+        label += f" on {PARTITION.sub('_partition', node['Relation Name'])}"
+    if 'Index Name' in node:
+        label += f" using {PARTITION.sub('_partition', node['Index Name'])}"
+    children = []
+    for child in node.get('Plans', []):
+        child = shape(child)
+        if child not in children or node['Node Type'] not in ('Append', 'Merge Append'):
+            children.append(child)
+    return f"{label}({', '.join(children)})" if children else label
+
+
+def seq_scans(node):
+    scans = set()
+    if node['Node Type'] == 'Seq Scan':
+        scans.add(PARTITION.sub('', node['Relation Name']))
+    for child in node.get('Plans', []):
+        scans |= seq_scans(child)
+    return scans
+
+
+def summarize_plan(explained):
+    plan = explained['Plan']
+    plan_shape = shape(plan)
+    return {
+        'shape': plan_shape,
+        'fingerprint': hashlib.sha1(plan_shape.encode()).hexdigest()[:12],
+        'seq_scans': sorted(seq_scans(plan)),
+        'buffers': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0),
+        'planning_ms': explained.get('Planning Time', 0.0),
+        'execution_ms': explained.get('Execution Time', 0.0),
+    }
+
+
+@contextmanager
+def recorded_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().lower().startswith(EXPLAINED):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def describe(statement):
+    "A name for a statement, like `insert subject`."
+
+    match = STATEMENT.match(statement)
+    return f"{match.group(1).lower()} {match.group(2)}" if match else statement.split()[0].lower()
+
+
+def explain(statement, parameters):
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(f"explain (analyze, buffers, format json) {statement}", parameters)
+    explained = cursor.fetchone()[0]
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+    return summarize_plan(explained[0])
+
+
+def explain_calls(calls):
+    """
+    Record the statements run by each of `calls`, a mapping of names to
+    functions, then explain them. Everything is rolled back.
+    """
+
+    recorded = {}
+    for name, call in calls.items():
+        with recorded_statements(db.engine) as statements:
+            call()
+        db.session.rollback()
+        recorded[name] = statements
+
+    plans = {}
+    for name, statements in recorded.items():
+        for index, (statement, parameters) in enumerate(statements):
+            plans[f"{name} {index + 1}: {describe(statement)}"] = explain(statement, parameters)
+        db.session.rollback()
+    return plans
+
+
+def hot_calls(user, experiment, scope):
+    exposure = Exposure.query.get(experiment.last_exposure_id_production)
+    subject = Subject.query.get(exposure.subject_id)
+    cohort_name = exposure.cohort.name
+    yesterday = str(dt.date.today() - dt.timedelta(days=1))
+    return {
+        'Exposure.create new': lambda: Exposure.create('plans-new-subject', cohort_name, experiment.name),
+        'Exposure.create returning': lambda: Exposure.create(subject.name, cohort_name, experiment.name),
+        'Conversion.create': lambda: Conversion.create(subject.name, experiment.name, 1.0),
+        'experiment_loader_query': lambda: sql.experiment_loader_query.execute(
+            experiment_id=experiment.id, scope_id=scope.id).fetchall(),
+        'experiment_results': lambda: sql.experiment_results.execute(user_id=user.id).fetchall(),
+        'exposures_summary': lambda: sql.exposures_summary.execute(date=yesterday).fetchall(),
+        'recent_events': lambda: sql.recent_events.execute(user_id=user.id, scope_name=scope.name).fetchall(),
+    }
+
+
+def compare_plans(baseline, current, tolerance):
+    """
+    Returns the degraded plans and the plans whose shape changed, as lists
+    of messages.
+    """
+
+    degraded, changed = [], []
+    for name, plan in current.items():
+        before = baseline.get(name)
+        if before is None:
+            changed.append(f"{name}: new query")
+            continue
+        new_scans = set(plan['seq_scans']) - set(before['seq_scans'])
+        if new_scans:
+            degraded.append(f"{name}: sequential scan of {', '.join(sorted(new_scans))}")
+        growth = plan['buffers'] - before['buffers']
+        if growth > MIN_BUFFERS and plan['buffers'] > before['buffers'] * (1 + tolerance):
+            degraded.append(f"{name}: buffers grew from {before['buffers']} to {plan['buffers']}")
+        if plan['fingerprint'] != before['fingerprint']:
+            changed.append(f"{name}: {before['shape']} -> {plan['shape']}")
+    for name in baseline.keys() - current.keys():
+        changed.append(f"{name}: no longer run")
+    return degraded, changed
+
+
+def run(generate=None):
+    app = create_app()
+    app.config['SQL_PREPARED_STATEMENTS'] = False
+    with app.test_request_context():
+        if generate:
+            generate_synthetic(exposures=generate)
+            db.session.commit()
+        experiment = Experiment.query.order_by(Experiment.subjects_counter_production.desc()).first()
+        g.user = User.query.get(experiment.user_id)
+        g.token = g.user.admin_token
+        g.workload = 'background'
+        subjects = experiment.subjects_counter_production
+        plans = explain_calls(hot_calls(g.user, experiment, g.token.scope))
+    return {'experiment_subjects': subjects, 'queries': plans}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=None, help="Results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Relative growth in buffers that fails")
+    parser.add_argument('--generate', type=int, default=None, help="Load this many synthetic exposures first")
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    results = run(args.generate)
+    report('plans', results, args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']['queries']
+        degraded, changed = compare_plans(baseline, results['queries'], args.tolerance)
+        for message in changed:
+            print(f"changed: {message}")
+        for message in degraded:
+            print(f"DEGRADED: {message}")
+        if degraded:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
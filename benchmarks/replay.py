@@ -0,0 +1,168 @@
+"""
+Replay captured traffic against a running server.
+
+Reads the ndjson files written by capture mode (see app/capture.py), merges
+them in arrival order and sends every request again, keeping the gaps
+between requests divided by --speed. Requests are sent by --concurrency
+threads over pooled keep-alive connections; when every thread is busy,
+requests go out late rather than being dropped, and the report says how
+late. Reports latency percentiles and the error rate of each route.
+
+Captured tokens are aliases, so they must be mapped to tokens of the target
+server, either all to one token with --token, or one by one with
+--token-map alias=token. With --create-experiments the experiments named in
+the capture are created first for each token. Use a user on the custom plan
+so that subjects don't run into plan limits, eg one from
+`flask seed synthetic`.
+
+    python -m benchmarks.replay /tmp/captures/*.ndjson --base-url http://localhost:5000 \\
+        --token <token> --speed 2 --concurrency 32 --create-experiments
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import requests as http
+from requests.adapters import HTTPAdapter
+
+from benchmarks.results import add_output_argument, report
+
+
+def read_records(paths):
+    "Every captured request in the files, ordered by arrival time."
+
+    streams = []
+    for path in paths:
+        with open(path) as f:
+            streams.append(sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r['ts']))
+    return list(heapq.merge(*streams, key=lambda r: r['ts']))
+
+
+def create_session(concurrency):
+    session = http.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_experiments(session, base_url, records, tokens):
+    for token in set(tokens(record) for record in records):
+        names = set(r['body']['experiment'] for r in records
+                    if tokens(r) == token and r['body'] and 'experiment' in r['body'])
+        for name in names:
+            # Already existing experiments are rejected with a 403
+            session.post(f"{base_url}/experiments", json={'name': name}, headers={'Authorization': token})
+
+
+def percentile(times, q):
+    return times[min(int(len(times) * q), len(times) - 1)] * 1000
+
+
+def summarize(results, seconds):
+    routes = {}
+    for route, outcomes in sorted(results.items()):
+        times = sorted(elapsed for elapsed, ok in outcomes)
+        errors = sum(1 for elapsed, ok in outcomes if not ok)
+        routes[route] = {
+            'requests': len(outcomes),
+            'error_rate': errors / len(outcomes),
+            'p50_ms': percentile(times, 0.5),
+            'p95_ms': percentile(times, 0.95),
+            'p99_ms': percentile(times, 0.99),
+        }
+    return {
+        'requests': sum(route['requests'] for route in routes.values()),
+        'requests_per_second': sum(route['requests'] for route in routes.values()) / seconds,
+        'routes': routes,
+    }
+
+
+def replay(records, base_url, tokens, speed, concurrency):
+    session = create_session(concurrency)
+    pending = queue.Queue(maxsize=concurrency * 2)
+    lock = threading.Lock()
+    results = defaultdict(list)
+    lateness = []
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            due, record = item
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            sent = time.perf_counter()
+            try:
+                resp = session.request(
+                    record['method'], f"{base_url}{record['path']}",
+                    params=record.get('query'), json=record['body'],
+                    headers={'Authorization': tokens(record)},
+                )
+                ok = resp.status_code < 400
+            except http.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - sent
+            with lock:
+                results[f"{record['method']} {record['route']}"].append((elapsed, ok))
+                lateness.append(max(sent - due, 0))
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    first = records[0]['ts'] if records else 0
+    for record in records:
+        pending.put((started + (record['ts'] - first) / speed, record))
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+
+    summary = summarize(results, time.perf_counter() - started)
+    lateness.sort()
+    summary['late_p95_ms'] = percentile(lateness, 0.95) if lateness else 0.0
+    return summary
+
+
+def token_mapper(token, token_map):
+    def tokens(record):
+        return token_map.get(record['token'], token)
+    return tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="Captured ndjson files")
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--token', default=None, help="Token to send for aliases without a mapping")
+    parser.add_argument('--token-map', nargs='*', default=[], help="alias=token pairs")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay this many times faster than captured")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--limit', type=int, default=None, help="Replay only the first requests")
+    parser.add_argument('--create-experiments', action='store_true')
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    records = read_records(args.paths)
+    if args.limit:
+        records = list(itertools.islice(records, args.limit))
+    tokens = token_mapper(args.token, dict(pair.split('=', 1) for pair in args.token_map))
+    if args.create_experiments:
+        create_experiments(create_session(1), args.base_url, records, tokens)
+
+    results = replay(records, args.base_url, tokens, args.speed, args.concurrency)
+    results.update({'speed': args.speed, 'concurrency': args.concurrency})
+    report('replay', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Latency of the reporting paths, at several experiment sizes.
+
+For each size in --sizes, loads an experiment with that many subjects and
+measures `ExperimentResult.run`, both its duration and the peak memory
+python allocates while running it. Then times the daily exposures rollup
+over all of the loaded experiments, and the /recent and /results listings of
+the user that owns them.
+
+Creates a throwaway user on the custom plan, see benchmarks/fixtures.py.
+
+    FLASK_ENV=development python -m benchmarks.reporting --sizes 1000 10000 100000
+"""
+
+import argparse
+import datetime as dt
+import statistics
+import time
+import tracemalloc
+
+from flask import g
+
+from app import create_app
+from app.models import db, ExperimentResult, ExposureRollup, User
+from app.sql import exposures_summary
+from benchmarks.fixtures import create_user, create_experiment, load_events
+from benchmarks.results import add_output_argument, report
+
+
+def timings(call, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def peak_memory(call):
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure_report(experiment, scope, repeat):
+    def call():
+        ExperimentResult.create(experiment=experiment, scope=scope).run()
+        db.session.rollback()
+
+    times = timings(call, repeat)
+    return {
+        'median_seconds': statistics.median(times),
+        'max_seconds': max(times),
+        # Measured separately, tracing allocations slows the run down
+        'peak_memory_bytes': peak_memory(call),
+    }
+
+
+def measure_rollup(day, repeat):
+    """
+    The work of `flask rollup exposures`, rolled back instead of committed
+    so it can be repeated.
+    """
+
+    def call():
+        rows = [dict(r) for r in exposures_summary.execute(date=str(day)).fetchall()]
+        db.session.bulk_insert_mappings(ExposureRollup, rows)
+        db.session.flush()
+        db.session.rollback()
+
+    times = timings(call, repeat)
+    return {'median_seconds': statistics.median(times), 'max_seconds': max(times)}
+
+
+def measure_listings(app, token, repeat):
+    client = app.test_client()
+    results = {}
+    for route in ['/recent', '/results']:
+        def call():
+            resp = client.get(route, headers={'Authorization': token})
+            assert resp.status_code == 200, resp.data
+        times = sorted(timings(call, repeat))
+        results[route] = {
+            'p50_ms': times[len(times) // 2] * 1000,
+            'p95_ms': times[int(len(times) * 0.95)] * 1000,
+        }
+    return results
+
+
+def run(sizes, repeat, listings):
+    app = create_app()
+    with app.app_context():
+        user = create_user(plan="custom")
+        token = user.admin_token
+        user_id, token_value = user.id, str(token.value)
+        for size in sizes:
+            load_events(create_experiment(user, name=f"benchmark-{size}"), token.scope, size)
+
+    results = {'sizes': sizes, 'repeat': repeat, 'reports': {}}
+    with app.test_request_context():
+        g.user = User.query.get(user_id)
+        g.token = g.user.admin_token
+        for size in sizes:
+            experiment = g.user.experiments.filter_by(name=f"benchmark-{size}").first()
+            results['reports'][str(size)] = measure_report(experiment, g.token.scope, repeat)
+            # Keep one result of each size for the /results listing
+            ExperimentResult.create(experiment=experiment, scope=g.token.scope).run()
+            db.session.commit()
+        # Exposures are spread over the last week, yesterday has a full day
+        results['rollup'] = measure_rollup(dt.date.today() - dt.timedelta(days=1), repeat)
+
+    # Each request pushes its own app context, and so gets its own session
+    results['listings'] = measure_listings(app, token_value, listings)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Subjects per experiment")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs of each report and of the rollup")
+    parser.add_argument('--listings', type=int, default=200, help="Requests to each listing")
+    add_output_argument(parser)
+    args = parser.parse_args()
+    report('reporting', run(args.sizes, args.repeat, args.listings), args.output)
+
+
+if __name__ == '__main__':
+    main()
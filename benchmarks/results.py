@@ -0,0 +1,128 @@
+"""
+Saving and comparing benchmark results.
+
+Every benchmark prints its results as json. Pass --output to also write them
+to a file, along with the commit and time they were measured at, then
+compare two files to find regressions:
+
+    python -m benchmarks.ingestion --output before.json
+    git checkout my-branch
+    python -m benchmarks.ingestion --output after.json
+    python -m benchmarks.results before.json after.json --threshold 0.1
+
+Metrics are compared by name. Names ending in `_ms`, `_us`, `_seconds` or
+`_bytes` are better when lower and names ending in `_per_second` are better
+when higher; anything else, like the parameters of the run, is only shown.
+The command exits with status 1 when any metric got worse by more than the
+threshold, so it can fail a build.
+"""
+
+import argparse
+import datetime as dt
+import json
+import platform
+import subprocess
+import sys
+
+
+LOWER_IS_BETTER = ('_ms', '_us', '_seconds', '_bytes')
+HIGHER_IS_BETTER = ('_per_second',)
+
+
+def direction(metric):
+    if metric.endswith(HIGHER_IS_BETTER):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_output_argument(parser):
+    parser.add_argument('--output', default=None, help="Also write the results to this json file")
+
+
+def report(name, results, output=None):
+    print(json.dumps(results, indent=2, default=float))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'benchmark': name,
+                'commit': git_commit(),
+                'measured_at': dt.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, default=float)
+
+
+def flatten(results, prefix=''):
+    """
+    Numbers in nested results keyed by their dotted path, eg
+    `endpoints./exposures.p95_ms`.
+    """
+
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix=f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline, current, threshold):
+    """
+    One row per metric present in both results. `change` is the relative
+    change from the baseline, positive when the metric got worse.
+    """
+
+    baseline, current = flatten(baseline), flatten(current)
+    rows = []
+    for metric in sorted(baseline.keys() & current.keys()):
+        sign = direction(metric.rsplit('.', 1)[-1])
+        before, after = baseline[metric], current[metric]
+        change = -sign * (after - before) / before if sign and before else 0.0
+        rows.append({
+            'metric': metric,
+            'baseline': before,
+            'current': after,
+            'change': change,
+            'regression': bool(sign) and change > threshold,
+        })
+    return rows
+
+
+def load(path):
+    with open(path) as f:
+        saved = json.load(f)
+    return saved.get('results', saved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change that counts as a regression")
+    args = parser.parse_args()
+
+    rows = compare(load(args.baseline), load(args.current), args.threshold)
+    width = max((len(row['metric']) for row in rows), default=0)
+    for row in rows:
+        flag = "REGRESSION" if row['regression'] else ""
+        print(f"{row['metric']:<{width}}  {row['baseline']:>14.4f}  {row['current']:>14.4f}  "
+              f"{row['change'] * 100:>+8.1f}%  {flag}")
+    regressions = [row for row in rows if row['regression']]
+    if regressions:
+        print(f"\n{len(regressions)} metrics regressed by more than {args.threshold * 100:.0f}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
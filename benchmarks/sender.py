@@ -0,0 +1,121 @@
+"""
+Caller-side cost of logging events with cli.sender.BufferedSender.
+
+Times each `send` from `--threads` threads, against a stand-in for the api
+that takes `--latency` milliseconds per request, and the same events
+posted one blocking request at a time for comparison. With --api-url and
+--token the events go to a real api instead, into an experiment that has
+to exist with cohorts 'control' and 'experimental'.
+
+    python -m benchmarks.sender --events 100000 --threads 4
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+# The cli isn't installed alongside the api, see tests/__init__.py
+sys.path.append('./cli')
+
+from cli.client import create_session  # noqa: E402
+from cli.sender import BufferedSender  # noqa: E402
+from benchmarks.results import add_output_argument, report  # noqa: E402
+
+
+class Response(object):
+    status_code = 200
+    ok = True
+
+    def json(self):
+        return {'data': {}}
+
+
+class SlowSession(object):
+    "Answers every post after `latency` seconds, like an api would."
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        time.sleep(self.latency)
+        self.requests += 1
+        return Response()
+
+
+def summarize(times, seconds):
+    times = sorted(times)
+    return {
+        'events_per_second': len(times) / seconds,
+        'p50_us': times[len(times) // 2] * 1e6,
+        'p99_us': times[int(len(times) * 0.99)] * 1e6,
+        'max_us': times[-1] * 1e6,
+    }
+
+
+def events(experiment, count, offset):
+    for n in range(offset, offset + count):
+        yield {'experiment': experiment, 'subject': f"subject-{n}", 'cohort': ('control', 'experimental')[n % 2]}
+
+
+def measure(log, experiment, count, threads):
+    "Call `log` for `count` events from `threads` threads at once."
+
+    times = [[] for _ in range(threads)]
+
+    def work(n):
+        for record in events(experiment, count // threads, n * count):
+            started = time.perf_counter()
+            log('exposures', record)
+            times[n].append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return summarize([t for thread_times in times for t in thread_times], time.perf_counter() - started)
+
+
+def run(events_count, threads, latency, api_url=None, token=None, experiment='benchmark'):
+    def session():
+        return create_session() if api_url else SlowSession(latency)
+
+    results = {'events': events_count, 'threads': threads}
+
+    sender = BufferedSender(token, api_url=api_url or 'http://localhost', session=session(),
+                            max_size=events_count)
+    results['buffered'] = measure(sender.send, experiment, events_count, threads)
+    started = time.perf_counter()
+    sender.close(timeout=None)
+    results['buffered']['drain_seconds'] = time.perf_counter() - started
+    results['buffered']['stats'] = sender.stats
+
+    # Blocking posts are slow enough that a sample of the events will do
+    blocking = session()
+    url = (api_url or 'http://localhost') + '/exposures'
+
+    def post(kind, record):
+        blocking.post(url, json=record, headers={'Authorization': token})
+    results['blocking'] = measure(post, experiment, min(events_count, 200 * threads), threads)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=20, help="Milliseconds per request of the stand-in api")
+    parser.add_argument('--api-url', default=None)
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--experiment', default='benchmark')
+    add_output_argument(parser)
+    args = parser.parse_args()
+    results = run(args.events, args.threads, args.latency / 1000, args.api_url, args.token, args.experiment)
+    report('sender', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
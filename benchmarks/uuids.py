@@ -0,0 +1,116 @@
+"""
+Compare insert throughput and index size for uuid4 and uuid7 primary keys.
+
+Copies the same number of rows into two copies of the exposure table that
+differ only in how `id` is generated, with all of the table's indexes in
+place so that every insert pays for index maintenance. Tables live in a
+scratch `benchmarks` schema of DATABASE_URL and are dropped afterwards.
+
+    python -m benchmarks.uuids --rows 10000000
+"""
+
+import argparse
+import io
+import os
+import time
+import uuid
+
+import sqlalchemy
+
+from app.ids import uuid7
+from benchmarks.results import add_output_argument, report
+
+
+SCHEMA = "benchmarks"
+BATCH_SIZE = 100000
+INDEXED_COLUMNS = ['cohort_id', 'created_at', 'experiment_id', 'last_seen_at', 'scope_id', 'subject_id', 'updated_at']
+COLUMNS = ['id', 'cohort_id', 'subject_id', 'experiment_id', 'scope_id']
+
+
+def create_table(conn, name):
+    conn.execute(f"drop table if exists {SCHEMA}.{name}")
+    conn.execute(f"""
+        create table {SCHEMA}.{name} (
+            created_at timestamp with time zone not null default now(),
+            updated_at timestamp with time zone not null default now(),
+            id uuid primary key,
+            cohort_id uuid not null,
+            subject_id uuid not null,
+            experiment_id uuid not null,
+            scope_id uuid not null,
+            last_seen_at timestamp with time zone not null default now(),
+            unique (subject_id, experiment_id, scope_id)
+        )
+    """)
+    for column in INDEXED_COLUMNS:
+        conn.execute(f"create index on {SCHEMA}.{name} ({column})")
+
+
+def batches(rows, generate_id, experiments):
+    """
+    Yield tab separated batches of rows for COPY. Subject ids use the same
+    generator as the primary key, as they would in the app.
+    """
+
+    experiment_ids = [uuid.uuid4() for _ in range(experiments)]
+    cohort_ids = [uuid.uuid4() for _ in range(experiments * 2)]
+    scope_ids = [uuid.uuid4(), uuid.uuid4()]
+    for start in range(0, rows, BATCH_SIZE):
+        buffer = io.StringIO()
+        for n in range(start, min(start + BATCH_SIZE, rows)):
+            buffer.write(f"{generate_id()}\t{cohort_ids[n % len(cohort_ids)]}\t{generate_id()}\t"
+                         f"{experiment_ids[n % experiments]}\t{scope_ids[n % 2]}\n")
+        buffer.seek(0)
+        yield buffer
+
+
+def index_sizes(conn, name):
+    rows = conn.execute(f"""
+        select indexrelid::regclass::text, pg_relation_size(indexrelid)
+        from pg_index where indrelid = '{SCHEMA}.{name}'::regclass
+    """).fetchall()
+    return {index: size for index, size in rows}
+
+
+def run(database_url, rows, experiments, keep=False):
+    engine = sqlalchemy.create_engine(database_url)
+    results = {'rows': rows, 'generators': {}}
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(f"create schema if not exists {SCHEMA}")
+        for label, generate_id in [('uuid4', uuid.uuid4), ('uuid7', uuid7)]:
+            name = f"exposure_{label}"
+            create_table(conn, name)
+            cursor = conn.connection.cursor()
+            copy_seconds = 0
+            for buffer in batches(rows, generate_id, experiments):
+                # Only time the database's side of the copy
+                started = time.perf_counter()
+                cursor.copy_expert(f"copy {SCHEMA}.{name} ({', '.join(COLUMNS)}) from stdin", buffer)
+                copy_seconds += time.perf_counter() - started
+            sizes = index_sizes(conn, name)
+            results['generators'][label] = {
+                'rows_per_second': rows / copy_seconds,
+                'primary_key_bytes': sizes[f"{SCHEMA}.{name}_pkey"],
+                'index_bytes': sum(sizes.values()),
+                'table_bytes': conn.execute(f"select pg_relation_size('{SCHEMA}.{name}')").scalar(),
+            }
+            if not keep:
+                conn.execute(f"drop table {SCHEMA}.{name}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--experiments', type=int, default=1000)
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch tables")
+    add_output_argument(parser)
+    args = parser.parse_args()
+    results = run(args.database_url, args.rows, args.experiments, keep=args.keep)
+    report('uuids', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,13 @@ import os
 
 _qs_config_fname = os.path.join(os.path.expanduser('~'), '.quicksplit.json')
 _qs_data_fname = os.path.join(os.getcwd(), '.data.yml')
+# Telemetry waiting to be uploaded, see cli/telemetry.py
+_qs_spool_fname = os.path.join(os.path.expanduser('~'), '.quicksplit-events')
 
 
 os.environ.setdefault('QUICKSPLIT_CONFIG', _qs_config_fname)
 os.environ.setdefault('QUICKSPLIT_DATA', _qs_data_fname)
+os.environ.setdefault('QUICKSPLIT_SPOOL', _qs_spool_fname)
 os.environ.setdefault('QUICKSPLIT_API_URL', 'https://api.quicksplit.io')
 
 
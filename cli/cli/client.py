@@ -1,32 +1,86 @@
-import requests
-import threading
+import gzip
+import json as jsonlib
+import os
+import time
+from urllib.parse import urlencode
 
+from cli.telemetry import Telemetry
 
-class Logger(threading.Thread):
-    def __init__(self, client, **kwargs):
-        self.client = client
-        self.kwargs = kwargs
-        self.kwargs.update(user_id=self.client.config.user.get('id'))
-        super().__init__()
 
-    def run(self):
-        return self.client.send('post', '/events', json=self.kwargs)
+# Seconds to wait for a connection, and then for each read
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = float(os.environ.get('QUICKSPLIT_TIMEOUT', 30))
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+# Rows requested at a time from paged list routes
+PAGE_SIZE = 500
+
+
+def create_session(timing=False):
+    """
+    One session is shared by every request of the process, so requests
+    reuse kept-alive connections instead of paying for a new TCP and TLS
+    handshake each. Failed connections are retried with backoff, and so are
+    gateway errors for idempotent methods.
+
+    requests takes longer to import than the rest of the cli put together,
+    so it's only imported once a command sends a request.
+    """
+
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+    if timing:
+        from cli.timing import TimedHTTPAdapter as HTTPAdapter
+    adapter = HTTPAdapter(max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class Client(object):
 
-    def __init__(self, config):
+    def __init__(self, config, timing=False, compress=False):
         self.config = config
-
-    def send(self, method, route, json=None):
+        self.timing = timing or os.environ.get('QUICKSPLIT_TIMING') == 'true'
+        self.compress = compress or os.environ.get('QUICKSPLIT_COMPRESS') == 'true'
+        self.telemetry = Telemetry(self, config.spool_fname)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = create_session(timing=self.timing)
+        return self._session
+
+    def send(self, method, route, json=None, timeout=None, stream=False):
         _route = self.config.api_url + route
         headers = {}
         if self.config.token:
             headers.update({'Authorization': self.config.token})
-        return requests.request(method, url=_route, json=json, headers=headers)
+        data = None
+        if json is not None:
+            data = jsonlib.dumps(json).encode()
+            headers['Content-Type'] = 'application/json'
+            if self.compress and len(data) >= COMPRESS_MIN_BYTES:
+                data = gzip.compress(data)
+                headers['Content-Encoding'] = 'gzip'
+
+        if self.timing:
+            from cli import timing
+            timing.reset()
+        started = time.perf_counter()
+        resp = self.session.request(method, url=_route, data=data, headers=headers,
+                                    timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), stream=stream)
+        if self.timing:
+            timing.report(method, route, resp, time.perf_counter() - started)
+        return resp
 
     def track(self, **kwargs):
-        return Logger(client=self, **kwargs).start()
+        return self.telemetry.track(**kwargs)
 
     def login(self, email, password):
         resp = self.post('/login', json={
@@ -50,13 +104,75 @@ class Client(object):
         })
         return resp
 
-    def get(self, route, json=None):
-        return self.send(method='GET', route=route, json=json)
+    def get(self, route, json=None, stream=False):
+        return self.send(method='GET', route=route, json=json, stream=stream)
 
     def post(self, route, json=None):
         return self.send(method='POST', route=route, json=json)
 
 
+class RequestFailed(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+class Pages(object):
+    """
+    The rows of a paged list route, fetched a page at a time as they're
+    iterated over by following the cursor the api sends in X-Next-Cursor.
+    The first page is fetched right away, as `resp`, so that commands can
+    check it for errors before they start printing. Later pages that fail
+    raise RequestFailed.
+
+    At most `limit` rows are fetched, starting after `cursor`. Once the
+    rows run out, `next_cursor` is where the next ones start, if any.
+    """
+
+    def __init__(self, client, route, limit=None, cursor=None, page_size=PAGE_SIZE):
+        self.client = client
+        self.route = route
+        self.limit = limit
+        self.page_size = page_size
+        self.next_cursor = None
+        self.resp = self.fetch(cursor, 0)
+
+    def fetch(self, cursor, count):
+        size = min(self.page_size, self.limit - count) if self.limit else self.page_size
+        params = {'limit': size, **({'after': cursor} if cursor else {})}
+        return self.client.get(f"{self.route}?{urlencode(params)}")
+
+    def __iter__(self):
+        resp, count = self.resp, 0
+        while True:
+            rows = resp.json()['data']
+            yield from rows
+            count += len(rows)
+            self.next_cursor = resp.headers.get('X-Next-Cursor')
+            if not self.next_cursor or (self.limit and count >= self.limit):
+                return
+            resp = self.fetch(self.next_cursor, count)
+            if not resp.ok:
+                raise RequestFailed(resp)
+
+
+class LazyClient(object):
+    """
+    Stands in for the client of a command until the command first uses it,
+    so that `--help` and usage errors don't read the config file.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            from cli.config import Config
+            self._client = Client(Config(), **self._kwargs)
+        return getattr(self._client, name)
+
+
 class StagingClient(object):
     def __init__(self, client):
         self.client = client
@@ -1,16 +1,20 @@
 import json
 import click
+import contextlib
 import os
 import sys
 import getpass
 
-from cli.config import Config
-from cli.client import Client, StagingClient
-from cli.printers import Printer
+from cli.client import LazyClient, StagingClient, Pages, RequestFailed
+from cli.printers import Printer, FORMATS
+from cli.progress import Progress
 
+# Scripts run the cli thousands of times, so its startup time matters.
+# Modules that are slow to import and only needed by some commands, like
+# requests, are imported by the commands that use them.
 
-config = Config()
-client = Client(config)
+# Records rejected by an import that are listed at the end
+REJECTED_SHOWN = 10
 
 
 class ResponseErrorHandler(object):
@@ -31,15 +35,17 @@ class ResponseErrorHandler(object):
 
 
 @click.group()
+@click.option('--timing', is_flag=True, default=False, help="Print a timing breakdown of each request")
+@click.option('--compress', is_flag=True, default=False, help="Gzip large request bodies")
 @click.pass_context
-def base(ctx):
+def base(ctx, timing, compress):
     """
     CLI for managing Quick Split A/B tests
     """
 
     if '.' not in sys.path:
         sys.path.append('.')
-    ctx.obj = client
+    ctx.obj = LazyClient(timing=timing, compress=compress)
 
 
 @base.command()
@@ -123,44 +129,66 @@ def config(ctx):
     print(ctx.obj.config)
 
 
+def parse_cohorts(ctx, param, values):
+    cohorts = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        try:
+            cohorts[name] = float(weight or 1)
+        except ValueError:
+            raise click.BadParameter(f"Invalid weight for cohort {name}: {weight}")
+    return cohorts
+
+
 @base.command()
 @click.argument('name', required=True)
+@click.option('--cohort', 'cohorts', multiple=True, callback=parse_cohorts, metavar='NAME[=WEIGHT]',
+              help="A cohort to assign subjects to, weighted 1 by default. Can be repeated.")
 @click.pass_context
-def create(ctx, name):
+def create(ctx, name, cohorts):
     """
     Create a new experiment
     """
 
     ctx.obj.track(name="create", data={'experiment': name})
-    resp = ctx.obj.post('/experiments', json={'name': name})
+    resp = ctx.obj.post('/experiments', json={'name': name, **({'cohorts': cohorts} if cohorts else {})})
     if ResponseErrorHandler(resp).ok:
         print(f"Successfully created new experiment {name}")
 
 
 @base.command()
 @click.option('--staging', is_flag=True, required=False, default=False)
+@click.option('--limit', type=click.IntRange(1), default=None, help="List at most this many experiments")
+@click.option('--page', default=None, help="Continue a --limit listing from this cursor")
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='table')
 @click.pass_context
-def experiments(ctx, staging):
+def experiments(ctx, staging, limit, page, fmt):
     """
     List active experiments
     """
 
     ctx.obj.track(name="experiments")
-    if staging:
-        with StagingClient(ctx.obj) as client:
-            resp = client.get('/experiments')
-    else:
-        resp = ctx.obj.get('/experiments')
-    if ResponseErrorHandler(resp).ok:
-        data = resp.json()['data']
-        Printer(data,
-                order=['name', 'subjects_counter', 'active', 'full', 'last_exposure_at'],
-                rename={
-                    'subjects_counter': 'subjects',
-                    'last_exposure_at': 'last exposure',
-                },
-                empty_data_message="No experiments created yet. \nCreate an experiment with `quicksplit create my-experiment`"
-        ).echo()
+    # Pages are fetched as they're printed, so print with the staging token
+    with StagingClient(ctx.obj) if staging else contextlib.nullcontext(ctx.obj) as client:
+        pages = Pages(client, '/experiments', limit=limit, cursor=page)
+        if not ResponseErrorHandler(pages.resp).ok:
+            return
+        try:
+            Printer(pages,
+                    order=['name', 'subjects_counter', 'active', 'full', 'last_exposure_at'],
+                    rename={
+                        'subjects_counter': 'subjects',
+                        'last_exposure_at': 'last exposure',
+                    },
+                    empty_data_message="No experiments created yet. \nCreate an experiment with `quicksplit create my-experiment`",
+                    fmt=fmt
+            ).echo()
+        except RequestFailed as exc:
+            ResponseErrorHandler(exc.response).ok
+            sys.exit(1)
+    if pages.next_cursor:
+        print(f"More experiments: quicksplit experiments --limit {limit} --page {pages.next_cursor}",
+              file=sys.stderr)
 
 
 @base.command()
@@ -234,10 +262,60 @@ def results(ctx, experiment, staging):
             )
 
 
+@base.command()
+@click.argument('experiment', required=True)
+@click.option('--output', '-o', default='-', help="File to write, defaults to stdout")
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help="Defaults to csv for .csv files and ndjson otherwise")
+@click.option('--gzip', 'compressed', is_flag=True, default=False, help="Write the export gzipped")
+@click.option('--staging', required=False, default=False, is_flag=True)
+@click.pass_context
+def export(ctx, experiment, output, fmt, compressed, staging):
+    """
+    Export the raw exposures and conversions of an experiment
+    """
+
+    from urllib.parse import quote
+
+    from cli import exports, imports
+
+    ctx.obj.track(name="export", data={'experiment': experiment, 'staging': staging})
+    fmt = fmt or imports.detect_format(output[:-3] if output.endswith('.gz') else output)
+    route = f"/experiments/{quote(experiment, safe='')}/export?format={fmt}"
+    if staging:
+        with StagingClient(ctx.obj) as client:
+            resp = client.get(route, stream=True)
+    else:
+        resp = ctx.obj.get(route, stream=True)
+    if not ResponseErrorHandler(resp).ok:
+        return
+
+    progress = Progress("lines written")
+    # Written next to the output and moved over it once complete, so a
+    # failed export doesn't leave a truncated file behind
+    part = None if output == '-' else f"{output}.part"
+    f = open(part, 'wb') if part else sys.stdout.buffer
+    try:
+        with resp, f if part else contextlib.nullcontext():
+            lines = exports.save(resp, f, compressed, progress=progress.update)
+    except BaseException as exc:
+        if part:
+            os.remove(part)
+        if not isinstance(exc, (exports.ExportFailed, KeyboardInterrupt)):
+            raise
+        progress.finish(progress.count)
+        print(f"Export failed: {exc or 'interrupted'}", file=sys.stderr)
+        sys.exit(1)
+    if part:
+        os.replace(part, output)
+    progress.finish(lines)
+
+
 @base.command()
 @click.option('--staging', default=False, is_flag=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='table')
 @click.pass_context
-def recent(ctx, staging):
+def recent(ctx, staging, fmt):
     """
     Display recent exposure and conversion events
     """
@@ -256,7 +334,8 @@ def recent(ctx, staging):
             data,
             empty_data_message=f"No results received for {environment} environment yet. Please check your logging is working.",
             order=['type', 'experiment', 'subject', 'cohort', 'value', 'last_seen_at'],
-            rename={'last_seen_at': 'last seen'}
+            rename={'last_seen_at': 'last seen'},
+            fmt=fmt
         ).echo()
 
 
@@ -297,14 +376,90 @@ def log(ctx, log, subject, experiment, cohort, value, staging):
         pass
 
 
+@base.command(name='import')
+@click.argument('kind', type=click.Choice(['exposures', 'conversions']))
+@click.argument('file', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help="Defaults to csv for .csv files and ndjson otherwise")
+@click.option('--batch-size', type=click.IntRange(1, 1000), default=1000, help="Records per request")
+@click.option('--workers', type=click.IntRange(1, 10), default=4, help="Requests sent at once")
+@click.option('--checkpoint', default=None, help="Where progress is saved, defaults to FILE.checkpoint")
+@click.option('--resume', is_flag=True, default=False, help="Continue from the checkpoint")
+@click.option('--offset', type=int, default=None, help="Skip this many records")
+@click.option('--skip-invalid', is_flag=True, default=False,
+              help="Import the rest of a batch when some of its records are rejected")
+@click.option('--staging', required=False, is_flag=True, default=False)
+@click.pass_context
+def import_events(ctx, kind, file, fmt, batch_size, workers, checkpoint, resume, offset, skip_invalid, staging):
+    """
+    Import exposures or conversions from a CSV or NDJSON file, or - for stdin
+
+    Records have the fields of `quicksplit log`, plus an optional created_at
+    timestamp of when they happened.
+    """
+
+    from cli import imports
+
+    ctx.obj.track(name="import", data={'kind': kind, 'staging': staging})
+    if file != '-':
+        checkpoint = checkpoint or f"{file}.checkpoint"
+    if resume and not checkpoint:
+        print("Pass --checkpoint to resume an import from stdin.")
+        return
+    checkpoint = imports.Checkpoint(checkpoint) if checkpoint else None
+    if offset is None:
+        offset = checkpoint.load() if resume else 0
+
+    f = sys.stdin.buffer if file == '-' else open(file, 'rb')
+    reader = imports.CountingReader(f)
+    progress = Progress("records imported", offset, total=None if file == '-' else os.path.getsize(file))
+    importer = imports.Importer(
+        send=lambda chunk: ctx.obj.post(f'/{kind}?skip_invalid=true' if skip_invalid else f'/{kind}', json=chunk),
+        batch_size=batch_size,
+        workers=workers,
+        checkpoint=checkpoint,
+        progress=lambda records: progress.update(records, reader.bytes),
+    )
+    records = imports.read_records(reader, fmt or imports.detect_format(file), kind)
+    try:
+        if staging:
+            with StagingClient(ctx.obj):
+                totals = importer.run(records, offset)
+        else:
+            totals = importer.run(records, offset)
+    except (imports.ImportFailed, KeyboardInterrupt) as exc:
+        progress.finish(importer.offset, reader.bytes)
+        print(str(exc) or "Interrupted.")
+        if checkpoint:
+            print(f"Imported the first {importer.offset} records. Rerun with --resume to continue.")
+        else:
+            print(f"Imported the first {importer.offset} records. Rerun with --offset {importer.offset} to continue.")
+        sys.exit(1)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+    progress.finish(importer.offset, reader.bytes)
+    if checkpoint:
+        checkpoint.clear()
+    print(f"Imported {importer.offset - offset - len(importer.rejected)} {kind}: "
+          f"{totals['created']} new, {totals['updated']} updated.")
+    if importer.rejected:
+        print(f"Skipped {len(importer.rejected)} invalid records:")
+        for number, message in sorted(importer.rejected)[:REJECTED_SHOWN]:
+            print(f"  Record {number}: {message}")
+        if len(importer.rejected) > REJECTED_SHOWN:
+            print(f"  and {len(importer.rejected) - REJECTED_SHOWN} more")
+
+
 @base.command()
 @click.option('--current', is_flag=True, default=False)
 @click.option('--public', is_flag=True, default=False)
 @click.option('--private', is_flag=True, default=False)
 @click.option('--production', is_flag=True, default=False)
 @click.option('--staging', is_flag=True, default=False)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='table')
 @click.pass_context
-def tokens(ctx, current, public, private, production, staging):
+def tokens(ctx, current, public, private, production, staging, fmt):
     """
     Print the set of available tokens
     """
@@ -333,4 +488,4 @@ def tokens(ctx, current, public, private, production, staging):
         if all([public or private, staging or production]):
             print(data[0]['value'])
         else:
-            Printer(data, order=['value', 'private', 'environment']).echo()
+            Printer(data, order=['value', 'private', 'environment'], fmt=fmt).echo()
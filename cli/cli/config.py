@@ -12,14 +12,16 @@ class Config(object):
     def __init__(self):
         self.config_fname = os.environ['QUICKSPLIT_CONFIG']
         self.data_fname = os.environ['QUICKSPLIT_DATA']
+        self.spool_fname = os.environ['QUICKSPLIT_SPOOL']
         self.api_url = os.environ['QUICKSPLIT_API_URL']
         self.token = None
         self.user = {}
         self.load_config()
 
     def load_config(self):
+        # Written by the first command that changes it, like login
         if not os.path.exists(self.config_fname):
-            self.dump_config()
+            return
         with open(self.config_fname, 'r') as o:
             data = load(o)
             self.token = data.get('token')
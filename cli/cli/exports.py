@@ -0,0 +1,64 @@
+"""
+Raw data exports, for `quicksplit export`.
+
+The api streams exports as they're read from the database, gzipped, so
+they're written out as they arrive instead of being held in memory.
+"""
+
+import zlib
+
+import requests
+from urllib3.exceptions import HTTPError
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ExportFailed(Exception):
+    pass
+
+
+def save(resp, f, compressed=False, progress=None):
+    """
+    Write the body of the streamed response `resp` to the binary file `f`,
+    gzipped when `compressed`. Returns the number of lines written, which
+    `progress` is called with after every chunk. Raises ExportFailed when
+    the download breaks off.
+    """
+
+    try:
+        return write_body(resp, f, compressed, progress)
+    # Reading the raw stream raises urllib3's errors rather than requests'
+    except (requests.RequestException, HTTPError, zlib.error) as exc:
+        raise ExportFailed(str(exc) or exc.__class__.__name__) from exc
+
+
+def write_body(resp, f, compressed, progress):
+
+    gzipped = resp.headers.get('Content-Encoding') == 'gzip'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    # A body the api sent gzipped is written as it is
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compressed and not gzipped else None
+    lines = 0
+
+    def write(chunk, data):
+        if not compressed:
+            f.write(data)
+        elif compressor:
+            f.write(compressor.compress(data))
+        else:
+            f.write(chunk)
+
+    for chunk in resp.raw.stream(CHUNK_SIZE, decode_content=False):
+        data = decompressor.decompress(chunk) if decompressor else chunk
+        lines += data.count(b"\n")
+        write(chunk, data)
+        if progress:
+            progress(lines)
+    if decompressor:
+        data = decompressor.flush()
+        lines += data.count(b"\n")
+        write(b"", data)
+    if compressor:
+        f.write(compressor.flush())
+    return lines
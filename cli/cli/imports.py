@@ -0,0 +1,189 @@
+"""
+Bulk imports of exposures and conversions, for `quicksplit import`.
+
+Records are streamed from a CSV file with a header row or from NDJSON, one
+json object per line, and grouped into chunks that are sent as batch
+requests (a json array of records) to /exposures or /conversions by a pool
+of threads. Only a few chunks per thread are read ahead, so memory use
+doesn't depend on the size of the file.
+
+Chunks finish out of order. After each one, the number of records up to
+which every chunk has been imported is saved to a checkpoint file, so an
+interrupted import can continue from there. The api merges records it has
+already seen, so chunks that are sent twice aren't counted twice.
+"""
+
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+
+# Required and optional fields of the records of each kind
+FIELDS = {
+    'exposures': (['experiment', 'subject', 'cohort'], ['created_at']),
+    'conversions': (['experiment', 'subject'], ['value', 'created_at']),
+}
+# Chunks read ahead for each thread
+READ_AHEAD = 2
+# Attempts at a chunk the api failed to handle, with exponential backoff
+ATTEMPTS = 4
+BACKOFF = 0.5
+
+
+class ImportFailed(Exception):
+    pass
+
+
+class CountingReader(object):
+    "Decoded lines of a binary file, counting the bytes read so far."
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def __iter__(self):
+        for line in self.f:
+            self.bytes += len(line)
+            yield line.decode('utf-8-sig')
+
+
+def detect_format(fname):
+    return 'csv' if fname.lower().endswith('.csv') else 'ndjson'
+
+
+def read_records(lines, fmt, kind):
+    "Yield the records of `kind` in `lines`, keeping only the fields the api accepts."
+
+    required, optional = FIELDS[kind]
+    if fmt == 'csv':
+        rows = csv.DictReader(lines)
+    else:
+        rows = (json.loads(line) for line in lines if line.strip())
+    try:
+        for number, row in enumerate(rows, 1):
+            if not isinstance(row, dict):
+                raise ImportFailed(f"Record {number} is not an object")
+            missing = [field for field in required if row.get(field) in (None, '')]
+            if missing:
+                raise ImportFailed(f"Record {number} is missing {', '.join(missing)}")
+            record = {field: row[field] for field in required}
+            record.update({field: row[field] for field in optional if row.get(field) not in (None, '')})
+            yield record
+    except (ValueError, csv.Error) as exc:
+        raise ImportFailed(f"Invalid {fmt}: {exc}")
+
+
+def chunked(records, size, offset=0):
+    "Yield the offset of each chunk of `records` after the first `offset`, with the chunk."
+
+    records = itertools.islice(records, offset, None)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield offset, chunk
+        offset += len(chunk)
+
+
+class Checkpoint(object):
+    "The number of records imported so far, saved atomically to `fname`."
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                return json.load(f)['offset']
+        except FileNotFoundError:
+            return 0
+
+    def save(self, offset):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump({'offset': offset}, f)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    def clear(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+class Importer(object):
+    """
+    Sends chunks of records with `send`, a function posting one chunk and
+    returning the response, from `workers` threads.
+    """
+
+    def __init__(self, send, batch_size=1000, workers=4, checkpoint=None, progress=None):
+        self.send = send
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.offset = 0
+        self.totals = {'created': 0, 'updated': 0}
+        # Numbers of the records the api rejected, with why, when it's
+        # asked to skip invalid records
+        self.rejected = []
+        # Ends of the chunks done ahead of the offset, by their start
+        self.acknowledged = {}
+
+    def run(self, records, offset=0):
+        self.offset = offset
+        pending = {}
+        with ThreadPoolExecutor(self.workers) as pool:
+            try:
+                for start, chunk in chunked(records, self.batch_size, offset):
+                    while len(pending) >= self.workers * READ_AHEAD:
+                        self.collect(pending, wait(pending, return_when=FIRST_COMPLETED).done)
+                    pending[pool.submit(self.send_chunk, start, chunk)] = (start, start + len(chunk))
+                while pending:
+                    self.collect(pending, wait(pending, return_when=FIRST_COMPLETED).done)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return self.totals
+
+    def collect(self, pending, done):
+        for future in done:
+            start, end = pending.pop(future)
+            result = future.result()
+            self.totals['created'] += result['created']
+            self.totals['updated'] += result['updated']
+            self.rejected.extend((start + rejected['index'] + 1, rejected['message'])
+                                 for rejected in result.get('rejected', []))
+            self.acknowledged[start] = end
+        while self.offset in self.acknowledged:
+            self.offset = self.acknowledged.pop(self.offset)
+        if self.checkpoint:
+            self.checkpoint.save(self.offset)
+        if self.progress:
+            self.progress(self.offset)
+
+    def send_chunk(self, start, chunk):
+        error = None
+        for attempt in range(ATTEMPTS):
+            if attempt:
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+            try:
+                resp = self.send(chunk)
+            except requests.RequestException as exc:
+                error = str(exc)
+                continue
+            if resp.ok:
+                return resp.json()['data']
+            try:
+                error = resp.json().get('message')
+            except ValueError:
+                error = None
+            error = f"{error or 'A client error occured.'} [code={resp.status_code}]"
+            # Retrying won't fix records the api rejected
+            if resp.status_code < 500 and resp.status_code != 429:
+                break
+        raise ImportFailed(f"Records {start + 1} to {start + len(chunk)}: {error}")
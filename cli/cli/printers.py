@@ -1,70 +1,162 @@
+import itertools
+import json
+import sys
+from typing import Dict, Iterable
+
 from click import style, echo
-from typing import List, Dict
-from terminaltables import SingleTable
-from click import echo
 
 
 DEFAULT_EMPTY_DATA_MESSAGE = """
 No data to display.
 """
 
+FORMATS = ['table', 'json', 'csv']
+# Rows the widths of a table's columns are measured on. Values in later
+# rows that don't fit are cut short, so rows can be printed as they arrive.
+SAMPLE_ROWS = 100
+MAX_COLUMN_WIDTH = 60
+# Rows written to the terminal at once
+WRITE_BATCH = 500
 
 
-class Printer(SingleTable):
+class Printer(object):
     """
-    Handles printing a list of json objects.
+    Handles printing a list of json objects, as a table or as json or csv
+    for piping. The data can be any iterable, like the pages of a list
+    route, and is printed as it's read, so the first rows show up without
+    waiting for the last and memory use doesn't grow with the number of
+    rows.
 
     TODO:
     - validate that all items in the data have the same keys
     """
 
-    def __init__(self, table_data_json: List[Dict], title=None,
+    def __init__(self, table_data_json: Iterable[Dict], title=None,
                  order=None, bold_header=True, color="bright_magenta",
-                 rename=None, empty_data_message=None):
-        self.table_data_json = table_data_json
-        if len(self.table_data_json) == 0 or self.table_data_json[0] == {}:
-            self.empty = True
-        else:
-            self.empty = False
+                 rename=None, empty_data_message=None, fmt='table', stream=None):
+        data = iter(table_data_json)
+        self.sample = list(itertools.islice(data, SAMPLE_ROWS))
+        self.remaining = data
+        self.empty = len(self.sample) == 0 or self.sample[0] == {}
 
+        self.title = title
         self.rename = rename
         self.order = order if order else []
         self.bold_header = bold_header
         self.color = color
         self.empty_data_message = empty_data_message or DEFAULT_EMPTY_DATA_MESSAGE
-        super().__init__(self.formatted_table_data, title=title)
+        self.fmt = fmt
+        self.stream = stream or sys.stdout
 
     def echo(self):
-        if self.empty:
+        if self.empty and self.fmt == 'table':
             echo(self.empty_data_message)
+        elif self.fmt == 'json':
+            self.write_json()
+        elif self.fmt == 'csv':
+            self.write_csv()
         else:
-            echo(self.table)
+            self.write_table()
 
     @property
-    def formatted_table_data(self):
-        return [self.columns] + list(self.rows)
+    def keys(self):
+        return self.order.copy() if self.order else list(self.sample[0].keys())
 
     @property
-    def columns(self):
-        if self.order:
-            keys = self.order.copy()
-        else:
-            keys = list(self.table_data_json[0].keys())
+    def headers(self):
+        keys = self.keys
         if self.rename:
-            keys_copy = keys.copy()
-            for current, future in self.rename.items():
-                for n, key in enumerate(keys_copy):
-                    if key == current:
-                        keys[n] = future
+            keys = [self.rename.get(key, key) for key in keys]
+        return keys
+
+    @property
+    def columns(self):
+        keys = self.headers
         if self.bold_header or self.color:
             keys = [style(k.capitalize(), bold=self.bold_header, fg=self.color) for k in keys]
         return keys
 
     @property
     def rows(self):
-        for d in self.table_data_json:
-            if self.order:
-                dcopy = {k: d[k] for k in self.order}
-            else:
-                dcopy = d
-            yield ['' if v==None else v for k,v in dcopy.items()]
+        keys = self.keys
+        for d in itertools.chain(self.sample, self.remaining):
+            yield ['' if d.get(k) is None else d[k] for k in keys]
+
+    @property
+    def table_data(self):
+        return [self.columns] + list(self.rows)
+
+    def write(self, lines):
+        # click strips the colors when the output isn't a terminal
+        lines = iter(lines)
+        for batch in iter(lambda: list(itertools.islice(lines, WRITE_BATCH)), []):
+            echo("".join(line + "\n" for line in batch), file=self.stream, nl=False)
+
+    def write_json(self):
+        "A json array of the whole objects, one per line."
+
+        def lines():
+            rows = (json.dumps(d) for d in itertools.chain(self.sample, self.remaining))
+            previous = next(rows, None)
+            if previous is None:
+                yield "[]"
+                return
+            yield "["
+            for row in rows:
+                yield previous + ","
+                previous = row
+            yield previous
+            yield "]"
+        self.write(lines())
+
+    def write_csv(self):
+        import csv
+        import io
+
+        if self.empty:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def line(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            return buffer.getvalue().rstrip("\r\n")
+        self.write(itertools.chain([line(self.headers)], (line(row) for row in self.rows)))
+
+    def write_table(self):
+        headers = [k.capitalize() if self.bold_header or self.color else k for k in self.headers]
+        widths = [len(header) for header in headers]
+        for d in self.sample:
+            for n, key in enumerate(self.keys):
+                widths[n] = max(widths[n], len(cell(d.get(key))))
+        widths = [min(width, MAX_COLUMN_WIDTH) for width in widths]
+
+        def border(left, middle, right):
+            return left + middle.join("─" * (width + 2) for width in widths) + right
+
+        def line(values, styled=False):
+            cells = [fit(value, width) for value, width in zip(values, widths)]
+            if styled:
+                cells = [style(c, bold=self.bold_header, fg=self.color) for c in cells]
+            return "│ " + " │ ".join(cells) + " │"
+
+        top = border("┌", "┬", "┐")
+        if self.title:
+            top = top[0] + self.title[:len(top) - 2] + top[len(self.title) + 1:]
+        self.write(itertools.chain(
+            [top, line(headers, styled=bool(self.bold_header or self.color)), border("├", "┼", "┤")],
+            (line([cell(value) for value in row]) for row in self.rows),
+            [border("└", "┴", "┘")],
+        ))
+
+
+def cell(value):
+    return '' if value is None else str(value).replace("\n", " ")
+
+
+def fit(value, width):
+    if len(value) > width:
+        return value[:width - 1] + "…"
+    return value.ljust(width)
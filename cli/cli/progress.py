@@ -0,0 +1,35 @@
+import sys
+import time
+
+
+class Progress(object):
+    """
+    A one line report on stderr of how many `unit` were handled and how
+    fast, redrawn at most every `interval` seconds. When the size of the
+    input is known, `update` can be given the position in it too.
+    """
+
+    def __init__(self, unit, offset=0, total=None, interval=0.2, stream=sys.stderr):
+        self.unit = unit
+        self.offset = self.count = offset
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.started = self.drawn = time.perf_counter()
+
+    def update(self, count, position=None, force=False):
+        self.count = count
+        now = time.perf_counter()
+        if not force and now - self.drawn < self.interval:
+            return
+        self.drawn = now
+        rate = (count - self.offset) / max(now - self.started, 1e-6)
+        line = f"{count} {self.unit}  {rate:.0f}/s"
+        if self.total and position is not None:
+            line += f"  {min(position / self.total, 1):.0%}"
+        self.stream.write("\r" + line)
+        self.stream.flush()
+
+    def finish(self, count, position=None):
+        self.update(count, position, force=True)
+        self.stream.write("\n")
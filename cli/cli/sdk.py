@@ -0,0 +1,138 @@
+"""
+Cohort assignment for services that embed quicksplit.
+
+Instead of picking cohorts themselves and waiting on /exposures for every
+subject, services can assign subjects locally from the configuration of
+their experiments, which is fetched once from GET /experiments/config and
+then refreshed in the background with conditional requests:
+
+    from cli.sdk import Assigner
+
+    assigner = Assigner(token=os.environ['QUICKSPLIT_TOKEN'])
+    cohort = assigner.assign('checkout-button', user_id)
+
+A subject's cohort is picked by hashing it with the id of the experiment,
+so it doesn't change between calls, processes or machines for as long as
+the cohorts and their weights stay the same. Assigning doesn't send any
+requests. The exposure still has to be logged, which `expose` hands to the
+`log` function the assigner was created with, off the critical path. The
+`send` of a cli.sender.BufferedSender is one:
+
+    sender = BufferedSender(token=os.environ['QUICKSPLIT_TOKEN'])
+    assigner = Assigner(token=os.environ['QUICKSPLIT_TOKEN'], log=sender.send)
+    cohort = assigner.expose('checkout-button', user_id)
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+import requests
+
+from cli.client import create_session, CONNECT_TIMEOUT, READ_TIMEOUT
+
+
+# Seconds between checks for changes to the configuration
+REFRESH_INTERVAL = 30
+
+
+# bucket and pick must match app/assignment.py, which assigns subjects for
+# POST /assign.
+def bucket(salt, subject):
+    "Where `subject` falls in [0, 1), uniformly and stable for a given `salt`."
+
+    digest = hashlib.blake2b(f"{salt}:{subject}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def pick(salt, subject, cohorts):
+    "The cohort of `subject` among `cohorts`, a list of [name, weight]."
+
+    point = bucket(salt, subject) * sum(weight for _, weight in cohorts)
+    for name, weight in cohorts:
+        point -= weight
+        if point < 0:
+            return name
+    # Rounding can leave the point at the very end
+    return cohorts[-1][0] if cohorts else None
+
+
+class Assigner(object):
+    """
+    Assigns subjects to the cohorts of the active experiments of the
+    account that `token` belongs to.
+
+    The configuration is fetched when the assigner is created, so that the
+    first assignments don't wait on it, and then every `refresh_interval`
+    seconds from a background thread. When a refresh fails the last
+    configuration is kept.
+    """
+
+    def __init__(self, token, api_url=None, refresh_interval=REFRESH_INTERVAL, log=None, session=None):
+        self.token = token
+        self.api_url = api_url or os.environ.get('QUICKSPLIT_API_URL', 'https://api.quicksplit.io')
+        self.refresh_interval = refresh_interval
+        self.log = log
+        self.session = session or create_session()
+        self.experiments = {}
+        self.etag = None
+        self.refreshed_at = None
+        self.error = None
+        self._stopped = threading.Event()
+        self.refresh()
+        self._thread = None
+        if refresh_interval:
+            self._thread = threading.Thread(target=self._refresh_periodically, name='quicksplit-config', daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        "Fetch the configuration, unless it hasn't changed. Returns whether it had."
+
+        headers = {'Authorization': self.token}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        try:
+            resp = self.session.get(self.api_url + '/experiments/config', headers=headers,
+                                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.RequestException as exc:
+            self.error = str(exc)
+            return False
+        if resp.status_code == 304:
+            self.refreshed_at = time.time()
+            return False
+        if not resp.ok:
+            self.error = f"Fetching the experiment configuration failed [code={resp.status_code}]"
+            return False
+        # Replaced as a whole, so assignments never see half of an update
+        self.experiments = resp.json()['data']['experiments']
+        self.etag = resp.headers.get('ETag')
+        self.refreshed_at = time.time()
+        self.error = None
+        return True
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self.refresh_interval):
+            self.refresh()
+
+    def close(self):
+        self._stopped.set()
+
+    def assign(self, experiment, subject):
+        """
+        The cohort of `subject` in `experiment`, or None when the experiment
+        isn't active or has no cohorts yet.
+        """
+
+        config = self.experiments.get(experiment)
+        if not config or not config['cohorts']:
+            return None
+        return pick(config['id'], subject, config['cohorts'])
+
+    def expose(self, experiment, subject):
+        "Assign `subject` and pass its exposure to `log`. Returns the cohort."
+
+        cohort = self.assign(experiment, subject)
+        if cohort is not None and self.log:
+            self.log('exposures', {'experiment': experiment, 'subject': subject, 'cohort': cohort})
+        return cohort
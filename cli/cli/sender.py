@@ -0,0 +1,195 @@
+"""
+Logging exposures and conversions from services without waiting on the api.
+
+`BufferedSender.send` puts the event in a bounded in-memory buffer and
+returns. A daemon thread posts what's buffered as batch requests to
+/exposures and /conversions, once `batch_size` events are waiting or every
+`flush_interval` seconds, over a single kept-alive connection. Batches that
+fail are retried with backoff, and whatever is still buffered when the
+interpreter exits is sent then, for at most `EXIT_DEADLINE` seconds.
+
+    from cli.sender import BufferedSender
+
+    sender = BufferedSender(token=os.environ['QUICKSPLIT_TOKEN'])
+    sender.send('conversions', {'experiment': 'checkout-button', 'subject': user_id, 'value': 30})
+
+When the api can't keep up and the buffer fills, events are dropped rather
+than blocking the caller or growing without bound: the new event with the
+'newest' policy, or the oldest buffered one with 'oldest'. Dropped events,
+and batches that were rejected or failed for good, are counted in `stats`.
+"""
+
+import atexit
+import collections
+import datetime as dt
+import os
+import threading
+import time
+
+import requests
+
+from cli.client import create_session, CONNECT_TIMEOUT, READ_TIMEOUT
+
+
+KINDS = ['exposures', 'conversions']
+DROP_POLICIES = ['newest', 'oldest']
+# Events buffered at most
+MAX_SIZE = 10000
+# Events per request, the api accepts up to 1000
+BATCH_SIZE = 500
+# Seconds an event waits at most before it's sent
+FLUSH_INTERVAL = 1.0
+# Attempts at a batch, with exponential backoff
+ATTEMPTS = 4
+BACKOFF = 0.5
+# Seconds the interpreter waits at exit for the last events to be sent
+EXIT_DEADLINE = 5
+
+
+class BufferedSender(object):
+
+    def __init__(self, token, api_url=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_size=MAX_SIZE, drop='newest', session=None):
+        if drop not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop}")
+        self.token = token
+        self.api_url = api_url or os.environ.get('QUICKSPLIT_API_URL', 'https://api.quicksplit.io')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.drop = drop
+        self.session = session or create_session()
+        self.stats = {'sent': 0, 'dropped': 0, 'rejected': 0, 'failed': 0}
+        self.buffer = collections.deque()
+        self._ready = threading.Condition()
+        self._closed = False
+        self._stopped = False
+        # Flushes asked for, and the last one the thread finished
+        self._flushes = 0
+        self._flushed = 0
+        self._thread = threading.Thread(target=self._run, name='quicksplit-sender', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def send(self, kind, record):
+        """
+        Buffer `record`, the parameters of a POST to /exposures or
+        /conversions for `kind`. Returns False when it was dropped.
+        """
+
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind: {kind}")
+        if not isinstance(record, dict):
+            raise TypeError("Records must be dicts")
+        # When the event happened, timestamped once it's sent
+        event = (kind, record, time.time())
+        with self._ready:
+            if self._closed:
+                self.stats['dropped'] += 1
+                return False
+            if len(self.buffer) >= self.max_size:
+                self.stats['dropped'] += 1
+                if self.drop == 'newest':
+                    return False
+                self.buffer.popleft()
+            self.buffer.append(event)
+            if len(self.buffer) == self.batch_size:
+                self._ready.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Have the thread send everything buffered so far and wait up to
+        `timeout` seconds for it. Returns whether it was sent.
+        """
+
+        with self._ready:
+            self._flushes += 1
+            requested = self._flushes
+            self._ready.notify_all()
+            return self._ready.wait_for(lambda: self._flushed >= requested or self._stopped, timeout)
+
+    def close(self, timeout=EXIT_DEADLINE):
+        "Stop accepting events and wait up to `timeout` seconds for the rest to be sent."
+
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._ready:
+                if not self._closed and self._flushed == self._flushes and len(self.buffer) < self.batch_size:
+                    self._ready.wait(self.flush_interval)
+                closed = self._closed
+                requested = self._flushes
+                # Events buffered later wait for the next round, so a steady
+                # stream of them can't hold up a flush
+                count = len(self.buffer)
+            try:
+                while count > 0:
+                    sent = self._send_batch()
+                    if not sent:
+                        break
+                    count -= sent
+            except Exception:
+                # Whatever went wrong, the thread has to keep sending, or
+                # events would be buffered for good
+                pass
+            with self._ready:
+                self._flushed = requested
+                self._stopped = closed
+                self._ready.notify_all()
+            if closed:
+                return
+
+    def _take(self):
+        with self._ready:
+            count = min(len(self.buffer), self.batch_size)
+            return [self.buffer.popleft() for _ in range(count)]
+
+    def _send_batch(self):
+        "Send a batch of buffered events. Returns how many there were."
+
+        events = self._take()
+        if not events:
+            return 0
+        batches = {kind: [] for kind in KINDS}
+        for kind, record, happened_at in events:
+            created_at = dt.datetime.fromtimestamp(happened_at, dt.timezone.utc).isoformat()
+            batches[kind].append({**record, 'created_at': created_at})
+        for kind, records in batches.items():
+            if not records:
+                continue
+            try:
+                self._post(kind, records)
+            except Exception:
+                self._count('failed', len(records))
+        return len(events)
+
+    def _post(self, kind, records):
+        for attempt in range(ATTEMPTS):
+            if attempt:
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+            try:
+                # So a record of, say, a deactivated experiment doesn't fail
+                # the rest of the batch
+                resp = self.session.post(self.api_url + f'/{kind}?skip_invalid=true', json=records,
+                                         headers={'Authorization': self.token},
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            except requests.RequestException:
+                continue
+            if resp.ok:
+                rejected = len(resp.json()['data'].get('rejected', []))
+                self._count('rejected', rejected)
+                return self._count('sent', len(records) - rejected)
+            # Retrying won't fix records the api rejected
+            if resp.status_code < 500 and resp.status_code != 429:
+                return self._count('rejected', len(records))
+        self._count('failed', len(records))
+
+    def _count(self, stat, records):
+        # Under the lock, as send() updates stats from the callers' threads
+        with self._ready:
+            self.stats[stat] += records
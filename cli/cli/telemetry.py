@@ -0,0 +1,165 @@
+"""
+Usage telemetry that never slows a command down.
+
+`Telemetry.track` appends the event to a spool file and returns. At most once
+per interval, a daemon thread uploads everything spooled so far to /events
+in batches. When the command is done the process waits for the upload for
+at most `EXIT_DEADLINE` seconds, then exits regardless; events that weren't
+sent stay on disk, and a later command uploads them once they've been left
+for `ORPHANED_AFTER` seconds.
+
+Set QUICKSPLIT_TELEMETRY=false to turn it off.
+"""
+
+import atexit
+import datetime as dt
+import glob
+import json
+import os
+import threading
+import time
+
+
+# Seconds between uploads
+INTERVAL = int(os.environ.get('QUICKSPLIT_TELEMETRY_INTERVAL', 300))
+# Seconds a finished command waits for an upload in progress
+EXIT_DEADLINE = 0.5
+# Events per request, the api accepts up to 1000
+BATCH_SIZE = 500
+# Timeouts of upload requests, in seconds
+UPLOAD_TIMEOUT = (1, 2)
+# A file being sent that's older than this belongs to a process that died
+ORPHANED_AFTER = 60
+
+
+def read_events(fname):
+    events = []
+    with open(fname) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a process that was killed mid-write
+                continue
+    return events
+
+
+class Telemetry(object):
+
+    def __init__(self, client, spool_fname):
+        self.client = client
+        self.spool_fname = spool_fname
+        self.enabled = os.environ.get('QUICKSPLIT_TELEMETRY', 'true') != 'false'
+        self._thread = None
+
+    @property
+    def marker_fname(self):
+        return self.spool_fname + '.uploaded'
+
+    def track(self, **kwargs):
+        if not self.enabled:
+            return
+        event = dict(kwargs, created_at=dt.datetime.now(dt.timezone.utc).isoformat())
+        event.setdefault('user_id', self.client.config.user.get('id'))
+        try:
+            # Lines this short are appended atomically, so concurrent commands
+            # can share the spool
+            with open(self.spool_fname, 'a') as f:
+                f.write(json.dumps(event) + "\n")
+        except OSError:
+            return
+        self.maybe_upload()
+
+    def due(self):
+        try:
+            return time.time() - os.path.getmtime(self.marker_fname) >= INTERVAL
+        except OSError:
+            return True
+
+    def maybe_upload(self):
+        if self._thread is not None or not self.due():
+            return
+        # Claim the interval before uploading, so that commands run meanwhile
+        # don't start uploads of their own
+        try:
+            with open(self.marker_fname, 'a'):
+                os.utime(self.marker_fname)
+        except OSError:
+            return
+        self._thread = threading.Thread(target=self.upload, daemon=True)
+        self._thread.start()
+        atexit.register(self.wait)
+
+    def wait(self, deadline=EXIT_DEADLINE):
+        if self._thread is not None:
+            self._thread.join(deadline)
+
+    def claim(self):
+        """
+        Rename the spool, and the files of uploads that didn't finish, to
+        files of this upload. Events tracked while uploading go to a new
+        spool, and only one process can claim each file.
+        """
+
+        fnames = []
+        for fname in glob.glob(self.spool_fname + '.sending-*'):
+            try:
+                if time.time() - os.path.getmtime(fname) > ORPHANED_AFTER:
+                    fnames.append(fname)
+            except OSError:
+                continue
+        fnames.append(self.spool_fname)
+        claimed = []
+        for n, fname in enumerate(fnames):
+            sending = f"{self.spool_fname}.sending-{os.getpid()}-{int(time.time())}-{n}"
+            try:
+                os.replace(fname, sending)
+                # Not orphaned while this upload is sending it
+                os.utime(sending)
+            except OSError:
+                continue
+            claimed.append(sending)
+        return claimed
+
+    def upload(self):
+        for fname in self.claim():
+            try:
+                events = read_events(fname)
+            except OSError:
+                continue
+            sent = self.send(events)
+            # Files are only removed once all their events are sent. What's
+            # left is uploaded again once it's orphaned, also when this
+            # thread is abandoned at exit.
+            try:
+                if sent == len(events):
+                    os.remove(fname)
+                elif sent:
+                    self.rewrite(fname, events[sent:])
+            except OSError:
+                pass
+            if sent < len(events):
+                break
+
+    def send(self, events):
+        "Post `events` in batches. Returns how many were done with before a batch failed."
+
+        for start in range(0, len(events), BATCH_SIZE):
+            try:
+                resp = self.client.send('post', '/events', json=events[start:start + BATCH_SIZE],
+                                        timeout=UPLOAD_TIMEOUT)
+            except Exception:
+                resp = None
+            # Retry later when offline or the api is down, but drop
+            # batches it rejected
+            if resp is None or resp.status_code >= 500:
+                return start
+        return len(events)
+
+    def rewrite(self, fname, events):
+        # Not named like a file being sent, or it could be claimed half written
+        tmp_fname = f"{self.spool_fname}.rewrite-{os.getpid()}"
+        with open(tmp_fname, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+        os.replace(tmp_fname, fname)
@@ -0,0 +1,112 @@
+"""
+A breakdown of where the time of each request went, for `--timing`.
+"""
+
+import socket
+import sys
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family, create_connection
+
+
+# Connection setup times of the current thread's latest request
+timings = threading.local()
+
+
+def reset():
+    timings.dns = timings.connect = timings.tls = 0.0
+
+
+class TimedConnectionMixin(object):
+    """
+    Records how long each new connection spent resolving the host,
+    connecting and negotiating TLS. Reused connections record nothing.
+
+    Connections are opened the way urllib3 opens them, except that the host
+    is resolved here, once, so the two steps can be timed apart.
+    """
+
+    def _new_conn(self):
+        options = {}
+        if self.source_address:
+            options['source_address'] = self.source_address
+        if self.socket_options:
+            options['socket_options'] = self.socket_options
+        started = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+            resolved = time.perf_counter()
+            conn = self._connect_any(addresses, options)
+        except socket.timeout:
+            raise ConnectTimeoutError(
+                self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})")
+        except OSError as exc:
+            raise NewConnectionError(self, f"Failed to establish a new connection: {exc}")
+        timings.dns = resolved - started
+        timings.connect = time.perf_counter() - resolved
+        return conn
+
+    def _connect_any(self, addresses, options):
+        error = None
+        for _, _, _, _, address in addresses:
+            try:
+                # An address, which create_connection doesn't look up again
+                return create_connection(address[:2], self.timeout, **options)
+            except OSError as exc:
+                error = exc
+        raise error or OSError("getaddrinfo returns an empty list")
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        timings.tls = time.perf_counter() - started - timings.dns - timings.connect
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+def report(method, route, resp, total):
+    setup = timings.dns + timings.connect + timings.tls
+    # `elapsed` runs until the response headers arrived
+    server = resp.elapsed.total_seconds() - setup
+    parts = [
+        f"{method.upper()} {route} {resp.status_code}",
+        f"dns {timings.dns * 1000:.1f}ms",
+        f"connect {timings.connect * 1000:.1f}ms",
+        f"tls {timings.tls * 1000:.1f}ms",
+        f"server {server * 1000:.1f}ms",
+        f"total {total * 1000:.1f}ms",
+    ]
+    if not setup:
+        parts.append("(reused connection)")
+    if 'Server-Timing' in resp.headers:
+        parts.append(f"[{resp.headers['Server-Timing']}]")
+    print("  ".join(parts), file=sys.stderr)
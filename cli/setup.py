@@ -22,7 +22,6 @@ setuptools.setup(
     },
     install_requires=[
         'click==7.0',
-        'requests==2.23.0',
-        'terminaltables==3.1.0'
+        'requests==2.23.0'
     ]
 )
@@ -0,0 +1,19 @@
+# Loaded by bin/web in production.
+
+import os
+
+
+def child_exit(server, worker):
+    # Drop the gauges of workers that have exited from /metrics. There are
+    # no files to drop them from without a multiprocess directory, as when
+    # benchmarks/ingestion.py starts gunicorn.
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # The worker reset the sampler's signal handler when it started
+    from app.profiling import install_signal_handler
+    install_signal_handler(worker.wsgi)
@@ -0,0 +1,46 @@
+"""Time ordered ids for event tables
+
+Revision ID: 4b8e0c7d2f61
+Revises: 9cd1b49f3a6a
+Create Date: 2026-10-19 11:40:03.518227
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8e0c7d2f61'
+down_revision = '9cd1b49f3a6a'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['subject', 'exposure', 'conversion']
+
+
+def upgrade():
+    # Same layout as app.ids.uuid7. The models generate ids in python, this
+    # default covers rows written with raw sql or COPY. Existing uuid4 ids
+    # remain valid, they just don't sort by time.
+    op.execute("""
+        create or replace function uuid_generate_v7() returns uuid as $$
+        declare
+            value bytea := decode(md5(random()::text || clock_timestamp()::text), 'hex');
+            unix_ms bigint := (extract(epoch from clock_timestamp()) * 1000)::bigint;
+        begin
+            value := overlay(value placing substring(int8send(unix_ms) from 3) from 1 for 6);
+            value := set_byte(value, 6, (get_byte(value, 6) & 15) | 112);
+            value := set_byte(value, 8, (get_byte(value, 8) & 63) | 128);
+            return encode(value, 'hex')::uuid;
+        end
+        $$ language plpgsql volatile
+    """)
+    for table in TABLES:
+        op.alter_column(table, 'id', server_default=sa.text('uuid_generate_v7()'))
+
+
+def downgrade():
+    for table in TABLES:
+        op.alter_column(table, 'id', server_default=None)
+    op.execute("drop function uuid_generate_v7()")
@@ -0,0 +1,175 @@
+"""Partition exposure and conversion by month
+
+Revision ID: 9cd1b49f3a6a
+Revises: e71dea0cd6c3
+Create Date: 2026-10-19 09:12:41.204518
+
+"""
+import datetime as dt
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9cd1b49f3a6a'
+down_revision = 'e71dea0cd6c3'
+branch_labels = None
+depends_on = None
+
+
+# Number of monthly partitions to create ahead of the current month. After
+# this migration, `flask partitions create` keeps them topped up.
+FUTURE_MONTHS = 3
+
+COLUMNS = {
+    'exposure': ['created_at', 'updated_at', 'id', 'cohort_id', 'subject_id', 'experiment_id', 'scope_id', 'last_seen_at'],
+    'conversion': ['created_at', 'updated_at', 'id', 'exposure_id', 'scope_id', 'value', 'last_seen_at'],
+}
+
+INDEXED_COLUMNS = {
+    'exposure': ['cohort_id', 'created_at', 'experiment_id', 'last_seen_at', 'scope_id', 'subject_id', 'updated_at'],
+    'conversion': ['created_at', 'exposure_id', 'last_seen_at', 'scope_id', 'updated_at'],
+}
+
+UNIQUE_CONSTRAINTS = {
+    'exposure': ('exposure_subject_id_experiment_id_scope_id_key', ['subject_id', 'experiment_id', 'scope_id']),
+    'conversion': ('conversion_exposure_id_scope_id_key', ['exposure_id', 'scope_id']),
+}
+
+FOREIGN_KEYS = {
+    'exposure': [('cohort_id', 'cohort'), ('subject_id', 'subject'), ('experiment_id', 'experiment'), ('scope_id', 'scope')],
+    'conversion': [('scope_id', 'scope')],
+}
+
+
+def pointer_foreign_keys():
+    "The last_exposure_*/last_conversion_* foreign keys from d72f8a7404ec"
+    for table in ['experiment', 'subject', 'cohort']:
+        for event in ['exposure', 'conversion']:
+            for scope in ['staging', 'production']:
+                column = f'last_{event}_id_{scope}'
+                name = f'{table}_{column}_fkey'
+                # This one was created without the table prefix
+                if table == 'cohort' and column == 'last_conversion_id_production':
+                    name = column
+                yield table, name, column, event
+
+
+def months(start, end):
+    month = dt.date(start.year, start.month, 1)
+    while month <= end:
+        following = dt.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        yield month, following
+        month = following
+
+
+def create_constraints(table, partitioned):
+    primary_key = ['id', 'created_at'] if partitioned else ['id']
+    op.create_primary_key(f'{table}_pkey', table, primary_key)
+    name, columns = UNIQUE_CONSTRAINTS[table]
+    op.create_unique_constraint(name, table, columns + (['created_at'] if partitioned else []))
+    for column, referenced in FOREIGN_KEYS[table]:
+        op.create_foreign_key(f'{table}_{column}_fkey', table, referenced, [column], ['id'])
+    for column in INDEXED_COLUMNS[table]:
+        op.create_index(op.f(f'ix_{table}_{column}'), table, [column], unique=False)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # Postgres can't reference a partitioned table unless the foreign key
+    # includes the partition key, so these become plain uuid columns.
+    for table, name, column, event in pointer_foreign_keys():
+        op.drop_constraint(name, table, type_='foreignkey')
+    op.drop_constraint('conversion_exposure_id_fkey', 'conversion', type_='foreignkey')
+
+    for table in ['exposure', 'conversion']:
+        op.rename_table(table, f'{table}_unpartitioned')
+
+    op.execute("""
+        create table exposure (
+            created_at timestamp with time zone not null default now(),
+            updated_at timestamp with time zone not null default now(),
+            id uuid not null,
+            cohort_id uuid not null,
+            subject_id uuid not null,
+            experiment_id uuid not null,
+            scope_id uuid not null,
+            last_seen_at timestamp with time zone not null default now()
+        ) partition by range (created_at)
+    """)
+    op.execute("""
+        create table conversion (
+            created_at timestamp with time zone not null default now(),
+            updated_at timestamp with time zone not null default now(),
+            id uuid not null,
+            exposure_id uuid not null,
+            scope_id uuid not null,
+            value double precision,
+            last_seen_at timestamp with time zone not null default now()
+        ) partition by range (created_at)
+    """)
+
+    today = dt.date.today()
+    last_month = dt.date(today.year + (today.month + FUTURE_MONTHS - 1) // 12, (today.month + FUTURE_MONTHS - 1) % 12 + 1, 1)
+    for table, columns in COLUMNS.items():
+        op.execute(f"create table {table}_default partition of {table} default")
+        first_created_at = bind.execute(f"select min(created_at) from {table}_unpartitioned").scalar()
+        first_month = first_created_at.date() if first_created_at else today
+        for month, following in months(first_month, last_month):
+            op.execute(
+                f"create table {table}_y{month.year}m{month.month:02d} partition of {table} "
+                f"for values from ('{month}') to ('{following}')"
+            )
+
+        # Copy before building any indexes, which is much faster than
+        # maintaining them row by row.
+        column_list = ', '.join(columns)
+        op.execute(f"insert into {table} ({column_list}) select {column_list} from {table}_unpartitioned")
+        op.drop_table(f'{table}_unpartitioned')
+        create_constraints(table, partitioned=True)
+
+
+def downgrade():
+    for table in ['conversion', 'exposure']:
+        op.rename_table(table, f'{table}_partitioned')
+        for column in INDEXED_COLUMNS[table]:
+            op.execute(f"alter index ix_{table}_{column} rename to ix_{table}_partitioned_{column}")
+        op.execute(f"alter table {table}_partitioned rename constraint {table}_pkey to {table}_partitioned_pkey")
+        name, columns = UNIQUE_CONSTRAINTS[table]
+        op.execute(f"alter table {table}_partitioned rename constraint {name} to {table}_partitioned_unique_key")
+
+    op.create_table('exposure',
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('cohort_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('subject_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('experiment_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('scope_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('last_seen_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    )
+    op.create_table('conversion',
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('exposure_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('scope_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('value', sa.Float(), nullable=True),
+    sa.Column('last_seen_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    )
+
+    for table, columns in COLUMNS.items():
+        column_list = ', '.join(columns)
+        op.execute(f"insert into {table} ({column_list}) select {column_list} from {table}_partitioned")
+
+    for table in ['conversion', 'exposure']:
+        op.drop_table(f'{table}_partitioned')
+    for table in ['exposure', 'conversion']:
+        create_constraints(table, partitioned=False)
+
+    op.create_foreign_key('conversion_exposure_id_fkey', 'conversion', 'exposure', ['exposure_id'], ['id'])
+    for table, name, column, event in pointer_foreign_keys():
+        op.create_foreign_key(name, table, event, [column], ['id'])
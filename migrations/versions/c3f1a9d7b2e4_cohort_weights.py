@@ -0,0 +1,24 @@
+"""Add Cohort.weight
+
+Revision ID: c3f1a9d7b2e4
+Revises: 4b8e0c7d2f61
+Create Date: 2026-10-19 14:02:51.204317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d7b2e4'
+down_revision = '4b8e0c7d2f61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cohort', sa.Column('weight', sa.Float(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('cohort', 'weight')
@@ -0,0 +1,18 @@
+from benchmarks.results import compare, flatten
+
+
+def test_flatten():
+    results = {'requests': 10, 'gunicorn': {'/exposures single': {'p95_ms': 4.0}}, 'multiprocess': True}
+    assert flatten(results) == {'requests': 10, 'gunicorn./exposures single.p95_ms': 4.0}
+
+
+def test_compare():
+    baseline = {'requests': 10, 'reports': {'1000': {'median_seconds': 1.0}}, 'requests_per_second': 100.0}
+    current = {'requests': 20, 'reports': {'1000': {'median_seconds': 1.05}}, 'requests_per_second': 80.0}
+    rows = {row['metric']: row for row in compare(baseline, current, threshold=0.1)}
+
+    assert not rows['requests']['regression']
+    assert round(rows['reports.1000.median_seconds']['change'], 2) == 0.05
+    assert not rows['reports.1000.median_seconds']['regression']
+    assert round(rows['requests_per_second']['change'], 2) == 0.2
+    assert rows['requests_per_second']['regression']
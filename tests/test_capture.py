@@ -0,0 +1,56 @@
+import hashlib
+import json
+
+import pytest
+from flask import Flask
+
+from app.capture import alias, sanitize, init_capture
+
+
+@pytest.fixture()
+def capture_dir(app, tmp_path):
+    app.config['CAPTURE_DIR'] = str(tmp_path)
+    yield tmp_path
+    app.config['CAPTURE_DIR'] = None
+
+
+def captured(capture_dir):
+    return [json.loads(line) for path in capture_dir.glob('capture-*.ndjson') for line in path.open()]
+
+
+def test_sanitize(app):
+    with app.app_context():
+        body = sanitize({'experiment': 'e', 'subject': 'someone@example.com', 'password': 'secret'})
+        assert body == {'experiment': 'e', 'subject': alias('someone@example.com')}
+        assert sanitize(None) is None
+        # Keyed, so a dictionary of plain hashes doesn't reverse it
+        assert alias('someone@example.com') != hashlib.sha256(b'someone@example.com').hexdigest()[:16]
+
+
+def test_capture_requires_secret(tmp_path):
+    app = Flask(__name__)
+    app.config.update(CAPTURE_DIR=str(tmp_path), CAPTURE_SECRET=None)
+    with pytest.raises(ValueError):
+        init_capture(app)
+
+
+def test_capture_ingestion(db, client, experiment, capture_dir):
+    resp = client.post('/exposures', json={'experiment': experiment.name, 'subject': 'captured', 'cohort': 'control'})
+    assert resp.status_code == 200
+
+    records = captured(capture_dir)
+    assert len(records) == 1
+    record = records[0]
+    assert record['method'] == 'POST'
+    assert record['route'] == '/exposures'
+    assert record['status'] == 200
+    assert record['body']['subject'] == alias('captured')
+    token = client.environ_base['HTTP_AUTHORIZATION']
+    assert record['token'] == alias(token)
+    assert token not in json.dumps(record)
+
+
+def test_capture_skips_excluded_routes(db, client, email, password, capture_dir):
+    client.post('/login', json={'email': email, 'password': password})
+    client.get('/experiments')
+    assert [r['route'] for r in captured(capture_dir)] == ['/experiments']
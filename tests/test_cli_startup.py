@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+
+
+CLI_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'cli')
+# Cumulative import time of the cli package, well above what it takes on a
+# laptop so that slow CI machines don't fail it
+IMPORT_BUDGET_MS = 60
+# Only imported by the commands that need them
+DEFERRED_MODULES = ['requests', 'urllib3', 'concurrent.futures', 'csv']
+
+
+def run_cli(code, tmp_path, *options):
+    env = {
+        **os.environ,
+        'PYTHONPATH': CLI_DIRECTORY,
+        'HOME': str(tmp_path),
+        'QUICKSPLIT_CONFIG': str(tmp_path / 'quicksplit.json'),
+        'QUICKSPLIT_SPOOL': str(tmp_path / 'quicksplit-events'),
+    }
+    return subprocess.run([sys.executable, *options, '-c', code], env=env, cwd=str(tmp_path),
+                          capture_output=True, text=True)
+
+
+def import_time_ms(stderr, module):
+    "The cumulative import time of `module` from the output of `python -X importtime`."
+
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and line.split('|')[-1].strip() == module:
+            return int(line.split('|')[1]) / 1000
+    raise AssertionError(f"{module} wasn't imported")
+
+
+def test_cli_import_time(tmp_path):
+    # The fastest of a few runs, since the first one pays for cold disk caches
+    times = []
+    for _ in range(3):
+        result = run_cli("import cli", tmp_path, '-X', 'importtime')
+        assert result.returncode == 0, result.stderr
+        times.append(import_time_ms(result.stderr, 'cli'))
+    assert min(times) < IMPORT_BUDGET_MS
+
+
+def test_cli_import_defers_modules(tmp_path):
+    code = f"import cli, sys; print([m for m in {DEFERRED_MODULES!r} if m in sys.modules])"
+    result = run_cli(code, tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+
+
+def test_cli_help_skips_config(tmp_path):
+    result = run_cli("import cli; cli.base(['create', '--help'])", tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert "Create a new experiment" in result.stdout
+    assert not (tmp_path / 'quicksplit.json').exists()
@@ -7,8 +7,7 @@ from app.models import ExposureRollup
 
 def test_exposures_summary_sql(db, user, experiment, exposure, conversion):
     date = exposure.last_seen_at.date()
-    query = exposures_summary.format(date=date)
-    results = db.session.execute(query).fetchall()
+    results = exposures_summary.execute(date=date).fetchall()
     assert len(results) == 1
     data = dict(results[0])
     assert data['exposures'] == 1
@@ -17,8 +16,7 @@ def test_exposures_summary_sql(db, user, experiment, exposure, conversion):
 
 def test_exposures_summary_sql_staging(db, user, experiment, exposure_staging):
     date = exposure_staging.last_seen_at.date()
-    query = exposures_summary.format(date=date)
-    results = db.session.execute(query).fetchall()
+    results = exposures_summary.execute(date=date).fetchall()
     assert len(results) == 1
     data = dict(results[0])
     assert data['exposures'] == 1
@@ -0,0 +1,41 @@
+import time
+import uuid
+
+from app.ids import uuid7, uuid7_timestamp
+
+
+def test_uuid7_version_and_variant():
+    value = uuid7()
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+
+
+def test_uuid7_is_time_ordered():
+    first = uuid7()
+    time.sleep(0.002)
+    second = uuid7()
+    assert first < second
+    assert abs(uuid7_timestamp(second) - time.time()) < 1
+
+
+def test_uuid7_is_unique():
+    assert len(set(uuid7() for _ in range(10000))) == 10000
+
+
+def test_exposure_ids_are_time_ordered(db, exposure):
+    assert exposure.id.version == 7
+
+
+def test_database_uuid7_matches_python(db):
+    # Only present on databases built by migrations
+    exists = db.session.execute("select to_regproc('uuid_generate_v7') is not null").scalar()
+    if exists:
+        value = db.session.execute("select uuid_generate_v7()").scalar()
+        assert uuid.UUID(str(value)).version == 7
+        assert abs(uuid7_timestamp(uuid.UUID(str(value))) - time.time()) < 60
+
+
+def test_uuid7_from_timestamp():
+    value = uuid7(unix_ms=1577836800000)
+    assert value.version == 7
+    assert uuid7_timestamp(value) == 1577836800
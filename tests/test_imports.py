@@ -0,0 +1,126 @@
+import io
+import threading
+
+import pytest
+import requests
+
+import cli.imports
+from cli.imports import Checkpoint, Importer, ImportFailed, chunked, read_records
+
+
+class Response(object):
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.data = data
+
+    def json(self):
+        if self.ok:
+            return {'data': self.data}
+        return {'message': "Rejected"}
+
+
+def ok(chunk):
+    return Response(200, {'created': len(chunk), 'updated': 0})
+
+
+def test_read_records():
+    lines = io.StringIO("experiment,subject,cohort,extra\ne,s1,a,x\ne,s2,b,\n")
+    assert list(read_records(lines, 'csv', 'exposures')) == [
+        {'experiment': 'e', 'subject': 's1', 'cohort': 'a'},
+        {'experiment': 'e', 'subject': 's2', 'cohort': 'b'},
+    ]
+    with pytest.raises(ImportFailed, match="Record 1 is missing cohort"):
+        list(read_records(['{"experiment": "e", "subject": "s1"}'], 'ndjson', 'exposures'))
+
+
+def test_chunked():
+    assert list(chunked(iter(range(5)), 2)) == [(0, [0, 1]), (2, [2, 3]), (4, [4])]
+    assert list(chunked(iter(range(5)), 2, offset=3)) == [(3, [3, 4])]
+
+
+def test_checkpoint(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'import.checkpoint'))
+    assert checkpoint.load() == 0
+    checkpoint.save(42)
+    assert checkpoint.load() == 42
+    checkpoint.clear()
+    assert checkpoint.load() == 0
+
+
+def test_importer_offset_stops_at_first_gap(tmp_path):
+    # The first chunk only finishes once the three after it are done
+    release = threading.Event()
+    offsets = []
+
+    def send(chunk):
+        if chunk == [0]:
+            assert release.wait(5)
+        return ok(chunk)
+
+    def progress(offset):
+        offsets.append(offset)
+        if len(importer.acknowledged) == 3:
+            release.set()
+
+    checkpoint = Checkpoint(str(tmp_path / 'import.checkpoint'))
+    importer = Importer(send, batch_size=1, workers=4, checkpoint=checkpoint, progress=progress)
+    totals = importer.run(iter(range(4)))
+    assert totals == {'created': 4, 'updated': 0}
+    assert offsets[-1] == 4
+    assert set(offsets[:-1]) == {0}
+    assert checkpoint.load() == 4
+
+
+def test_importer_resumes_from_checkpoint(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'import.checkpoint'))
+    checkpoint.save(3)
+    sent = []
+
+    def send(chunk):
+        sent.extend(chunk)
+        return ok(chunk)
+
+    importer = Importer(send, batch_size=2, workers=1, checkpoint=checkpoint)
+    importer.run(iter(range(7)), offset=checkpoint.load())
+    assert sorted(sent) == [3, 4, 5, 6]
+    assert checkpoint.load() == 7
+
+
+def test_importer_retries_server_errors(monkeypatch):
+    monkeypatch.setattr(cli.imports, 'BACKOFF', 0)
+    responses = [requests.ConnectionError("down"), Response(503), ok([0])]
+
+    def send(chunk):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert Importer(send, batch_size=1, workers=1).run(iter([0])) == {'created': 1, 'updated': 0}
+    assert responses == []
+
+
+def test_importer_stops_on_client_errors(monkeypatch):
+    monkeypatch.setattr(cli.imports, 'BACKOFF', 0)
+    calls = []
+
+    def send(chunk):
+        calls.append(chunk)
+        return Response(404)
+
+    importer = Importer(send, batch_size=2, workers=1)
+    with pytest.raises(ImportFailed, match=r"Records 1 to 2: Rejected \[code=404\]"):
+        importer.run(iter(range(2)))
+    assert len(calls) == 1
+    assert importer.offset == 0
+
+
+def test_importer_collects_rejected_records():
+    def send(chunk):
+        return Response(200, {'created': len(chunk) - 1, 'updated': 0,
+                              'rejected': [{'index': 1, 'message': "Experiment does not exist"}]})
+
+    importer = Importer(send, batch_size=2, workers=1)
+    importer.run(iter(range(4)))
+    assert sorted(importer.rejected) == [(2, "Experiment does not exist"), (4, "Experiment does not exist")]
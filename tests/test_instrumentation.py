@@ -0,0 +1,38 @@
+from flask import g
+from pytest import raises
+
+from app.instrumentation import QueryBudgetExceeded
+from app.proxies import get_redis
+
+
+def test_server_timing_header(db, client, experiment):
+    resp = client.get('/experiments')
+    assert resp.status_code == 200
+    timing = resp.headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'queries' in timing
+    assert 'redis;desc="0 calls"' in timing
+    assert 'total;dur=' in timing
+
+
+def test_request_stats_count_statements_and_redis(app, db):
+    with app.test_request_context('/experiments'):
+        app.preprocess_request()
+        db.session.execute("select 1").fetchall()
+        db.session.execute("select generate_series(1, 3)").fetchall()
+        get_redis().ping()
+        get_redis().pipeline().ping().ping().execute()
+        assert g.request_stats.statements == 2
+        assert g.request_stats.rows == 4
+        assert g.request_stats.redis_calls == 2
+        assert g.request_stats.db_seconds > 0
+
+
+def test_query_budget_is_strict_in_tests(app, db, client, experiment):
+    budgets = app.config['QUERY_BUDGETS']
+    app.config['QUERY_BUDGETS'] = {**budgets, '/experiments': 0}
+    try:
+        with raises(QueryBudgetExceeded):
+            client.get('/experiments')
+    finally:
+        app.config['QUERY_BUDGETS'] = budgets
@@ -0,0 +1,41 @@
+import pytest
+
+from prometheus_client import REGISTRY
+
+from app.metrics import size_bucket
+
+
+@pytest.fixture()
+def metrics_token(app):
+    app.config['METRICS_TOKEN'] = 'secret'
+    yield 'secret'
+    app.config['METRICS_TOKEN'] = None
+
+
+def test_size_bucket():
+    assert size_bucket(10) == '<1k'
+    assert size_bucket(1000) == '<10k'
+    assert size_bucket(10 ** 6) == '>=100k'
+
+
+def test_metrics_requires_token(db, app, client, metrics_token):
+    assert client.get('/metrics').status_code == 403
+
+    app.config['METRICS_TOKEN'] = None
+    resp = app.test_client().get('/metrics', headers={'Authorization': 'Bearer '})
+    assert resp.status_code == 403
+
+
+def test_metrics(db, app, client, experiment, metrics_token):
+    labels = {'method': 'GET', 'route': '/experiments', 'status': '200'}
+    before = REGISTRY.get_sample_value('quicksplit_request_duration_seconds_count', labels) or 0
+    client.get('/experiments')
+    assert REGISTRY.get_sample_value('quicksplit_request_duration_seconds_count', labels) == before + 1
+
+    resp = app.test_client().get('/metrics', headers={'Authorization': f"Bearer {metrics_token}"})
+    assert resp.status_code == 200
+    assert resp.content_type.startswith('text/plain')
+    body = resp.data.decode()
+    assert 'quicksplit_request_duration_seconds_bucket{' in body
+    assert 'quicksplit_pool_connections{pool="database",state="checked_out"}' in body
+    assert 'quicksplit_queue_jobs{queue="default"}' in body
@@ -57,6 +57,17 @@ def test_experiment_create_duplicate(user, db, experiment):
         experiment2 = Experiment.create(name=experiment.name, user=user)
 
 
+def test_experiment_find_by_name(user, db, experiment):
+    assert Experiment.find_by_name(user, experiment.name) == experiment
+    assert Experiment.find_by_name(user, "missing") is None
+
+
+def test_token_find_by_value(user, db):
+    token = user.tokens[0]
+    assert Token.find_by_value(token.value) == token
+    assert Token.find_by_value(str(token.value)) == token
+
+
 def test_subject_init(db, user, production_scope):
     subject = Subject(name='test-subject-1', account=user.account, scope=production_scope)
     db.session.add(subject)
@@ -160,6 +171,14 @@ def test_exposure_create_staging(db, app, user, experiment, cohort, subject_stag
         # assert exposure_duplicate.last_seen_at != exposure_duplicate.created_at
 
 
+def test_exposure_lookups(db, user, subject, experiment, exposure, conversion, production_scope):
+    assert Subject.find_by_name(user.account_id, subject.name) == subject
+    assert Exposure.find_created_at(subject.id, experiment.id, production_scope.id) == exposure.created_at
+    assert Exposure.lock_id(subject.id, experiment.id) == exposure.id
+    assert Conversion.find_created_at(exposure.id, production_scope.id) == conversion.created_at
+    assert Conversion.find_created_at(conversion.id, production_scope.id) is None
+
+
 def test_conversion_init(db, exposure, production_scope):
     conversion = Conversion(exposure=exposure, scope=production_scope)
     db.session.add(conversion)
@@ -0,0 +1,50 @@
+import datetime as dt
+
+from app.partitions import (
+    create_partition, detach_partitions, list_partitions, partition_name,
+    default_partition_rows
+)
+from app.commands import create_partitions as create_partitions_command
+
+
+def test_partition_name():
+    assert partition_name('exposure', dt.date(2020, 3, 1)) == 'exposure_y2020m03'
+
+
+def test_default_partitions_exist(db):
+    assert 'exposure_default' in list_partitions('exposure')
+    assert 'conversion_default' in list_partitions('conversion')
+
+
+def test_create_and_detach_partition(db):
+    month = dt.date(2099, 1, 15)
+    assert create_partition('exposure', month) == 'exposure_y2099m01'
+    assert create_partition('exposure', month) is None
+    assert 'exposure_y2099m01' in list_partitions('exposure')
+
+    assert detach_partitions('exposure', dt.date(2099, 1, 31)) == []
+    assert detach_partitions('exposure', dt.date(2099, 2, 1)) == ['exposure_y2099m01']
+    assert 'exposure_y2099m01' not in list_partitions('exposure')
+
+
+def test_exposures_land_in_default_partition(db, exposure):
+    # The test database only has default partitions
+    assert default_partition_rows('exposure') >= 1
+
+
+def test_exposure_create_deduplicates_on_partitioned_table(db, client, experiment):
+    for _ in range(2):
+        resp = client.post('/exposures', json={
+            'experiment': experiment.name,
+            'subject': 'partitioned-subject',
+            'cohort': 'control'
+        })
+        assert resp.status_code == 200
+    assert experiment.exposures.count() == 1
+
+
+def test_create_partitions_command(app, db):
+    runner = app.test_cli_runner()
+    result = runner.invoke(create_partitions_command, ['--months', '1', '--start', '2098-06-01'])
+    assert "exposure_y2098m06" in result.output
+    assert "conversion_y2098m06" in result.output
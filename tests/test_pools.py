@@ -0,0 +1,40 @@
+from app.pools import PoolStats, InstrumentedRedisPool
+from app.proxies import get_redis, get_worker
+
+
+def test_pool_stats_record():
+    stats = PoolStats()
+    stats.record(0.5)
+    stats.record(0.25, timed_out=True)
+    assert stats.as_dict() == {
+        'checkouts': 2,
+        'timeouts': 1,
+        'wait_seconds': 0.75,
+        'max_wait_seconds': 0.5
+    }
+
+
+def test_redis_client_is_shared_across_requests(app):
+    with app.test_request_context():
+        first = get_redis()
+        queue = get_worker()
+    with app.test_request_context():
+        assert get_redis() is first
+        assert get_worker() is queue
+    assert queue.connection is first
+
+
+def test_redis_pool_is_configured(app):
+    with app.app_context():
+        pool = get_redis().connection_pool
+        assert isinstance(pool, InstrumentedRedisPool)
+        assert pool.max_connections == app.config['REDIS_MAX_CONNECTIONS']
+
+
+def test_redis_pool_records_checkouts(app):
+    with app.app_context():
+        pool = get_redis().connection_pool
+        checkouts = pool.stats.checkouts
+        get_redis().ping()
+        assert pool.stats.checkouts == checkouts + 1
+        assert pool.describe()['connections'] >= 1
@@ -0,0 +1,80 @@
+import os
+import threading
+
+import pytest
+
+from app.commands import profile
+from app.profiling import StackSampler
+
+
+@pytest.fixture()
+def profiling(app, tmp_path):
+    app.config['PROFILE_REQUESTS'] = True
+    app.config['PROFILE_DIR'] = str(tmp_path)
+    yield
+    app.config['PROFILE_REQUESTS'] = False
+
+
+@pytest.fixture()
+def admin_client(app, user):
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = str(user.admin_token.value)
+    return client
+
+
+def test_profile_header(db, admin_client, profiling, tmp_path):
+    resp = admin_client.get('/experiments', headers={'X-Profile': 'true'})
+    assert resp.status_code == 200
+    assert resp.json['data'] is not None
+    assert (tmp_path / resp.headers['X-Profile-File']).exists()
+
+
+def test_profile_header_text(db, admin_client, profiling):
+    resp = admin_client.get('/experiments', headers={'X-Profile': 'true', 'X-Profile-Format': 'text'})
+    assert resp.content_type.startswith('text/plain')
+    assert 'cumulative' in resp.data.decode()
+
+
+def test_profile_header_only_for_admins(db, app, user, admin_client, profiling):
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = str([t for t in user.tokens if not t.private][0].value)
+    resp = client.get('/experiments', headers={'X-Profile': 'true'})
+    assert 'X-Profile-File' not in resp.headers
+
+    app.config['PROFILE_REQUESTS'] = False
+    resp = admin_client.get('/experiments', headers={'X-Profile': 'true'})
+    assert resp.status_code == 200
+    assert 'X-Profile-File' not in resp.headers
+
+
+def test_stack_sampler(tmp_path):
+    sampler = StackSampler(str(tmp_path))
+    # The sampler skips its own thread, so sample this one from another
+    thread = threading.Thread(target=sampler.sample)
+    thread.start()
+    thread.join()
+    assert sum(sampler.stacks.values()) >= 1
+    assert any('test_stack_sampler (test_profiling.py' in stack for stack in sampler.stacks)
+
+    sampler.flush()
+    lines = open(sampler.path).read().splitlines()
+    assert len(lines) == len(sampler.stacks)
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) >= 1
+
+
+def test_stack_sampler_toggle(tmp_path):
+    sampler = StackSampler(str(tmp_path), interval=0.001)
+    sampler.toggle()
+    assert sampler.running
+    sampler.toggle()
+    assert not sampler.running
+    assert os.path.exists(sampler.path)
+
+
+def test_profile_command(db, app, user):
+    runner = app.test_cli_runner()
+    result = runner.invoke(profile, ['/experiments', '-n', '2', '--token', str(user.admin_token.value)])
+    assert result.exit_code == 0, result.output
+    assert 'GET /experiments: 200, 2 requests' in result.output
+    assert 'cumulative' in result.output
@@ -0,0 +1,87 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app.models import db as _db
+
+
+JOIN = re.compile(r'\bjoin\b', re.IGNORECASE)
+EVENT_TABLES = re.compile(r'\b(from|join)\s+(exposure|conversion)\b', re.IGNORECASE)
+
+
+@contextmanager
+def recorded_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lower().startswith(('savepoint', 'release savepoint', 'rollback to savepoint')):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+# (method, route, json, max statements, max joins in any one statement)
+#
+# Routes that call stripe (/user POST, /account/payment-setup, /account/plan
+# PATCH and /webhooks/stripe) are covered by the billing tests instead. The
+# raw sql behind /recent and POST /results joins the event tables on purpose.
+# Beacons carry a public token in their body instead of a header.
+BUDGETS = [
+    ('get', '/', None, 3, 3),
+    ('get', '/user', None, 8, 3),
+    ('get', '/experiments', None, 8, 3),
+    ('post', '/experiments', {'name': 'budgeted'}, 12, 3),
+    ('get', '/experiments/config', None, 5, 3),
+    ('get', '/experiments/Test%20Experiment/export', None, 8, 3),
+    ('post', '/exposures', {'experiment': 'Test Experiment', 'subject': 'budgeted', 'cohort': 'experimental'}, 18, 3),
+    ('post', '/conversions', {'experiment': 'Test Experiment', 'subject': 'test-subject-1', 'value': 1.0}, 18, 3),
+    ('post', '/assign', {'experiment': 'Test Experiment', 'subject': 'budgeted'}, 10, 3),
+    ('post', '/beacon', {'token': '{public_token}', 'exposures': [
+        {'experiment': 'Test Experiment', 'subject': 'budgeted', 'cohort': 'experimental'}
+    ]}, 3, 3),
+    ('get', '/results', None, 5, 3),
+    ('post', '/results', {'experiment': 'Test Experiment'}, 16, 6),
+    ('get', '/results/{experiment_result_id}', None, 5, 3),
+    ('post', '/activate', {'experiment': 'Test Experiment'}, 8, 3),
+    ('post', '/deactivate', {'experiment': 'Test Experiment'}, 8, 3),
+    ('get', '/tokens', None, 5, 3),
+    ('get', '/recent', None, 5, 10),
+    ('post', '/events', {'name': 'budgeted'}, 5, 3),
+    ('get', '/plans', None, 6, 3),
+    ('get', '/account/plan', None, 5, 3),
+    ('post', '/login', {'email': 'tester@quicksplit.io', 'password': 'password'}, 6, 3),
+    ('post', '/sessions', {'email': 'tester@quicksplit.io', 'password': 'password'}, 8, 3),
+    ('get', '/summaries/exposures', None, 5, 3),
+]
+
+
+@pytest.mark.parametrize('method,route,data,max_statements,max_joins', BUDGETS)
+def test_resource_query_budget(db, client, user, experiment, exposure, conversion, experiment_result, exposures_rollup,
+                               method, route, data, max_statements, max_joins):
+    route = route.format(experiment_result_id=experiment_result.id)
+    if data and data.get('token') == '{public_token}':
+        public = [t for t in user.tokens if t.environment == 'production' and not t.private][0]
+        data = dict(data, token=str(public.value))
+    with recorded_statements(_db.engine) as statements:
+        resp = getattr(client, method)(route, json=data)
+        # Exports stream their rows
+        resp.get_data()
+    assert resp.status_code in (200, 204), resp.get_data(as_text=True)
+
+    assert len(statements) <= max_statements, "\n\n".join(statements)
+    joins = max((len(JOIN.findall(statement)) for statement in statements), default=0)
+    assert joins <= max_joins, "\n\n".join(statements)
+
+
+def test_experiment_loads_no_event_tables(db, experiment, exposure):
+    db.session.expunge_all()
+    with recorded_statements(_db.engine) as statements:
+        experiment = type(experiment).query.get(experiment.id)
+    assert len(statements) == 1
+    assert not EVENT_TABLES.search(statements[0])
@@ -0,0 +1,53 @@
+from benchmarks.plans import compare_plans, describe, shape, summarize_plan
+
+
+def index_scan(relation, index):
+    return {'Node Type': 'Index Scan', 'Relation Name': relation, 'Index Name': index}
+
+
+EXPLAINED = {
+    'Plan': {
+        'Node Type': 'Append',
+        'Shared Hit Blocks': 40,
+        'Shared Read Blocks': 2,
+        'Plans': [
+            index_scan('exposure_y2020m03', 'exposure_y2020m03_subject_id_idx'),
+            index_scan('exposure_y2020m04', 'exposure_y2020m04_subject_id_idx'),
+            {'Node Type': 'Seq Scan', 'Relation Name': 'exposure_default'},
+        ],
+    },
+    'Planning Time': 0.1,
+    'Execution Time': 0.5,
+}
+
+
+def test_shape_ignores_partitions():
+    assert shape(EXPLAINED['Plan']) == (
+        "Append(Index Scan on exposure_partition using exposure_partition_subject_id_idx, "
+        "Seq Scan on exposure_partition)"
+    )
+
+
+def test_summarize_plan():
+    plan = summarize_plan(EXPLAINED)
+    assert plan['buffers'] == 42
+    assert plan['seq_scans'] == ['exposure']
+    assert plan['execution_ms'] == 0.5
+
+
+def test_describe():
+    assert describe('INSERT INTO subject (account_id) VALUES (%(account_id)s)') == 'insert subject'
+    assert describe('SELECT exposure.created_at \nFROM exposure WHERE') == 'select exposure'
+
+
+def test_compare_plans():
+    indexed = summarize_plan({'Plan': dict(index_scan('subject', 'subject_name_idx'), **{'Shared Hit Blocks': 4})})
+    scanned = summarize_plan({'Plan': {'Node Type': 'Seq Scan', 'Relation Name': 'subject', 'Shared Hit Blocks': 4000}})
+
+    degraded, changed = compare_plans({'lookup': indexed}, {'lookup': indexed}, tolerance=0.5)
+    assert degraded == [] and changed == []
+
+    degraded, changed = compare_plans({'lookup': indexed}, {'lookup': scanned}, tolerance=0.5)
+    assert len(degraded) == 2
+    assert 'sequential scan of subject' in degraded[0]
+    assert len(changed) == 1
@@ -0,0 +1,73 @@
+import pytest
+from flask import g
+
+from app import replicas
+from app.models import db as _db, Experiment, ExposureRollup
+
+
+@pytest.fixture(autouse=True)
+def app_context(app):
+    # `g` lives on the app context, which test_request_context reuses when
+    # one is pushed already, like the session's in conftest. A fresh one
+    # keeps g.read_only from leaking between tests.
+    with app.app_context():
+        yield
+
+
+@pytest.fixture()
+def replica(app):
+    # The same database on a second url is enough to test routing
+    app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+    max_lag = app.config['REPLICA_MAX_LAG_SECONDS']
+    replicas._lag['checked_at'] = None
+    with app.app_context():
+        yield _db.get_engine(app, bind='replica')
+    app.config['SQLALCHEMY_BINDS'] = {}
+    app.config['REPLICA_MAX_LAG_SECONDS'] = max_lag
+    replicas._lag['checked_at'] = None
+
+
+def test_no_replica_configured(app):
+    with app.test_request_context():
+        g.read_only = True
+        assert replicas.replica_bind() is None
+        assert _db.session.get_bind(mapper=Experiment.__mapper__) is _db.engine
+
+
+def test_read_only_requests_use_replica(app, replica):
+    with app.test_request_context():
+        assert _db.session.get_bind(mapper=Experiment.__mapper__) is _db.engine
+        g.read_only = True
+        assert _db.session.get_bind(mapper=Experiment.__mapper__) is replica
+        assert _db.session.get_bind(clause=_db.text("select 1")) is replica
+
+
+def test_writes_pin_to_primary(app, replica, db, user):
+    with app.test_request_context():
+        g.read_only = True
+        experiment = Experiment(name="pinned", user=user)
+        db.session.add(experiment)
+        db.session.flush()
+        assert g.pinned_to_primary
+        assert db.session.get_bind(mapper=ExposureRollup.__mapper__) is db.engine
+        assert replicas.replica_bind(ignore_writes=True) is replica
+
+
+def test_lagging_replica_falls_back_to_primary(app, replica):
+    assert replicas.replica_lag(replica) == 0
+    app.config['REPLICA_MAX_LAG_SECONDS'] = -1
+    with app.test_request_context():
+        g.read_only = True
+        assert replicas.replica_bind() is None
+        assert _db.session.get_bind(mapper=Experiment.__mapper__) is _db.engine
+
+
+def test_read_only_decorator(app):
+
+    @replicas.read_only
+    def view():
+        return g.read_only
+
+    with app.test_request_context():
+        assert not g.get('read_only')
+        assert view()
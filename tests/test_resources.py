@@ -1,9 +1,18 @@
+import datetime as dt
+import gzip
+import json
+import uuid
+
 from flask import request
 from pytest import raises
 
 from app.resources import params
-from app.models import User, Experiment, Exposure, Conversion, Scope, Contact, Subject, Cohort
+from app.models import (
+    User, Experiment, Exposure, Conversion, Scope, Contact, Subject, Cohort, Event, _create_events_async
+)
 from app.exceptions import ApiException
+from app.assignment import pick
+from app.proxies import get_redis
 
 
 def test_params_decorator(app):
@@ -75,6 +84,24 @@ def test_experiment_get(db, client, experiment):
     assert str(experiment.id) == resp.json['data'][0]['id']
 
 
+def test_experiment_get_paginated(db, client, user, experiment):
+    for name in ['Test Experiment 2', 'Test Experiment 3']:
+        client.post('/experiments', json={'name': name})
+
+    resp = client.get('/experiments?limit=2')
+    assert resp.status_code == 200
+    assert [e['name'] for e in resp.json['data']] == ['Test Experiment', 'Test Experiment 2']
+    cursor = resp.headers['X-Next-Cursor']
+
+    resp = client.get(f'/experiments?limit=2&after={cursor}')
+    assert resp.status_code == 200
+    assert [e['name'] for e in resp.json['data']] == ['Test Experiment 3']
+    assert 'X-Next-Cursor' not in resp.headers
+
+    assert client.get('/experiments?limit=0').status_code == 422
+    assert client.get('/experiments?limit=2&after=%25').status_code == 422
+
+
 def test_experiment_post(db, client):
     resp = client.post('/experiments', json={
         'name': "My first experiment"
@@ -83,6 +110,35 @@ def test_experiment_post(db, client):
     assert Experiment.query.get(resp.json['data']['id']) is not None
 
 
+def test_experiment_post_cohorts(db, client):
+    resp = client.post('/experiments', json={'name': "Weighted", 'cohorts': {'control': 3, 'treatment': 1}})
+    assert resp.status_code == 200
+    experiment = Experiment.query.get(resp.json['data']['id'])
+    assert sorted((c.name, c.weight) for c in experiment.cohorts) == [('control', 3), ('treatment', 1)]
+
+    resp = client.post('/experiments', json={'name': "Invalid", 'cohorts': {'control': 0}})
+    assert resp.status_code == 422
+
+
+def test_experiments_config_get(db, client, experiment, cohort):
+    resp = client.get('/experiments/config')
+    assert resp.status_code == 200
+    assert resp.json['data']['experiments'] == {
+        experiment.name: {'id': str(experiment.id), 'cohorts': [['experimental', 1.0]]}
+    }
+    etag = resp.headers['ETag']
+
+    resp = client.get('/experiments/config', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+    cohort.weight = 2
+    db.session.flush()
+    resp = client.get('/experiments/config', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
 def test_experiment_post_duplicate(db, client, experiment):
     resp = client.post('/experiments', json={
         'name': experiment.name
@@ -102,6 +158,28 @@ def test_experiment_post_over_active_limits(db, client, user):
     assert len(list(filter(lambda x: not x.active, experiments))) == 1
 
 
+def test_experiment_export(db, client, experiment, subject, exposure, conversion):
+    resp = client.get(f'/experiments/{experiment.name}/export')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    assert 'Test-Experiment-production.ndjson' in resp.headers['Content-Disposition']
+    rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert len(rows) == 1
+    assert rows[0]['subject'] == subject.name
+    assert rows[0]['cohort'] == exposure.cohort.name
+    assert rows[0]['conversion_value'] == 30.0
+
+    resp = client.get(f'/experiments/{experiment.name}/export?format=csv', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.decompress(resp.data).decode().splitlines()
+    assert lines[0].startswith('subject,cohort,exposed_at')
+    assert lines[1].startswith(f'{subject.name},{exposure.cohort.name},')
+
+    assert client.get(f'/experiments/{experiment.name}/export?format=xml').status_code == 422
+    assert client.get('/experiments/missing/export').status_code == 404
+
+
 def test_exposures_post(db, client, experiment, subject, cohort):
     resp = client.post('/exposures', json={
         'experiment': experiment.name,
@@ -246,6 +324,204 @@ def test_conversions_post_inactive_experiment(db, client, experiment, exposure,
     assert exposure.conversion.value == conversion.value
 
 
+class Worker(object):
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, f, args=()):
+        self.jobs.append((f, args))
+
+
+def test_assign_post(db, client, experiment, cohort, subject, exposure, monkeypatch):
+    worker = Worker()
+    monkeypatch.setattr('app.models.worker', worker)
+    db.session.add(Cohort(name='control', experiment=experiment, weight=3))
+    db.session.flush()
+
+    resp = client.post('/assign', json={'experiment': experiment.name, 'subject': 'new-subject'})
+    assert resp.status_code == 200
+    cohort_name = resp.json['data']['cohort']
+    assert cohort_name == pick(experiment.id, 'new-subject', experiment.weighted_cohorts())
+    assert len(worker.jobs) == 1
+
+    # Repeats are answered from the cache
+    resp = client.post('/assign', json={'experiment': experiment.name, 'subject': 'new-subject'})
+    assert resp.json['data']['cohort'] == cohort_name
+
+    # Subjects that were already exposed keep their cohort, and their
+    # exposure waits for the job that's already queued
+    resp = client.post('/assign', json={'experiment': experiment.name, 'subject': subject.name})
+    assert resp.json['data']['cohort'] == exposure.cohort.name
+    assert len(worker.jobs) == 1
+
+    drain, args = worker.jobs[0]
+    drain(*args)
+    assert Subject.query.filter(Subject.name=='new-subject').one().exposures.one().cohort.name == cohort_name
+    assert experiment.exposures.count() == 2
+
+    # The cache isn't used once the experiment is deactivated
+    experiment.deactivate()
+    resp = client.post('/assign', json={'experiment': experiment.name, 'subject': 'new-subject'})
+    assert resp.status_code == 422
+
+    resp = client.post('/assign', json={'experiment': 'missing', 'subject': 'new-subject'})
+    assert resp.status_code == 404
+
+
+def test_write_behind_keeps_failed_batches(db, client, experiment, monkeypatch):
+    worker = Worker()
+    monkeypatch.setattr('app.models.worker', worker)
+    token_value = client.environ_base['HTTP_AUTHORIZATION']
+    record = {'experiment': experiment.name, 'subject': 'pending', 'cohort': 'control',
+              'created_at': dt.datetime.now(dt.timezone.utc)}
+    Exposure.write_behind(record, token_value=token_value)
+    Exposure.write_behind(record, token_value=token_value)
+    assert len(worker.jobs) == 1
+
+    def fail(token_value, records, skip_invalid=False):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(Exposure, '_create_batch_async', fail)
+    drain, args = worker.jobs[0]
+    with raises(RuntimeError):
+        drain(*args)
+    assert get_redis().llen(Exposure.pending_key(token_value)) == 2
+
+    # The next push queues another job for them
+    Exposure.write_behind(record, token_value=token_value)
+    assert len(worker.jobs) == 2
+    assert get_redis().ttl(Exposure.pending_key(token_value) + ':queued') > 0
+    get_redis().delete(Exposure.pending_key(token_value), Exposure.pending_key(token_value) + ':queued')
+
+
+def test_beacon(db, app, user, experiment, monkeypatch):
+    queued = []
+    monkeypatch.setattr('app.resources.create_events_async',
+                        lambda token_value, exposures, conversions: queued.append((token_value, exposures, conversions)))
+    token = [t for t in user.tokens if t.environment == 'production' and not t.private][0]
+    payload = json.dumps({
+        'token': str(token.value),
+        'exposures': [{'experiment': experiment.name, 'subject': 'beacon-subject', 'cohort': 'control'}],
+        'conversions': [{'experiment': experiment.name, 'subject': 'beacon-subject', 'value': '2.5'}],
+    })
+    client = app.test_client()
+
+    resp = client.post('/beacon', data=payload, content_type='text/plain')
+    assert resp.status_code == 204
+    assert [(token_value, len(exposures), len(conversions)) for token_value, exposures, conversions in queued] == [
+        (str(token.value), 1, 1)
+    ]
+    assert queued[0][2][0]['value'] == 2.5
+
+    # Once the token is known to be public, answered without touching the database
+    resp = client.get('/beacon', query_string={'d': payload})
+    assert resp.status_code == 204
+    assert 'db;dur=0.00;desc="0 queries' in resp.headers['Server-Timing']
+    assert len(queued) == 2
+
+    private = [t for t in user.tokens if t.private][0]
+    assert client.post('/beacon', data=json.dumps({'token': str(private.value)})).status_code == 403
+    assert client.post('/beacon', data=json.dumps({'token': str(uuid.uuid4())})).status_code == 403
+    assert client.post('/beacon', data='not json', content_type='text/plain').status_code == 400
+    assert client.post('/beacon', data=json.dumps({'token': 'abc'})).status_code == 403
+    assert client.post('/beacon', data='x' * (app.config['MAX_BEACON_BYTES'] + 1)).status_code == 413
+    assert len(queued) == 2
+
+
+def test_beacon_job(db, user, experiment):
+    token = [t for t in user.tokens if t.environment == 'production' and not t.private][0]
+    now = dt.datetime.now(dt.timezone.utc)
+    # The conversion finds the exposure written just before it
+    result = _create_events_async(
+        str(token.value),
+        [{'experiment': experiment.name, 'subject': 'beacon-subject', 'cohort': 'control', 'created_at': now}],
+        [{'experiment': experiment.name, 'subject': 'beacon-subject', 'value': 2.5, 'created_at': now}],
+    )
+    assert result['exposures']['created'] == 1
+    assert result['conversions']['created'] == 1
+
+    private = [t for t in user.tokens if t.private][0]
+    with raises(ApiException) as exc:
+        _create_events_async(str(private.value), [], [])
+    assert exc.value.status_code == 403
+
+
+def test_exposures_post_batch(db, client, experiment, subject, exposure):
+    resp = client.post('/exposures', json=[
+        {'experiment': experiment.name, 'subject': subject.name, 'cohort': 'control'},
+        {'experiment': experiment.name, 'subject': 'imported-1', 'cohort': 'control',
+         'created_at': '2020-03-01T12:00:00+00:00'},
+        {'experiment': experiment.name, 'subject': 'imported-1', 'cohort': 'experimental',
+         'created_at': '2020-03-02T12:00:00'},
+        {'experiment': experiment.name, 'subject': 'imported-2', 'cohort': 'experimental',
+         'created_at': '2020-03-03T12:00:00Z'},
+    ])
+    assert resp.status_code == 200
+    assert resp.json['data'] == {'created': 2, 'updated': 1}
+    assert experiment.exposures.count() == 3
+    assert experiment.subjects_counter_production == 3
+    # Exposures imported from the past don't become the latest
+    assert Exposure.query.get(experiment.last_exposure_id_production).subject.name != 'imported-1'
+
+    imported = Subject.query.filter(Subject.name=='imported-1').one()
+    imported_exposure = imported.exposures.one()
+    assert imported_exposure.cohort.name == 'control'
+    assert imported_exposure.created_at.day == 1
+    assert imported_exposure.last_seen_at.day == 2
+    assert imported.last_exposure_id_production == imported_exposure.id
+    assert Subject.query.filter(Subject.name=='imported-2').one().exposures.one().created_at.day == 3
+
+    resp = client.post('/exposures', json=[{'experiment': "missing", 'subject': 'a', 'cohort': 'control'}])
+    assert resp.status_code == 404
+    resp = client.post('/exposures', json=[{'experiment': experiment.name, 'subject': 'a'}])
+    assert resp.status_code == 422
+
+
+def test_conversions_post_batch(db, client, experiment, subject, exposure):
+    resp = client.post('/conversions', json=[
+        {'experiment': experiment.name, 'subject': subject.name, 'value': '12.5'},
+        {'experiment': experiment.name, 'subject': subject.name, 'value': 20},
+    ])
+    assert resp.status_code == 200
+    assert resp.json['data'] == {'created': 1, 'updated': 0}
+    db.session.refresh(exposure)
+    assert exposure.conversion.value == 12.5
+    assert experiment.last_conversion_id_production == exposure.conversion.id
+
+    resp = client.post('/conversions', json=[{'experiment': experiment.name, 'subject': subject.name}])
+    assert resp.json['data'] == {'created': 0, 'updated': 1}
+    resp = client.post('/conversions', json=[{'experiment': experiment.name, 'subject': 'unexposed'}])
+    assert resp.status_code == 404
+
+
+def test_post_batch_skip_invalid(db, client, experiment, subject, exposure):
+    resp = client.post('/exposures?skip_invalid=true', json=[
+        {'experiment': "missing", 'subject': 'a', 'cohort': 'control'},
+        {'experiment': experiment.name, 'subject': 'skipped-1', 'cohort': 'control'},
+    ])
+    assert resp.status_code == 200
+    assert resp.json['data'] == {'created': 1, 'updated': 0,
+                                 'rejected': [{'index': 0, 'message': "Experiment does not exist"}]}
+
+    resp = client.post('/conversions?skip_invalid=true', json=[
+        {'experiment': experiment.name, 'subject': 'unknown'},
+        {'experiment': experiment.name, 'subject': subject.name, 'value': 1},
+        {'experiment': "missing", 'subject': subject.name},
+    ])
+    assert resp.status_code == 200
+    assert resp.json['data']['created'] == 1
+    assert [r['index'] for r in resp.json['data']['rejected']] == [0, 2]
+
+    # New subjects over the limit are left out, exposed ones still count
+    experiment.subjects_counter_production = experiment.user.account.plan.max_subjects_per_experiment
+    db.session.flush()
+    resp = client.post('/exposures?skip_invalid=true', json=[
+        {'experiment': experiment.name, 'subject': subject.name, 'cohort': 'control'},
+        {'experiment': experiment.name, 'subject': 'over-limit', 'cohort': 'control'},
+    ])
+    assert resp.json['data'] == {'created': 0, 'updated': 1,
+                                 'rejected': [{'index': 1, 'message': "Experiment has reached max exposures limit"}]}
+
+
 def test_results_get(db, client, experiment, exposure, conversion, experiment_result):
     resp = client.get('/results')
     assert resp.status_code == 200
@@ -436,6 +712,27 @@ def test_events_resource_post(db, client, user):
     assert resp.json['data']['user_id'] == None
 
 
+def test_events_resource_post_batch(db, client, user):
+    before = Event.query.count()
+    resp = client.post('/events', json=[
+        {'name': "batched event"},
+        {'name': "batched event", 'user_id': str(user.id), 'data': {'a': 1}, 'created_at': '2020-04-01T12:00:00+00:00'},
+    ])
+    assert resp.status_code == 200
+    assert resp.json['data'] == {'created': 2}
+    assert Event.query.count() == before + 2
+    event = Event.query.filter(Event.user_id==user.id).filter(Event.name=="batched event").one()
+    assert event.data == {'a': 1}
+    assert event.created_at.year == 2020
+
+    assert client.post('/events', json=[{'data': {}}]).status_code == 422
+    assert client.post('/events', json=[{'name': "event", 'password': "secret"}]).status_code == 422
+    assert client.post('/events', json=[{'name': "event", 'created_at': "yesterday"}]).status_code == 422
+    assert client.post('/events', json=[{'name': "event", 'user_id': "nobody"}]).status_code == 422
+    assert client.post('/events', json=[{'name': {'nested': True}}]).status_code == 422
+    assert client.post('/events', json=[]).status_code == 422
+
+
 def test_plans_resource_get(db, client, user):
     # Changing this number will break the front end styles
     expected_public_plan_count = 6
@@ -452,3 +749,27 @@ def test_contacts_resource_post(db, client, user):
     })
     assert resp.status_code == 200
     assert resp.json['data']['job']['id'] is not None
+
+
+def test_gzipped_request_body(db, client, experiment):
+    body = gzip.compress(json.dumps({
+        'experiment': experiment.name,
+        'subject': 'gzipped-subject',
+        'cohort': 'control'
+    }).encode())
+    resp = client.post('/exposures', data=body, headers={
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip'
+    })
+    assert resp.status_code == 200
+    assert resp.json['data']['subject']['subject_id'] == 'gzipped-subject'
+
+
+def test_gzipped_request_body_limits(db, app, client, monkeypatch):
+    resp = client.post('/experiments', data=b'not gzip', headers={'Content-Encoding': 'gzip'})
+    assert resp.status_code == 400
+
+    monkeypatch.setitem(app.config, 'MAX_DECOMPRESSED_BYTES', 10)
+    resp = client.post('/experiments', data=gzip.compress(b'{"name": "' + b'a' * 100 + b'"}'),
+                       headers={'Content-Encoding': 'gzip'})
+    assert resp.status_code == 413
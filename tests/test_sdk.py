@@ -0,0 +1,62 @@
+import collections
+import uuid
+
+import app.assignment
+from cli.sdk import Assigner, bucket, pick
+
+
+class Response(object):
+    def __init__(self, status_code, data=None, etag=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.data = data
+        self.headers = {'ETag': etag} if etag else {}
+
+    def json(self):
+        return {'data': self.data}
+
+
+class Session(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers, timeout):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+CONFIG = {'experiments': {'button': {'id': 'a1', 'cohorts': [['control', 3], ['treatment', 1]]}}}
+
+
+def test_pick_is_stable_and_weighted():
+    cohorts = CONFIG['experiments']['button']['cohorts']
+    assert pick('a1', 'subject-1', cohorts) == pick('a1', 'subject-1', cohorts)
+    counts = collections.Counter(pick('a1', f'subject-{i}', cohorts) for i in range(20000))
+    assert 0.72 < counts['control'] / 20000 < 0.78
+    assert 0 <= bucket('a1', 'subject-1') < 1
+    assert pick('a1', 'subject-1', []) is None
+
+
+def test_pick_matches_the_api():
+    # Services assigning with the sdk and POST /assign must agree
+    for cohorts in ([['control', 1], ['treatment', 1]], [['a', 0.2], ['b', 5], ['c', 1.3]], [['only', 1]]):
+        for n in range(50):
+            salt = uuid.uuid4()
+            for subject in (f'subject-{n}', n, 'ünïcode'):
+                assert pick(salt, subject, cohorts) == app.assignment.pick(salt, subject, cohorts)
+
+
+def test_assigner_refreshes_conditionally():
+    session = Session(Response(200, CONFIG, etag='"v1"'), Response(304))
+    logged = []
+    assigner = Assigner('token', api_url='http://api', refresh_interval=0, session=session,
+                        log=lambda kind, record: logged.append((kind, record)))
+    cohort = assigner.expose('button', 'subject-1')
+    assert cohort in ('control', 'treatment')
+    assert logged == [('exposures', {'experiment': 'button', 'subject': 'subject-1', 'cohort': cohort})]
+    assert assigner.assign('missing', 'subject-1') is None
+
+    assert assigner.refresh() is False
+    assert session.requests[-1]['If-None-Match'] == '"v1"'
+    assert assigner.assign('button', 'subject-1') == cohort
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+import cli.sender
+from cli.sender import BufferedSender
+
+
+class Response(object):
+    def __init__(self, status_code, rejected=()):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.rejected = rejected
+
+    def json(self):
+        return {'data': {'rejected': [{'index': index, 'message': "Rejected"} for index in self.rejected]}}
+
+
+class Session(object):
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.requests = []
+        self.threads = []
+        self.sent = threading.Event()
+
+    def post(self, url, json, headers, timeout):
+        self.requests.append((url, json))
+        self.threads.append(threading.current_thread().name)
+        self.sent.set()
+        response = self.status_codes.pop(0) if self.status_codes else 200
+        if isinstance(response, Exception):
+            raise response
+        return response if isinstance(response, Response) else Response(response)
+
+
+def test_sender_flushes_full_batches():
+    session = Session()
+    sender = BufferedSender('token', api_url='http://api', batch_size=2, flush_interval=60, session=session)
+    sender.send('exposures', {'experiment': 'e', 'subject': 's1', 'cohort': 'a'})
+    sender.send('conversions', {'experiment': 'e', 'subject': 's1', 'value': 1})
+    assert session.sent.wait(5)
+    sender.close()
+    assert sorted(url for url, _ in session.requests) == ['http://api/conversions?skip_invalid=true',
+                                                          'http://api/exposures?skip_invalid=true']
+    assert all('created_at' in records[0] for _, records in session.requests)
+    assert sender.stats['sent'] == 2
+
+
+def test_sender_flushes_on_close():
+    session = Session()
+    sender = BufferedSender('token', api_url='http://api', flush_interval=60, session=session)
+    for n in range(3):
+        sender.send('exposures', {'experiment': 'e', 'subject': f's{n}', 'cohort': 'a'})
+    sender.close()
+    assert [len(records) for _, records in session.requests] == [3]
+    assert sender.send('exposures', {'experiment': 'e', 'subject': 's4', 'cohort': 'a'}) is False
+
+
+def test_sender_flush_waits_for_the_thread():
+    session = Session()
+    sender = BufferedSender('token', api_url='http://api', batch_size=2, flush_interval=60, session=session)
+    for n in range(5):
+        sender.send('exposures', {'experiment': 'e', 'subject': f's{n}', 'cohort': 'a'})
+    assert sender.flush(timeout=5)
+    assert [len(records) for _, records in session.requests] == [2, 2, 1]
+    assert set(session.threads) == {'quicksplit-sender'}
+    assert sender.stats['sent'] == 5
+    sender.close()
+    assert sender.flush(timeout=5)
+
+
+def test_sender_drops_when_full():
+    sender = BufferedSender('token', api_url='http://api', flush_interval=60, max_size=2, session=Session())
+    results = [sender.send('exposures', {'subject': n}) for n in range(3)]
+    assert results == [True, True, False]
+    assert [record['subject'] for _, record, _ in sender.buffer] == [0, 1]
+
+    sender = BufferedSender('token', api_url='http://api', flush_interval=60, max_size=2, drop='oldest',
+                            session=Session())
+    for n in range(3):
+        sender.send('exposures', {'subject': n})
+    assert [record['subject'] for _, record, _ in sender.buffer] == [1, 2]
+    assert sender.stats['dropped'] == 1
+
+
+def test_sender_retries_server_errors(monkeypatch):
+    monkeypatch.setattr(cli.sender, 'BACKOFF', 0)
+    session = Session(503, 200, 422)
+    sender = BufferedSender('token', api_url='http://api', flush_interval=60, session=session)
+    sender.send('exposures', {'subject': 1})
+    sender.flush()
+    sender.send('exposures', {'subject': 2})
+    sender.close()
+    assert len(session.requests) == 3
+    assert sender.stats == {'sent': 1, 'dropped': 0, 'rejected': 1, 'failed': 0}
+
+
+def test_sender_survives_bad_events():
+    session = Session(RuntimeError("unexpected"), Response(200, rejected=[1]))
+    sender = BufferedSender('token', api_url='http://api', flush_interval=60, session=session)
+    with pytest.raises(ValueError):
+        sender.send('exposure', {'subject': 1})
+    sender.send('exposures', {'subject': 1})
+    assert sender.flush(timeout=5)
+    sender.send('exposures', {'subject': 2})
+    sender.send('exposures', {'subject': 3})
+    assert sender.flush(timeout=5)
+    sender.close()
+    assert sender.stats == {'sent': 1, 'dropped': 0, 'rejected': 1, 'failed': 1}
@@ -0,0 +1,41 @@
+from pytest import raises
+
+from app import sql
+from app.sql import Query, experiment_results
+
+
+def test_query_params():
+    query = Query('example', "-- params: user_id uuid, day date\nselect :user_id, cast(:day as date), now()::date")
+    assert query.params == [('user_id', 'uuid'), ('day', 'date')]
+    assert str(query.prepare_statement) == \
+        "prepare sql_example(uuid, date) as -- params: user_id uuid, day date\nselect $1, cast($2 as date), now()::date"
+
+    with raises(ValueError):
+        Query('example', "select :user_id")
+
+    with raises(ValueError):
+        Query('example', "-- params: user_id serial\nselect :user_id")
+
+
+def test_execute_prepares_once(app, db, user):
+    calls = experiment_results.calls
+    experiment_results.execute(user_id=user.id).fetchall()
+    experiment_results.execute(user_id=str(user.id)).fetchall()
+    assert experiment_results.calls == calls + 2
+    assert sql.stats()['experiment_results']['seconds'] > 0
+
+    prepared = db.session.execute(
+        "select count(*) from pg_prepared_statements where name = 'sql_experiment_results'"
+    ).scalar()
+    assert prepared == 1
+
+    with raises(ValueError):
+        experiment_results.execute()
+
+
+def test_execute_without_prepared_statements(app, db, user):
+    app.config['SQL_PREPARED_STATEMENTS'] = False
+    try:
+        assert experiment_results.execute(user_id=user.id).fetchall() == []
+    finally:
+        app.config['SQL_PREPARED_STATEMENTS'] = True
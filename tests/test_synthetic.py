@@ -0,0 +1,48 @@
+from app.commands import synthetic as synthetic_command
+from app.models import Experiment, Exposure, ExposureRollup, Subject
+from app.synthetic import generate, zipf_split
+
+
+def test_zipf_split():
+    parts = zipf_split(1000, 4, 1.0)
+    assert parts == sorted(parts, reverse=True)
+    assert abs(sum(parts) - 1000) <= 2
+    assert parts[0] == round(parts[1] * 2)
+
+
+def test_generate(db):
+    counts = generate(accounts=2, experiments=3, subjects=50, exposures=200, days=3, seed=1)
+    assert counts['accounts'] == 2
+    assert counts['experiments'] == 6
+    assert counts['subjects'] == 100
+    assert 0 < counts['exposures'] <= 200
+    db.session.expire_all()
+
+    experiments = Experiment.query.filter(Experiment.name.like('synthetic-%')).all()
+    assert sum(e.subjects_counter_production for e in experiments) == counts['exposures']
+    for experiment in experiments:
+        exposures = experiment.exposures.order_by(Exposure.last_seen_at.desc()).all()
+        assert experiment.subjects_counter_production == len(exposures)
+        if exposures:
+            assert experiment.last_exposure_id_production == exposures[0].id
+
+    subject = Subject.query.filter(Subject.last_exposure_id_production!=None).first()
+    latest = Exposure.query.filter(Exposure.subject_id==subject.id).order_by(Exposure.last_seen_at.desc()).first()
+    assert subject.last_exposure_id_production == latest.id
+
+    rollups = ExposureRollup.query.filter(ExposureRollup.experiment_id.in_([e.id for e in experiments])).all()
+    assert rollups
+    assert sum(r.exposures for r in rollups) <= counts['exposures']
+
+
+def test_synthetic_command(app, db):
+    runner = app.test_cli_runner()
+    result = runner.invoke(synthetic_command, ['--accounts', '1', '--experiments', '2', '--subjects', '10',
+                                               '--exposures', '10', '--days', '2'])
+    assert result.exit_code == 0, result.output
+    assert "Not commiting during tests" in result.output
+    # The runner's app context rolls the rows back when it ends, so the
+    # counts it printed are all there is to check
+    assert "'accounts': 1" in result.output
+    assert "'experiments': 2" in result.output
+    assert "'exposures': 10" in result.output
@@ -0,0 +1,74 @@
+from flask import g
+from pytest import raises
+from sqlalchemy.exc import OperationalError
+
+from app.models import db as _db
+from app.pools import InstrumentedQueuePool
+from app.resources import ExposuresResource, ResultsResource, RecentResource
+from app.workloads import workload, current_workload
+
+
+def test_workload_decorator():
+    assert ExposuresResource.post.workload == 'ingestion'
+    assert ResultsResource.post.workload == 'analytics'
+    assert not hasattr(RecentResource.get, 'workload')
+
+    with raises(ValueError):
+        workload('unknown')
+
+
+def test_workload_resolved_per_request(app):
+    with app.test_request_context('/exposures', method='POST'):
+        app.preprocess_request()
+        assert g.workload == 'ingestion'
+        assert current_workload() == 'ingestion'
+
+    with app.test_request_context('/recent'):
+        app.preprocess_request()
+        assert g.workload == app.config['DEFAULT_WORKLOAD']
+
+    with app.app_context():
+        assert current_workload() == 'background'
+
+
+def test_engine_uses_configured_pool(app):
+    with app.app_context():
+        pool = _db.engine.pool
+        assert isinstance(pool, InstrumentedQueuePool)
+        assert pool.size() == app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size']
+        checkouts = pool.stats.checkouts
+        with _db.engine.connect() as conn:
+            conn.execute("select 1")
+        assert pool.stats.checkouts == checkouts + 1
+
+
+# `show` rounds to the largest exact unit, pg_settings is always in ms
+STATEMENT_TIMEOUT = "select setting::int from pg_settings where name = 'statement_timeout'"
+
+
+def test_statement_timeout_applied_on_checkout(app):
+    timeouts = app.config['STATEMENT_TIMEOUTS']
+    with app.test_request_context('/exposures', method='POST'):
+        g.workload = 'ingestion'
+        with _db.engine.connect() as conn:
+            assert conn.execute(STATEMENT_TIMEOUT).scalar() == timeouts['ingestion']
+
+    with app.test_request_context('/results', method='POST'):
+        g.workload = 'analytics'
+        with _db.engine.connect() as conn:
+            assert conn.execute(STATEMENT_TIMEOUT).scalar() == timeouts['analytics']
+
+
+def test_statement_timeout_returns_503(app):
+    with app.test_request_context('/exposures', method='POST'):
+        g.workload = 'ingestion'
+        with _db.engine.connect() as conn:
+            conn.execute("set local statement_timeout = 10")
+            with raises(OperationalError):
+                try:
+                    conn.execute("select pg_sleep(1)")
+                except OperationalError as exc:
+                    # Flask expects to handle the exception being raised
+                    resp = app.handle_user_exception(exc)
+                    raise
+    assert resp.status_code == 503